@@ -1,23 +1,31 @@
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import requests
 
 from mds_logging import getLogger, timed
+from deadline import default_timeout
+from circuit_breaker import circuit_breakers
 from gateway_request_environment_plugin import GatewayRequestEnvironment
 from service_exception_handler_plugin import InternalError
 from settings import get_required_setting
+from token_manager import TokenManager, get_mop_token_manager
+from upstream_pool import upstream_pool
 
 
 ll = getLogger("agw." + __name__)
 
 
 class PatchMopAccessItem:
-    _SESSION = requests.session()
     _PATCH_ENDPOINT: Optional[str] = None
-    _TICKET_INTROSPECTION_ENDPOINT: Optional[str] = None
+    _TOKENS: Optional[TokenManager] = None
 
     def __init__(self, after_hook_definition: Dict[str, Any]) -> None:
-        self.__class__._TICKET_INTROSPECTION_ENDPOINT = get_required_setting(
-            'PATCH_MOP_ACCESS_ITEM_PATCH_ENDPOINT')
+        if self.__class__._PATCH_ENDPOINT is None:
+            self.__class__._PATCH_ENDPOINT = get_required_setting('PATCH_MOP_ACCESS_ITEM_PATCH_ENDPOINT')
+        if self.__class__._TOKENS is None:
+            self.__class__._TOKENS = get_mop_token_manager()
+
+    def get_references(self) -> Tuple[List[str], List[str]]:
+        return ['route.extra.mop_request_ticket', 'error'], []
 
     @timed
     def run(self, gre: GatewayRequestEnvironment) -> None:
@@ -26,26 +34,35 @@ class PatchMopAccessItem:
         if 'mop_request_ticket' not in gre.route.extra:
             return
         info = gre.route.extra['mop_request_ticket']
-        if 'access_item_uuid' not in info or 'agw_token' not in info:
+        if 'access_item_uuid' not in info:
             raise InternalError("Badly formed 'mop_request_ticket' in GatewayRequestEnvironment "
                                 "'route.extra'")
 
         access_item_uuid = info['access_item_uuid']
         ll.debug(f"MOP access_item_uuid: {access_item_uuid}")
 
-        agw_token = info['agw_token']
-
-        try:
-            patch_response = cls._SESSION.patch(
-                f"{cls._TICKET_INTROSPECTION_ENDPOINT}/{access_item_uuid}",
-                headers={'Authorization': f'bearer {agw_token}'},
-                json={
-                    'success': True if not gre.error else False,
-                    'additional_info': "" if not gre.error else gre.error,
-                    'status': 'completed'
-                })
-        except requests.RequestException as e:
-            raise InternalError(f'Connection to MOP failed: {str(e)}')
+        # The token of the introspection may have expired while the route was handled
+        agw_token = cls._TOKENS.get_token()  # type: ignore  # created in __init__
+
+        for try_count in range(2):
+            try:
+                patch_response = circuit_breakers.call(
+                    str(cls._PATCH_ENDPOINT),
+                    upstream_pool.get_session(str(cls._PATCH_ENDPOINT)).patch,
+                    f"{cls._PATCH_ENDPOINT}/{access_item_uuid}",
+                    headers={'Authorization': f'bearer {agw_token}'},
+                    json={
+                        'success': True if not gre.error else False,
+                        'additional_info': "" if not gre.error else gre.error,
+                        'status': 'completed'
+                    },
+                    timeout=default_timeout())
+            except requests.RequestException as e:
+                raise InternalError(f'Connection to MOP failed: {str(e)}')
+            if patch_response.status_code != 401 or try_count:
+                break
+            ll.info(f"AGW token has expired: {patch_response.text}")
+            agw_token = cls._TOKENS.renew(agw_token)  # type: ignore  # created in __init__
 
         if patch_response.status_code != 200:
             raise InternalError(f"Patching of MOP access item failed. Status: {patch_response.status_code}, "
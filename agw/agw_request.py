@@ -1,18 +1,127 @@
 from dataclasses import dataclass
-from typing import Dict, Union, Any, Optional, List
-from copy import deepcopy
+from typing import Dict, Union, Any, Optional, List, Mapping
+from urllib.parse import parse_qs
 
+import charset_normalizer
+
+import json_codec
 from http_method import HttpMethod
+from service_exception_handler_plugin import InternalError
+from util import ReadOnlyMapping
+
+
+class _NotDecoded:
+    pass
+
+
+_NOT_DECODED: Any = _NotDecoded()
 
 
-@dataclass
 class AGWRequestResponse:
-    status: int
-    headers: Dict[str, str]
-    text: str
-    json: Optional[Dict[str, Union[str, Any]]] = None
-    data: Optional[Dict[str, Union[str, Any]]] = None
-    extra: Optional[Dict[Any, Any]] = None
+    """
+    Response of an upstream request.
+
+    The body is kept as the raw content received from upstream. `text`, `json` and `data` are decoded from it only when
+    they are accessed for the first time (e.g. through `GatewayRequestEnvironment.get`), so responses whose body is
+    never referenced are never decoded. All of them can be replaced, e.g. by processors. Headers are a read-only view of
+    the received headers.
+    """
+
+    def __init__(
+        self,
+        status: int,
+        headers: Mapping[str, str],
+        content: bytes = b'',
+        encoding: Optional[str] = None,
+        extra: Optional[Dict[Any, Any]] = None
+    ) -> None:
+        self.status = status
+        self.headers: Mapping[str, str] = headers if isinstance(headers, ReadOnlyMapping) else ReadOnlyMapping(headers)
+        self.content = content
+        self.encoding = encoding
+        self.extra = extra
+        self._text: Optional[str] = _NOT_DECODED
+        self._json: Optional[Dict[str, Union[str, Any]]] = _NOT_DECODED
+        # Values of form data are lists of strings
+        self._data: Optional[Dict[str, Any]] = _NOT_DECODED
+
+    @property
+    def content_type(self) -> str:
+        return self.headers.get('Content-Type', '')
+
+    @property
+    def text(self) -> Optional[str]:
+        if self._text is _NOT_DECODED:
+            encoding = self.encoding
+            if not encoding:
+                # As requests guesses the encoding of a response without a charset
+                best = charset_normalizer.from_bytes(self.content).best()
+                encoding = best.encoding if best is not None else None
+            try:
+                self._text = str(self.content, encoding if encoding else 'utf-8', errors='replace')
+            except LookupError:
+                self._text = str(self.content, 'utf-8', errors='replace')
+        return self._text
+
+    @text.setter
+    def text(self, value: Optional[str]) -> None:
+        self._text = value
+
+    @text.deleter
+    def text(self) -> None:
+        self._text = None
+
+    @property
+    def json(self) -> Optional[Dict[str, Union[str, Any]]]:
+        if self._json is _NOT_DECODED:
+            self._json = None
+            if "application/json" in self.content_type:
+                try:
+                    self._json = json_codec.loads(self.content)
+                except ValueError as e:
+                    raise InternalError('Upstream response is not valid JSON', log=f'Cannot decode JSON: {e}')
+        return self._json
+
+    @json.setter
+    def json(self, value: Optional[Dict[str, Union[str, Any]]]) -> None:
+        self._json = value
+
+    @json.deleter
+    def json(self) -> None:
+        self._json = None
+
+    @property
+    def data(self) -> Optional[Dict[str, Union[str, Any]]]:
+        if self._data is _NOT_DECODED:
+            self._data = None
+            if "application/x-www-form-urlencoded" in self.content_type:
+                self._data = parse_qs(self.text)
+        return self._data
+
+    @data.setter
+    def data(self, value: Optional[Dict[str, Union[str, Any]]]) -> None:
+        self._data = value
+
+    @data.deleter
+    def data(self) -> None:
+        self._data = None
+
+    def copy(self) -> 'AGWRequestResponse':
+        """
+        Get a new response with the same status, headers and content, decoded independently of this one.
+
+        :return: The copy.
+        """
+        return AGWRequestResponse(
+            status=self.status,
+            headers=self.headers,
+            content=self.content,
+            encoding=self.encoding
+        )
+
+    def __repr__(self) -> str:
+        return f"AGWRequestResponse(status={self.status}, headers={self.headers}, content={self.content[:300]!r}" \
+               f"{'...' if len(self.content) > 300 else ''})"
 
 
 @dataclass
@@ -27,21 +136,45 @@ class AGWRequestDefinition:
     data: Optional[Dict[str, Union[str, Any]]] = None
     builders: Optional[List[Dict[str, Union[str, Any]]]] = None
     processors: Optional[List[Dict[str, Union[str, Any]]]] = None
+    pool: Optional[Dict[str, Any]] = None
+    connect_timeout: Optional[float] = None
+    read_timeout: Optional[float] = None
+    cache: Optional[Dict[str, Any]] = None
+    single_flight: Optional[bool] = None
+    retry: Optional[Dict[str, Any]] = None
+    hedge: Optional[Dict[str, Any]] = None
 
 
 class AGWRequest(AGWRequestDefinition):
+    """
+    Upstream request of a single route invocation.
+
+    The nodes of the definition are shared, not copied. They are frozen (see `util.freeze`), and the GRE replaces them
+    with mutable copies only when templates are evaluated in them or when they are written to.
+    """
+
     def __init__(self, definition: AGWRequestDefinition):
         super().__init__(
             url=definition.url,
             method=definition.method,
             name=definition.name,
-            includes=deepcopy(definition.includes),
-            headers=deepcopy(definition.headers),
+            includes=definition.includes,
+            headers=definition.headers,
             text=definition.text,
-            json=deepcopy(definition.json),
-            data=deepcopy(definition.data),
-            builders=deepcopy(definition.builders),
-            processors=deepcopy(definition.processors)
+            json=definition.json,
+            data=definition.data,
+            builders=definition.builders,
+            processors=definition.processors,
+            pool=definition.pool,
+            connect_timeout=definition.connect_timeout,
+            read_timeout=definition.read_timeout,
+            cache=definition.cache,
+            single_flight=definition.single_flight,
+            retry=definition.retry,
+            hedge=definition.hedge
         )
 
         self.response: Optional[AGWRequestResponse]
+        # Body rendered from the json or data compiled at load (see `body_template`), sent instead of them
+        self.body: Optional[bytes] = None
+        self.body_content_type: Optional[str] = None
@@ -1,6 +1,5 @@
 from dataclasses import dataclass
 from typing import Dict, Union, Any, Optional, List
-from copy import deepcopy
 
 
 @dataclass
@@ -14,12 +13,16 @@ class AGWResponseDefinition:
 
 
 class AGWResponse(AGWResponseDefinition):
+    """
+    Response of a single route invocation, sharing the frozen nodes of its definition like `AGWRequest`.
+    """
+
     def __init__(self, definition: AGWResponseDefinition):
         super().__init__(
             status=definition.status,
-            headers=deepcopy(definition.headers),
+            headers=definition.headers,
             text=definition.text,
-            json=deepcopy(definition.json),
-            data=deepcopy(definition.data),
-            generators=deepcopy(definition.generators)
+            json=definition.json,
+            data=definition.data,
+            generators=definition.generators
         )
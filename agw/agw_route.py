@@ -1,6 +1,5 @@
 from dataclasses import dataclass
 from typing import Dict, Union, List, Any, Optional
-from copy import deepcopy
 
 from http_method import HttpMethod
 
@@ -10,6 +9,7 @@ class AGWRouteDefinition:
     path: str
     method: HttpMethod
     plugins: Optional[List[Dict[str, Union[str, Any]]]] = None
+    deadline: Optional[float] = None
 
 
 class AGWRoute(AGWRouteDefinition):
@@ -17,7 +17,8 @@ class AGWRoute(AGWRouteDefinition):
         super().__init__(
             path=definition.path,
             method=definition.method,
-            plugins=deepcopy(definition.plugins)
+            plugins=definition.plugins,
+            deadline=definition.deadline
         )
 
         self.headers: Optional[Dict[str, str]]
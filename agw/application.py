@@ -6,12 +6,13 @@ import random  # nosec
 import bottle
 import json
 
+import json_codec
 import mds_logging
 import settings
 from gateway_controller import GatewayController
-from after_hooks import get_after_hook
 from gateway_request_environment_plugin import GatewayRequestEnvironment
 from util import walk_dir
+from stats import get_stats
 
 ll: mds_logging.MdsLogger = logging.getLogger("agw")
 HEALTHCHECK_PATH = '/healthcheck'
@@ -29,11 +30,15 @@ class AGW:
 
         self.initialize_bottle()
         self.initializa_healtcheck_endpoint()
+        self.initialize_stats_endpoint()
         self.read_includes()
         self.initialize_routes()
 
     def initialize_bottle(self):
         self.app = bottle.app()
+        # Return values are serialized with the JSON codec
+        self.app.uninstall('json')
+        self.app.install(bottle.JSONPlugin(json_dumps=json_codec.dumps))
 
         self.app.add_hook('before_request', before_request)
         self.app.add_hook('after_request', after_request)
@@ -75,10 +80,20 @@ class AGW:
         ll.info(f"Initializing healthcheck endpoint: {HEALTHCHECK_PATH}")
         self.app.route(path=HEALTHCHECK_PATH, method='GET', callback=AGW._healthcheck)
 
+    def initialize_stats_endpoint(self):
+        if not settings.STATS_PATH:
+            return
+        ll.info(f"Initializing stats endpoint: {settings.STATS_PATH}")
+        self.app.route(path=settings.STATS_PATH, method='GET', callback=AGW._stats)
+
     @staticmethod
     def _healthcheck():
         return {'status': 'OK'}
 
+    @staticmethod
+    def _stats():
+        return {'pid': os.getpid(), 'stats': get_stats()}
+
 
 # Hook callbacks for bottle
 
@@ -117,8 +132,8 @@ def after_request():
     if 'gre' in bottle.request.environ:
         gre: GatewayRequestEnvironment = bottle.request.environ['gre']
         if gre.after_hooks:
-            for after_hook_definition in gre.after_hooks:
-                get_after_hook(after_hook_definition).run(gre)
+            for after_hook in gre.after_hooks:
+                after_hook.run(gre)
 
     elapsed = time.time() - bottle.request.environ['request_time']
     if bottle.request.path != HEALTHCHECK_PATH:
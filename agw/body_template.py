@@ -0,0 +1,140 @@
+import numbers
+from typing import Any, Callable, FrozenSet, List, Mapping, Optional, Tuple
+from urllib.parse import quote_plus
+
+import json_codec
+from template import Template, get_template, repeated_keys, KeyPart
+from util import FrozenDict, FrozenList
+
+
+class BodyTemplate:
+    """
+    A body of a request or a response compiled into a serializer plan: pre-encoded byte fragments, and slots for the
+    templated strings between them.
+
+    Rendering fills the slots with the encoded values of the templates, so per request only the templated strings are
+    evaluated and encoded, and the rest of the body is neither copied nor serialized. `repeated_keys` are the keys
+    occurring in more than one slot, memoized when the body is rendered.
+    """
+
+    __slots__ = ('fragments', 'slots', 'repeated_keys')
+
+    CONTENT_TYPE: str
+
+    def __init__(self) -> None:
+        self.fragments: List[bytes] = []
+        self.slots: List[Template] = []
+        self.repeated_keys: FrozenSet[str] = frozenset()
+
+    def _slot(self, text: List[bytes], template: Template) -> None:
+        # Ends the current fragment of text with a slot for the template
+        self.fragments.append(b''.join(text))
+        text.clear()
+        self.slots.append(template)
+
+    def _end(self, text: List[bytes]) -> None:
+        # Ends the last fragment, once all the slots are known
+        self.fragments.append(b''.join(text))
+        self.repeated_keys = repeated_keys(key for template in self.slots for key, _ in template.keys)
+
+    def _encode(self, value: str) -> bytes:
+        raise NotImplementedError()
+
+    def render(self, lookup: Callable[[str, Optional[Tuple[KeyPart, ...]]], str]) -> bytes:
+        """
+        Render the body.
+
+        :param lookup: See `Template.render`.
+        :return: The encoded body.
+        """
+        fragments = self.fragments
+        encode = self._encode
+        out = [fragments[0]]
+        for i, template in enumerate(self.slots):
+            out.append(encode(template.render(lookup)))
+            out.append(fragments[i + 1])
+        return b''.join(out)
+
+
+class JsonTemplate(BodyTemplate):
+    """
+    A json body compiled into a `BodyTemplate`. The output is the same as `json_codec.dumps` (used by bottle's JSON
+    plugin and for the json of upstream requests) of the evaluated json.
+    """
+
+    __slots__ = ()
+
+    CONTENT_TYPE = 'application/json'
+
+    def __init__(self, node: Any) -> None:
+        super().__init__()
+        text: List[bytes] = []
+        self._compile(node, text)
+        self._end(text)
+
+    def _compile(self, node: Any, text: List[bytes]) -> None:
+        # Appends the JSON of the node to text, ending the current fragment at each templated string
+        template = get_template(node) if isinstance(node, str) else None
+        if template is not None:
+            self._slot(text, template)
+        elif isinstance(node, dict) and node and _may_contain_templates(node):
+            text.append(b'{')
+            for i, (key, value) in enumerate(node.items()):
+                # Keys are not evaluated. The keys of a definition read from JSON are always strings.
+                if i:
+                    text.append(json_codec.ITEM_SEPARATOR)
+                text.append(json_codec.dumps(key) + json_codec.KEY_SEPARATOR)
+                self._compile(value, text)
+            text.append(b'}')
+        elif isinstance(node, list) and node and _may_contain_templates(node):
+            text.append(b'[')
+            for i, value in enumerate(node):
+                if i:
+                    text.append(json_codec.ITEM_SEPARATOR)
+                self._compile(value, text)
+            text.append(b']')
+        else:
+            text.append(json_codec.dumps(node))
+
+    def _encode(self, value: str) -> bytes:
+        return json_codec.dumps(value)
+
+
+class FormTemplate(BodyTemplate):
+    """
+    A data body (form fields) compiled into a `BodyTemplate`, with URL-encoded slots. The output is the same as the
+    encoding of the evaluated data by requests.
+    """
+
+    __slots__ = ()
+
+    CONTENT_TYPE = 'application/x-www-form-urlencoded'
+
+    def __init__(self, data: Mapping[str, Any]) -> None:
+        super().__init__()
+        text: List[bytes] = []
+        for i, (key, value) in enumerate(data.items()):
+            text.append((b'&' if i else b'') + self._encode(str(key)) + b'=')
+            template = get_template(value) if isinstance(value, str) else None
+            if template is not None:
+                self._slot(text, template)
+            else:
+                text.append(self._encode(str(value)))
+        self._end(text)
+
+    @staticmethod
+    def supports(data: Any) -> bool:
+        """
+        Tell if data can be compiled into a FormTemplate: it is a dict of single values (requests e.g. repeats a field
+        for each value of a list).
+        """
+        return isinstance(data, dict) and \
+            all(isinstance(value, (str, numbers.Number)) for value in data.values())
+
+    def _encode(self, value: str) -> bytes:
+        return quote_plus(value).encode('ascii')
+
+
+def _may_contain_templates(node: Any) -> bool:
+    # Mutable nodes are not known not to contain templates
+    return node.templated if isinstance(node, (FrozenDict, FrozenList)) else True
@@ -0,0 +1,109 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from stats import register_stats
+
+
+class LRUCache:
+    """
+    Thread-safe, memory-bounded LRU cache with a TTL for each entry.
+
+    Entries are evicted in least recently used order when the total size of the entries would exceed `max_size`. The
+    size of an entry is given by the caller, typically the size of its payload in bytes. Expired entries are removed
+    when they are looked up.
+
+    The cache lives in the memory of a single worker process.
+    """
+
+    def __init__(self, name: str, max_size: int, max_entries: Optional[int] = None) -> None:
+        """
+        :param name: Name of the cache, used for registering its stats.
+        :param max_size: Maximum total size of the entries.
+        :param max_entries: Optional maximum number of entries.
+        """
+        self.name = name
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._entries: 'OrderedDict[Hashable, Tuple[Any, float, int]]' = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        register_stats(name, self.stats)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Get a value from the cache.
+
+        :param key: Key of the entry.
+        :return: The cached value or None if the key is not cached or has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, size = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any, ttl: float, size: int = 1) -> bool:
+        """
+        Add a value to the cache.
+
+        :param key: Key of the entry.
+        :param value: The value to cache.
+        :param ttl: Time to live of the entry in seconds.
+        :param size: Size of the entry.
+        :return: True if the value was cached, False if it is too large for the cache or the TTL is not positive.
+        """
+        if ttl <= 0 or size > self.max_size:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while self._entries and (self.size + size > self.max_size or
+                                     (self.max_entries is not None and len(self._entries) >= self.max_entries)):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = (value, time.monotonic() + ttl, size)
+            self.size += size
+            return True
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, size = self._entries.pop(key)
+        self.size -= size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
@@ -0,0 +1,209 @@
+import time
+from collections import deque
+from threading import Lock
+from typing import Any, Callable, Deque, Dict, Tuple
+from urllib.parse import urlsplit
+
+import requests
+
+import settings
+from mds_logging import getLogger
+from service_exception_handler_plugin import ServiceUnavailableError
+from stats import register_stats
+
+ll = getLogger("agw." + __name__)
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of a single upstream host.
+
+    The outcomes of the calls made to the host during the last `CIRCUIT_BREAKER_WINDOW` seconds are recorded. Once
+    there are at least `CIRCUIT_BREAKER_MIN_CALLS` calls in the window and either the rate of failed calls (connection
+    errors, timeouts and 5xx responses) or the rate of slow calls reaches its threshold, the circuit opens: calls are
+    rejected without contacting the host for `CIRCUIT_BREAKER_OPEN_DURATION` seconds. After that the circuit is half
+    open and lets through up to `CIRCUIT_BREAKER_HALF_OPEN_CALLS` trial calls. If all of them succeed the circuit
+    closes, if any of them fails the circuit opens again.
+    """
+
+    def __init__(self, host: str) -> None:
+        self.host = host
+        self._lock = Lock()
+        self.state = CLOSED
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()
+        self._failures = 0
+        self._slow = 0
+        self._opened_at = 0.0
+        self._trials = 0
+        self._trial_successes = 0
+        self.rejected = 0
+        self.opened = 0
+
+    def before_call(self) -> None:
+        """
+        Check that a call can be made to the host.
+
+        :raises ServiceUnavailableError: If the circuit is open.
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < settings.CIRCUIT_BREAKER_OPEN_DURATION:
+                    self._reject()
+                ll.info(f"Circuit of {self.host} is half open")
+                self.state = HALF_OPEN
+                self._trials = 0
+                self._trial_successes = 0
+            if self.state == HALF_OPEN:
+                if self._trials >= settings.CIRCUIT_BREAKER_HALF_OPEN_CALLS:
+                    self._reject()
+                self._trials += 1
+
+    def record(self, success: bool, duration: float) -> None:
+        """
+        Record the outcome of a call allowed by `before_call`.
+
+        :param success: False if the call failed.
+        :param duration: Duration of the call in seconds.
+        :return: None
+        """
+        slow = duration >= settings.CIRCUIT_BREAKER_SLOW_CALL_DURATION
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if not success or slow:
+                    self._open(f"trial call {'failed' if not success else 'was slow'}")
+                else:
+                    self._trial_successes += 1
+                    if self._trial_successes >= settings.CIRCUIT_BREAKER_HALF_OPEN_CALLS:
+                        ll.info(f"Circuit of {self.host} closed")
+                        self.state = CLOSED
+                        self._reset_window()
+                return
+            if self.state == OPEN:
+                # Call started before the circuit opened
+                return
+
+            now = time.monotonic()
+            self._calls.append((now, not success, slow))
+            self._failures += not success
+            self._slow += slow
+            while self._calls and self._calls[0][0] < now - settings.CIRCUIT_BREAKER_WINDOW:
+                _, failed, was_slow = self._calls.popleft()
+                self._failures -= failed
+                self._slow -= was_slow
+
+            calls = len(self._calls)
+            if calls < settings.CIRCUIT_BREAKER_MIN_CALLS:
+                return
+            if self._failures / calls >= settings.CIRCUIT_BREAKER_FAILURE_RATE:
+                self._open(f"{self._failures} of {calls} calls failed")
+            elif self._slow / calls >= settings.CIRCUIT_BREAKER_SLOW_CALL_RATE:
+                self._open(f"{self._slow} of {calls} calls took at least "
+                           f"{settings.CIRCUIT_BREAKER_SLOW_CALL_DURATION}s")
+
+    def cancel(self) -> None:
+        """
+        Release a call allowed by `before_call` without recording its outcome.
+
+        :return: None
+        """
+        with self._lock:
+            if self.state == HALF_OPEN and self._trials > 0:
+                self._trials -= 1
+
+    def _open(self, reason: str) -> None:
+        ll.warning(f"Circuit of {self.host} opened: {reason}")
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self.opened += 1
+        self._reset_window()
+
+    def _reset_window(self) -> None:
+        self._calls.clear()
+        self._failures = 0
+        self._slow = 0
+
+    def _reject(self) -> None:
+        self.rejected += 1
+        raise ServiceUnavailableError('Service unavailable', log=f'Circuit of upstream host {self.host} is open')
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'state': self.state,
+            'calls': len(self._calls),
+            'failures': self._failures,
+            'slow': self._slow,
+            'opened': self.opened,
+            'rejected': self.rejected,
+        }
+
+
+class CircuitBreakers:
+    """
+    Per worker registry of the circuit breakers of upstream hosts.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, url: str) -> CircuitBreaker:
+        """
+        Get the circuit breaker of the scheme and host of the given URL.
+
+        :param url: URL to be requested.
+        :return: The circuit breaker.
+        """
+        parts = urlsplit(url)
+        host = f'{parts.scheme.lower()}://{parts.netloc.lower()}'
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(host, CircuitBreaker(host))
+        return breaker
+
+    def call(self, url: str, fn: Callable[..., requests.Response], *args: Any, **kwargs: Any) -> requests.Response:
+        """
+        Make an upstream call through the circuit breaker of the host of the URL.
+
+        Connection errors, timeouts and responses with a 5xx status are recorded as failures. A timeout is not recorded
+        if the `timeout` given to `fn` was truncated to the time left before the deadline of the route (see
+        `Deadline.timeout`), as the host was not given the time it is allowed.
+
+        :param url: URL to be requested.
+        :param fn: Function making the call, e.g. `session.request`.
+        :param args: Arguments of `fn`.
+        :param kwargs: Keyword arguments of `fn`.
+        :return: The response returned by `fn`.
+        :raises ServiceUnavailableError: If the circuit of the host is open.
+        """
+        if not settings.CIRCUIT_BREAKER_ENABLED:
+            return fn(*args, **kwargs)
+
+        breaker = self.get(url)
+        breaker.before_call()
+        start = time.monotonic()
+        try:
+            response = fn(*args, **kwargs)
+        except requests.Timeout:
+            if getattr(kwargs.get('timeout'), 'truncated', False):
+                breaker.cancel()
+            else:
+                breaker.record(False, time.monotonic() - start)
+            raise
+        except Exception:
+            breaker.record(False, time.monotonic() - start)
+            raise
+        breaker.record(response.status_code < 500, time.monotonic() - start)
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        return {host: breaker.stats() for host, breaker in list(self._breakers.items())}
+
+
+circuit_breakers = CircuitBreakers()
+register_stats('circuit_breakers', circuit_breakers.stats)
@@ -0,0 +1,71 @@
+import time
+from typing import Optional, Tuple
+
+import settings
+from service_exception_handler_plugin import GatewayTimeoutError
+
+
+def default_timeout() -> Tuple[float, float]:
+    """Get the default (connect, read) timeout for upstream requests made outside of a route deadline."""
+    return settings.UPSTREAM_CONNECT_TIMEOUT, settings.UPSTREAM_READ_TIMEOUT
+
+
+class Timeout(Tuple[float, float]):
+    """
+    (connect, read) timeout of an upstream request, `truncated` is True if it was limited by the deadline of the route.
+    """
+
+    truncated: bool
+
+    def __new__(cls, connect: float, read: float, truncated: bool = False) -> 'Timeout':
+        timeout = super().__new__(cls, (connect, read))
+        timeout.truncated = truncated
+        return timeout
+
+
+class Deadline:
+    """
+    End-to-end time budget of a route.
+
+    Every upstream request made while handling the route gets at most the time left in the budget as its timeout. If
+    the deadline is None, the requests only use their own timeouts.
+    """
+
+    def __init__(self, seconds: Optional[float] = None):
+        self.seconds = seconds
+        self.expires_at: Optional[float] = time.monotonic() + seconds if seconds else None
+
+    def remaining(self) -> Optional[float]:
+        """
+        Get the time left in the budget.
+
+        :return: Seconds left (can be negative) or None if there is no deadline.
+        """
+        if self.expires_at is None:
+            return None
+        return self.expires_at - time.monotonic()
+
+    def check(self) -> None:
+        """
+        :raises GatewayTimeoutError: If the deadline has expired.
+        """
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise GatewayTimeoutError('Gateway timeout', log=f'Route deadline of {self.seconds}s expired')
+
+    def timeout(self, connect: Optional[float] = None, read: Optional[float] = None) -> Timeout:
+        """
+        Get the (connect, read) timeout for an upstream request, limited by the time left in the budget.
+
+        :param connect: Connect timeout of the request, defaults to AGW_UPSTREAM_CONNECT_TIMEOUT.
+        :param read: Read timeout of the request, defaults to AGW_UPSTREAM_READ_TIMEOUT.
+        :return: A tuple that can be given as the `timeout` of `requests`, telling if it was truncated to the time left.
+        :raises GatewayTimeoutError: If the deadline has already expired.
+        """
+        self.check()
+        connect = connect if connect else settings.UPSTREAM_CONNECT_TIMEOUT
+        read = read if read else settings.UPSTREAM_READ_TIMEOUT
+        remaining = self.remaining()
+        if remaining is None or remaining >= max(connect, read):
+            return Timeout(connect, read)
+        return Timeout(min(connect, remaining), min(read, remaining), truncated=True)
@@ -1,11 +1,15 @@
 import json
-import requests
-from copy import deepcopy
-from urllib.parse import parse_qs, urlencode
-from typing import List, Optional, Dict
+from dataclasses import fields
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from typing import Any, Callable, FrozenSet, List, Optional, Dict, Set, Tuple
 
+import bottle
+import requests
 from bottle import response
 
+import json_codec
+import settings
+
 from builders import get_builder
 from processors import get_processor
 from mds_logging import getLogger, timed
@@ -13,13 +17,29 @@ from agw_route import AGWRouteDefinition
 from agw_request import AGWRequest, AGWRequestDefinition, AGWRequestResponse
 from agw_response import AGWResponse, AGWResponseDefinition
 from plugins import get_plugin
+from upstream_pool import upstream_pool, run_in_request_context
+import response_cache
+from single_flight import upstream_flights, get_flight_key
+from circuit_breaker import circuit_breakers
+from upstream_policy import upstream_policy, validate_retry_policy, validate_hedge_policy
+from request_graph import RequestGraph
+from body_template import BodyTemplate, FormTemplate, JsonTemplate
+from static_response import get_body, get_route_response, set_status_and_headers
+from template import compile_templates, fold_templates, find_template_keys, index_static, parse_key, repeated_keys, \
+    resolve_static, split_key, KeyPart, INDEX, KEY
+from util import freeze
 from generators import get_generator
-from service_exception_handler_plugin import InternalError, ServiceExceptionHandlerPlugin
-from gateway_request_environment_plugin import GatewayRequestEnvironmentPlugin, GatewayRequestEnvironment
+from after_hooks import get_after_hook
+from deadline import Deadline
+from service_exception_handler_plugin import InternalError, GatewayTimeoutError, ServiceExceptionHandlerPlugin
+from gateway_request_environment_plugin import GatewayRequestEnvironmentPlugin, GatewayRequestEnvironment, ENVIRONMENT
 
 
 ll = getLogger("agw." + __name__)
 
+# Fields of a request definition that an include may set when merged into the request at load
+_MERGED_FIELDS = {field.name for field in fields(AGWRequestDefinition)} - {'includes'}
+
 
 class GatewayController(object):
 
@@ -36,45 +56,309 @@ class GatewayController(object):
             raise InternalError(f"Parsing gateway definition '{self.definition_filepath}' failed: {e}")
 
         self.constants = {}
+        self.dynamic_indexes: Dict[Tuple[KeyPart, ...], Tuple[str, Dict[Any, str]]] = {}
         if 'constants' in gateway_definition:
             self.constants = gateway_definition['constants']
             if 'includes' in self.constants:
-                basic_definition = deepcopy(self.constants)
+                basic_definition = dict(self.constants)
                 for incl in self.constants['includes']:
                     self.constants.update(self.includes[incl['file']])
                 self.constants.update(basic_definition)
 
+        if 'requests' in gateway_definition:
+            for req in gateway_definition['requests']:
+                if 'includes' in req:
+                    for incl in req['includes']:
+                        self._include(incl)
+
+        self._fold_templates(gateway_definition)
+        compile_templates(gateway_definition)
+        compile_templates(self.constants)
+        self.constants = freeze(self.constants)
+
         if 'route' not in gateway_definition:
             raise InternalError(f"Gateway definition does not include a 'route'")
-        self.route_definition = AGWRouteDefinition(**gateway_definition['route'])
+        self.route_definition = AGWRouteDefinition(**freeze(gateway_definition['route']))
 
         self.request_definitions = []
         if 'requests' in gateway_definition:
             for req in gateway_definition['requests']:
-                if 'includes' in req:
-                    for incl in req['includes']:
-                        self._include(incl)
-                self.request_definitions.append(AGWRequestDefinition(**req))
+                if 'cache' in req:
+                    response_cache.validate_cache_policy(req['cache'])
+                if 'retry' in req:
+                    validate_retry_policy(req['retry'])
+                if 'hedge' in req:
+                    validate_hedge_policy(req['hedge'])
+                self.request_definitions.append(AGWRequestDefinition(**freeze(req)))
+        self.request_graph = RequestGraph(self.request_definitions)
 
         if 'response' not in gateway_definition:
             raise InternalError(f"Gateway definition does not include a 'response'")
-        self.response_definition = AGWResponseDefinition(**gateway_definition['response'])
+        self.response_definition = AGWResponseDefinition(**freeze(gateway_definition['response']))
 
         self.after_hooks = None
         if 'after_hooks' in gateway_definition:
-            self.after_hooks = gateway_definition['after_hooks']
+            self.after_hooks = [get_after_hook(definition) for definition in freeze(gateway_definition['after_hooks'])]
+
+        self._build_operations()
+        self.json_template = self._compile_json_template()
+        self._compile_request_bodies()
+        self._find_memoized_keys()
+
+        self.route_response = get_route_response(self.route_definition, self.request_definitions,
+                                                 self.response_definition, self.after_hooks)
+        if self.route_response is not None:
+            ll.debug(f"Serving {self.route_definition.path} without GRE ({type(self.route_response).__name__})")
+
+    def _build_operations(self) -> None:
+        """
+        Instantiate and validate the builders, processors and generators of the gateway.
+
+        Operations are stateless, so each one is instantiated once and used for all requests. An operation definition
+        containing templates is replaced with its evaluated copy when a request is evaluated (see
+        `GatewayRequestEnvironment`), in which case the operation is instantiated for that request in `_operation`.
+        """
+        self._operations: Dict[int, Tuple[Dict, Any]] = {}
+
+        def build(factory: Callable[[Dict], Any], definitions: Optional[List[Dict]]) -> None:
+            for definition in definitions or []:
+                self._operations[id(definition)] = (definition, factory(definition))
+
+        for req_def in self.request_definitions:
+            build(get_builder, req_def.builders)
+            build(get_processor, req_def.processors)
+            for incl in req_def.includes or []:
+                if 'include' in incl:
+                    build(get_builder, incl['include'].get('builders'))
+                    build(get_processor, incl['include'].get('processors'))
+        build(get_generator, self.response_definition.generators)
+
+    def _compile_json_template(self) -> Optional[JsonTemplate]:
+        """
+        Compile the json of the response into a JsonTemplate, if nothing reads or modifies the evaluated json.
+
+        The json is not evaluated into GRE when it is rendered from the template, so a response with generators or
+        after hooks that may read the response is evaluated and serialized as usual.
+        """
+        json_body = self.response_definition.json
+        if not json_body or not isinstance(json_body, dict) or self.response_definition.generators:
+            return None
+        for after_hook in self.after_hooks or []:
+            get_references = getattr(after_hook, 'get_references', None)
+            references = get_references() if get_references else None
+            if references is None or any(split_key(key)[0].split('[')[0] == 'response' for key in references[0]):
+                return None
+        return JsonTemplate(json_body)
+
+    def _compile_request_bodies(self) -> None:
+        """
+        Compile the json or data of the requests into BodyTemplates, if nothing reads or modifies the evaluated json or
+        data of the request.
+
+        The body is rendered from the template when the request is evaluated, and the json or data of the request in
+        GRE is left empty. Requests with includes not merged at load, and requests whose json or data is referenced by
+        an operation or a template, are evaluated and encoded as usual.
+        """
+        self._body_templates: Dict[int, Tuple[str, BodyTemplate]] = {}
+        referenced = self._referenced_request_fields()
+        if referenced is None:
+            return
+        for i, req_def in enumerate(self.request_definitions):
+            if any('include' in incl for incl in req_def.includes or []):
+                continue
+            template: BodyTemplate
+            # In the order of precedence of requests
+            if req_def.data:
+                if not FormTemplate.supports(req_def.data):
+                    continue
+                field, template = 'data', FormTemplate(req_def.data)
+            elif req_def.json and isinstance(req_def.json, dict):
+                field, template = 'json', JsonTemplate(req_def.json)
+            else:
+                continue
+            if not any(index in (i, None) and name in (field, None) for index, name in referenced):
+                self._body_templates[i] = (field, template)
+
+    def _find_memoized_keys(self) -> None:
+        """
+        Find the keys referenced more than once by the templates of each request and the response, whose values GRE
+        memoizes while evaluating them. The bodies rendered from BodyTemplates are not evaluated with the rest.
+        """
+        def keys(definition: Any, body: Optional[str]) -> FrozenSet[str]:
+            return repeated_keys(find_template_keys({k: v for k, v in vars(definition).items() if k != body}))
+
+        self._memoized_keys = [keys(req_def, self._body_templates[i][0] if i in self._body_templates else None)
+                               for i, req_def in enumerate(self.request_definitions)]
+        self._response_memoized_keys = keys(self.response_definition, 'json' if self.json_template else None)
+
+    def _referenced_request_fields(self) -> Optional[Set[Tuple[Optional[int], Optional[str]]]]:
+        """
+        Get the fields of the requests (e.g. `json`) referenced by the templates and the operations of the gateway.
+
+        :return: Tuples of the index of the request and the name of the field, None standing for any request or the
+            whole request, or None if an operation does not tell which keys it references.
+        """
+        keys: List[Tuple[str, Optional[int]]] = []
+
+        def add_operations(factory: Callable[[Dict], Any], definitions: Optional[List[Dict]],
+                           i: Optional[int]) -> bool:
+            for definition in definitions or []:
+                get_references = getattr(self._operation(factory, definition), 'get_references', None)
+                references = get_references() if get_references else None
+                if references is None:
+                    return False
+                keys.extend((key, i) for key in references[0] + references[1])
+            return True
+
+        for i, req_def in enumerate(self.request_definitions):
+            keys.extend((key, None) for key in find_template_keys(list(vars(req_def).values())))
+            sources = [req_def.__dict__] + [incl['include'] for incl in req_def.includes or [] if 'include' in incl]
+            for source in sources:
+                if not add_operations(get_builder, source.get('builders'), i) or \
+                        not add_operations(get_processor, source.get('processors'), i):
+                    return None
+        keys.extend((key, None) for key in find_template_keys(list(vars(self.response_definition).values())))
+        # The self of generators is the response
+        if not add_operations(get_generator, self.response_definition.generators, None):
+            return None
+        for after_hook in self.after_hooks or []:
+            get_references = getattr(after_hook, 'get_references', None)
+            references = get_references() if get_references else None
+            if references is None:
+                return None
+            keys.extend((key, None) for key in references[0] + references[1])
+
+        referenced: Set[Tuple[Optional[int], Optional[str]]] = set()
+        for key, self_index in keys:
+            try:
+                parts = parse_key(key)
+            except ValueError:
+                return None
+            name, kind, iok = parts[0]
+            field = parts[1][0] if len(parts) > 1 else None
+            if name == 'self' and self_index is not None:
+                referenced.add((self_index, field))
+            elif name == 'requests':
+                referenced.add((iok if kind == INDEX else None, field))  # type: ignore  # int if INDEX
+            elif name == 'requests_by_name':
+                referenced.add((self.request_graph.names.get(iok) if kind == KEY else None, field))  # type: ignore
+        return referenced
+
+    def _operation(self, factory: Callable[[Dict], Any], definition: Dict) -> Any:
+        operation = self._operations.get(id(definition))
+        if operation is not None and operation[0] is definition:
+            return operation[1]
+        return factory(definition)
 
     def _include(self, incl):
         if not isinstance(incl, dict):
             raise InternalError("Include definition should be a dict")
         if not self.includes or 'file' not in incl:
             raise InternalError("Include definition does not include a 'file'")
-        incl['include'] = deepcopy(self.includes[incl['file']])
+        incl['include'] = self.includes[incl['file']]
+
+    def _fold_templates(self, gateway_definition: Dict[str, Any]) -> None:
+        """
+        Evaluate the parts of the templates of the requests and the response that do not depend on the request.
+
+        References to the arguments of includes are substituted with the arguments, and the includes left without
+        references to their arguments are merged into their requests. References to constants and the environment are
+        substituted with their values. References to them with a dynamic key, e.g.
+        `${constants.environments[route.json.environment].mop}`, are indexed by the values of the dynamic key (see
+        `template.index_static`). Data written to by the operations of the gateway is not substituted.
+        """
+        written = self._written_roots(gateway_definition)
+        if written is None:
+            return
+
+        if 'arguments' not in written:
+            for req in gateway_definition.get('requests') or []:
+                self._fold_includes(req)
+
+        static = {root: data for root, data in (('constants', self.constants), ('environment', ENVIRONMENT))
+                  if root not in written}
+
+        def resolve(key: str, parts: Optional[Tuple[KeyPart, ...]]) -> Optional[str]:
+            value = resolve_static(static, parts) if parts is not None else None
+            # A value containing '$' could form a new template with the surrounding text, so it is left for rendering
+            return value if value is None or '$' not in value else None
+
+        for name in ('requests', 'response'):
+            if name in gateway_definition:
+                gateway_definition[name] = fold_templates(gateway_definition[name], resolve)
+                for key in find_template_keys(gateway_definition[name]):
+                    try:
+                        parts = parse_key(key)
+                    except ValueError:
+                        continue
+                    if parts[0][0] in static and parts not in self.dynamic_indexes:
+                        index = index_static(static, parts)
+                        if index is not None:
+                            self.dynamic_indexes[parts] = index
+
+    @staticmethod
+    def _fold_includes(req: Dict[str, Any]) -> None:
+        includes = req.get('includes')
+        if not isinstance(includes, list):
+            return
+        for i, incl in enumerate(includes):
+            # Includes are applied only when they have arguments, see GatewayRequestEnvironment
+            if 'arguments' not in incl or 'include' not in incl:
+                continue
+            arguments = {'arguments': incl['arguments']}
+
+            def resolve(key: str, parts: Optional[Tuple[KeyPart, ...]]) -> Optional[str]:
+                # Substituted as the source of the template, as the include is evaluated again with its request
+                return resolve_static(arguments, parts) if parts is not None else None
+
+            include = fold_templates(incl['include'], resolve)
+            if not isinstance(include, dict) or any(key not in _MERGED_FIELDS for key in include) or \
+                    any(split_key(key)[0].split('[')[0] == 'arguments' for key in find_template_keys(include)):
+                # Left to be evaluated for every request. Merging the later includes would make them be applied before
+                # this one.
+                return
+            req.update(include)
+            includes[i] = {key: value for key, value in incl.items() if key != 'include'}
+
+    @staticmethod
+    def _written_roots(gateway_definition: Dict[str, Any]) -> Optional[Set[str]]:
+        """
+        Get the roots (e.g. 'constants') of the GRE keys written to by the operations of a gateway definition.
+
+        :return: The roots, or None if an operation does not tell which keys it writes to.
+        """
+        operations: List[Tuple[Callable[[Dict], Any], Dict]] = []
+        for req in gateway_definition.get('requests') or []:
+            for source in [req] + [incl['include'] for incl in req.get('includes') or [] if 'include' in incl]:
+                operations.extend((get_builder, definition) for definition in source.get('builders') or [])
+                operations.extend((get_processor, definition) for definition in source.get('processors') or [])
+        response = gateway_definition.get('response') or {}
+        operations.extend((get_generator, definition) for definition in response.get('generators') or [])
+
+        roots: Set[str] = set()
+        for factory, definition in operations:
+            get_references = getattr(factory(definition), 'get_references', None)
+            references = get_references() if get_references else None
+            if references is None:
+                return None
+            roots.update(split_key(key)[0].split('[')[0] for key in references[1])
+        return roots
 
     def get_routes(self):
+        if self.route_response is not None:
+            return [
+                {
+                    'path': self.route_definition.path,
+                    'method': self.route_definition.method,
+                    'apply': [ServiceExceptionHandlerPlugin()],
+                    'callback': self.route_response.respond
+                }
+            ]
+
         plugins = self.__get_plugins()
         plugins.insert(0, ServiceExceptionHandlerPlugin())
-        plugins.insert(0, GatewayRequestEnvironmentPlugin(self.constants, self.route_definition, self.after_hooks))
+        plugins.insert(0, GatewayRequestEnvironmentPlugin(self.constants, self.route_definition, self.after_hooks,
+                                                          self.dynamic_indexes))
 
         # TODO: Plugin might want to add another route (at least cors)
 
@@ -87,6 +371,149 @@ class GatewayController(object):
             }
         ]
 
+    def _run_requests(self, gre: GatewayRequestEnvironment) -> None:
+        """
+        Run the requests of the gateway.
+
+        Requests that do not depend on each other (see RequestGraph) are sent concurrently. Evaluating the requests,
+        running builders and processors is always done in this thread, in definition order for the requests that are
+        ready at the same time.
+        """
+        if self.request_graph.is_sequential or settings.UPSTREAM_MAX_PARALLEL_REQUESTS <= 1:
+            for i, req_def in enumerate(self.request_definitions):
+                agw_req = self._prepare_request(gre, i, req_def)
+                agw_req.response = self._send_request(agw_req, gre)
+                self._process_response(gre, i, agw_req)
+            return
+
+        done: Set[int] = set()
+        started: Set[int] = set()
+        pending: Dict[Future, Tuple[int, AGWRequest]] = {}
+        try:
+            while len(done) < len(self.request_definitions):
+                ready = self.request_graph.ready(done, started)
+                started.update(ready)
+                if len(ready) == 1 and not pending:
+                    # Nothing to run concurrently with
+                    i = ready[0]
+                    agw_req = self._prepare_request(gre, i, self.request_definitions[i])
+                    agw_req.response = self._send_request(agw_req, gre)
+                    self._process_response(gre, i, agw_req)
+                    done.add(i)
+                    continue
+
+                for i in ready:
+                    agw_req = self._prepare_request(gre, i, self.request_definitions[i])
+                    future = upstream_pool.get_executor().submit(
+                        run_in_request_context, bottle.request.environ, self._send_request, agw_req, gre)
+                    pending[future] = (i, agw_req)
+
+                finished, _ = wait(pending, timeout=gre.deadline.remaining(), return_when=FIRST_COMPLETED)
+                if not finished:
+                    raise GatewayTimeoutError('Gateway timeout', log=f'Route deadline of {gre.deadline.seconds}s '
+                                                                     f'expired while waiting for upstream requests')
+                for future in sorted(finished, key=lambda f: pending[f][0]):
+                    i, agw_req = pending.pop(future)
+                    agw_req.response = future.result()
+                    self._process_response(gre, i, agw_req)
+                    done.add(i)
+        except BaseException:
+            # Requests that have not started are not sent. The running ones are not waited for, they stop at the
+            # deadline of the route at the latest, as the timeout of each try is limited by it.
+            for future in pending:
+                future.cancel()
+            raise
+
+    def _prepare_request(self, gre: GatewayRequestEnvironment, i: int, req_def: AGWRequestDefinition) -> AGWRequest:
+        gre.deadline.check()
+        agw_req = AGWRequest(req_def)
+        body_template = self._body_templates.get(i)
+        if body_template is not None:
+            # Rendered from the template below
+            setattr(agw_req, body_template[0], None)
+        gre.evaluate_and_add_request(agw_req, i, self._memoized_keys[i])
+        if body_template is not None:
+            agw_req.body = gre.render_body(body_template[1])
+            agw_req.body_content_type = body_template[1].CONTENT_TYPE
+
+        # Run builders
+        if agw_req.builders:
+            for builder_definition in agw_req.builders:
+                self._operation(get_builder, builder_definition).run(gre, self_key=f"requests[{i}]")
+
+        ll.debug(f"Requesting with: {agw_req}")
+        return agw_req
+
+    @staticmethod
+    def _send_request(agw_req: AGWRequest, gre: GatewayRequestEnvironment) -> AGWRequestResponse:
+        cache_key = response_cache.get_cache_key(agw_req)
+        if cache_key is not None:
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                ll.debug(f"Using cached response for {agw_req.url}")
+                return cached
+
+        flight_key = get_flight_key(agw_req)
+        if flight_key is None:
+            return GatewayController._request_upstream(agw_req, gre.deadline, cache_key)
+
+        sent = gre.upstream_responses.get(flight_key)
+        if sent is not None:
+            ll.debug(f"Using the response of an identical request already sent to {agw_req.url}")
+            return sent.copy()
+        agw_resp = upstream_flights.do(
+            flight_key, gre.deadline, GatewayController._request_upstream, agw_req, gre.deadline, cache_key)
+        gre.upstream_responses[flight_key] = agw_resp.copy()
+        return agw_resp
+
+    @staticmethod
+    def _request_upstream(agw_req: AGWRequest, deadline: Deadline,
+                          cache_key: Optional[response_cache.CacheKey]) -> AGWRequestResponse:
+        try:
+            agw_resp = upstream_policy.send(agw_req, deadline, GatewayController._send_once)
+        except requests.Timeout as e:
+            raise GatewayTimeoutError('Gateway timeout', log=f'Upstream request to {agw_req.url} timed out: {e}')
+
+        if cache_key is not None:
+            response_cache.put(cache_key, agw_req, agw_resp)
+        return agw_resp
+
+    @staticmethod
+    def _send_once(agw_req: AGWRequest, deadline: Deadline) -> AGWRequestResponse:
+        session = upstream_pool.get_session(agw_req.url, agw_req.pool)
+        headers, data, content_type = agw_req.headers, agw_req.data if agw_req.data else None, None
+        if agw_req.body is not None:
+            data, content_type = agw_req.body, agw_req.body_content_type
+        elif not data and agw_req.json:
+            # Encoded with the JSON codec instead of by requests
+            data, content_type = json_codec.dumps(agw_req.json), 'application/json'
+        if content_type and (not headers or not any(key.lower() == 'content-type' for key in headers)):
+            # As requests sets the content type of the bodies it encodes
+            headers = {**(headers or {}), 'Content-Type': content_type}
+        req = circuit_breakers.call(
+            agw_req.url,
+            session.request,
+            agw_req.method,
+            agw_req.url,
+            headers=headers,
+            data=data,
+            timeout=deadline.timeout(agw_req.connect_timeout, agw_req.read_timeout)
+        )
+        return AGWRequestResponse(
+            status=req.status_code,
+            headers=req.headers,
+            content=req.content,
+            encoding=req.encoding
+        )
+
+    def _process_response(self, gre: GatewayRequestEnvironment, i: int, agw_req: AGWRequest) -> None:
+        ll.verbose(f"Got response: {agw_req.response}")
+
+        # Run processors
+        if agw_req.processors:
+            for processor_definition in agw_req.processors:
+                self._operation(get_processor, processor_definition).run(gre, self_key=f"requests[{i}]")
+
     def __get_plugins(self) -> List:
         plugins = []
         if self.route_definition.plugins:
@@ -96,63 +523,22 @@ class GatewayController(object):
 
     @timed
     def __handle_route(self, gre: GatewayRequestEnvironment, **kwargs):
-        for i, req_def in enumerate(self.request_definitions):
-            agw_req = AGWRequest(req_def)
-            gre.evaluate_and_add_request(agw_req)
-
-            # Run builders
-            if agw_req.builders:
-                for builder_definition in agw_req.builders:
-                    get_builder(builder_definition).run(gre, self_key=f"requests[{i}]")
-
-            ll.debug(f"Requesting with: {agw_req}")
-
-            req = requests.request(
-                agw_req.method,
-                agw_req.url,
-                headers=agw_req.headers,
-                data=agw_req.data if agw_req.data else None,
-                json=agw_req.json if agw_req.json else None
-            )
-
-            agw_req.response = AGWRequestResponse(
-                status=req.status_code,
-                headers=deepcopy(req.headers),
-                text=req.text,
-                data=parse_qs(req.text) if "application/x-www-form-urlencoded" in req.headers['Content-Type'] else None,
-                json=req.json() if "application/json" in req.headers['Content-Type'] else None
-            )
-
-            ll.verbose(f"Got response: {agw_req.response}")
-
-            # Run processors
-            if agw_req.processors:
-                for processor_definition in agw_req.processors:
-                    get_processor(processor_definition).run(gre, self_key=f"requests[{i}]")
+        self._run_requests(gre)
 
         agw_resp = AGWResponse(self.response_definition)
-        gre.evaluate_and_add_response(agw_resp)
+        if self.json_template is not None:
+            # Rendered from the template below
+            agw_resp.json = None
+        gre.evaluate_and_add_response(agw_resp, self._response_memoized_keys)
 
         # Run generators
         if agw_resp.generators:
             for generator_definition in agw_resp.generators:
-                get_generator(generator_definition).run(gre, self_key=f"response")
-
-        response.status = agw_resp.status
-        response.headers.update(agw_resp.headers)
-
-        if 'Content-Length' in response.headers:
-            del response.headers['Content-Length']
-
-        if agw_resp.json:
-            ll.verbose(f'returning json: {agw_resp.json}')
-            return agw_resp.json
-        elif agw_resp.data:
-            ret = urlencode(agw_resp.data)
-            ll.verbose(f'returning data: {ret}')
-            return ret
-        elif agw_resp.text:
-            ll.verbose(f'returning text: {agw_resp.text}')
-            return agw_resp.text
-
-        raise InternalError(f"Response does not contain json, data or text.")
+                self._operation(get_generator, generator_definition).run(gre, self_key=f"response")
+
+        set_status_and_headers(agw_resp.status, agw_resp.headers)
+        if self.json_template is not None:
+            # As bottle's JSON plugin would return the json
+            response.content_type = 'application/json'
+            return gre.render_body(self.json_template)
+        return get_body(agw_resp.json, agw_resp.data, agw_resp.text)
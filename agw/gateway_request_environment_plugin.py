@@ -1,21 +1,28 @@
 import numbers
-from typing import Optional, List, Any, Tuple, Dict, Union
-import re
-from copy import deepcopy
+from collections.abc import Mapping, MutableMapping
+from typing import Optional, List, Any, Tuple, Dict, Union, Hashable, Callable, FrozenSet
 from os import environ
 
 from bottle import request
-from requests.models import CaseInsensitiveDict
 
+import settings
+from deadline import Deadline
+import json_codec
 from mds_logging import getLogger
 from agw_route import AGWRoute, AGWRouteDefinition
-from agw_request import AGWRequest
+from agw_request import AGWRequest, AGWRequestResponse
 from agw_response import AGWResponse
-from util import EnvironmentReferenceError
+from util import EnvironmentReferenceError, FrozenDict, FrozenList, freeze, thaw
+from body_template import BodyTemplate
+from template import split_key, parse_key, get_template, KeyPart, NO_INDEX, DYNAMIC_KEY
 from service_exception_handler_plugin import InternalError
 
 ll = getLogger("agw." + __name__)
 
+# Read-only snapshot of the environment variables, taken once when the gateways are loaded (before the workers are
+# forked) and shared by all requests as `environment`
+ENVIRONMENT = freeze(dict(environ))
+
 
 class GatewayRequestEnvironment:
     def __init__(
@@ -24,8 +31,10 @@ class GatewayRequestEnvironment:
         route: AGWRoute,
         requests: Optional[List[AGWRequest]] = None,
         response: Optional[AGWResponse] = None,
-        after_hooks: Optional[List[Dict]] = None,
-        error: Optional[str] = None
+        after_hooks: Optional[List[Any]] = None,
+        error: Optional[str] = None,
+        deadline: Optional[Deadline] = None,
+        dynamic_indexes: Optional[Dict[Tuple[KeyPart, ...], Tuple[str, Dict[Any, str]]]] = None
     ) -> None:
         self.constants = constants
         self.route = route
@@ -33,51 +42,68 @@ class GatewayRequestEnvironment:
         self.response = response
         self.after_hooks = after_hooks
         self.error = error
-        self.environment = deepcopy(dict(environ))
+        self.deadline = deadline if deadline else Deadline()
+        # Values of templates with a dynamic key into the constants, by the value of the dynamic key (see
+        # `template.index_static`)
+        self.dynamic_indexes = dynamic_indexes
+        self.environment = ENVIRONMENT
 
         self.requests_by_name: Dict[str, AGWRequest] = {}
+        # Rendered values of the keys referenced more than once by the templates of the node evaluated in a single pass
+        # (known when the gateway is loaded, see `template.repeated_keys`), in which nothing is written to GRE. Not kept
+        # between the passes, as builders, processors etc. may change the values in between.
+        self._memoized_keys: FrozenSet[str] = frozenset()
+        self._rendered: Optional[Dict[str, str]] = None
+        # Responses of single-flight requests already sent while handling this route
+        self.upstream_responses: Dict[Hashable, AGWRequestResponse] = {}
+
+    def evaluate_and_add_request(self, agw_request: AGWRequest, index: Optional[int] = None,
+                                 memoized_keys: FrozenSet[str] = frozenset()):
+        """
+        Evaluate the variables of given request and add it to GRE.
 
-    def evaluate_and_add_request(self, agw_request: AGWRequest):
+        :param agw_request: The request to add.
+        :param index: Index of the request in the gateway definition. Requests run concurrently may be added out of
+            order, the indices of requests not yet added are filled with None. If not given, the request is appended.
+        :param memoized_keys: Keys referenced more than once by the templates of the request, whose values are looked
+            up once per evaluation pass.
+        :return: None
+        """
 
         # Handle includes
         if agw_request.includes:
+            includes = []
             for incl in agw_request.includes:
                 self.arguments = {}
                 if 'arguments' in incl:
                     self.arguments = incl['arguments']
-                    self._evaluate_variables(incl['include'])
-                    for key, val in incl['include'].items():
-                        setattr(agw_request, key, val)
-                    del incl['include']
-
-        self._evaluate_variables(agw_request)
-        self.requests.append(agw_request)
+                    # Includes without 'include' were merged into the request definition when it was loaded
+                    if 'include' in incl:
+                        for key, val in self._evaluate_memoized(incl['include'], memoized_keys).items():
+                            setattr(agw_request, key, val)
+                        incl = {key: val for key, val in incl.items() if key != 'include'}
+                includes.append(incl)
+            agw_request.includes = includes
+
+        self._evaluate_variables(agw_request, memoized_keys)
+        if index is None:
+            self.requests.append(agw_request)
+        else:
+            if index >= len(self.requests):
+                self.requests.extend([None] * (index + 1 - len(self.requests)))  # type: ignore
+            self.requests[index] = agw_request
         if agw_request.name:
             self.requests_by_name[agw_request.name] = agw_request
 
-    def evaluate_and_add_response(self, agw_response: AGWResponse):
-        self._evaluate_variables(agw_response)
+    def evaluate_and_add_response(self, agw_response: AGWResponse, memoized_keys: FrozenSet[str] = frozenset()):
+        self._evaluate_variables(agw_response, memoized_keys)
         self.response = agw_response
 
     @staticmethod
     def _split_gre_key(key: str):
-        parts = []
-        pos = 0
-        open_sq_brackets = 0
-        for i, c in enumerate(key):
-            if c == '.' and open_sq_brackets == 0:
-                parts.append(key[pos:i])
-                pos = i + 1
-            elif c == '[':
-                open_sq_brackets += 1
-            elif c == ']':
-                open_sq_brackets -= 1
-                if open_sq_brackets < 0:
-                    raise ValueError(f"Syntax error {key}")
-        parts.append(key[pos:])
-        return parts
-
-    def _get_node(self, key: str, create_path: bool = False) -> Tuple[Any, Any]:
+        return split_key(key)
+
+    def _get_node(self, key: str, create_path: bool = False, for_write: bool = False) -> Tuple[Any, Any]:
         """
         Extract a reference to the innermost node and its index or key from given GRE key.
 
@@ -85,86 +111,97 @@ class GatewayRequestEnvironment:
 
         :param key: The full key pointing to a value in GRE.
         :param create_path: If True, missing paths in given key will be created instead of raising a KeyError.
+        :param for_write: If True, the returned node is mutable.
         :return: A tuple where the first item is the node, and the second is its key or index where the value pointed
             by the given key can be found.
         :raises KeyError: If given key is not found in GRE.
         :raises IndexError: If a list index in given key was out of range.
         :raises ValueError: If the given key is not properly formed.
         """
+        return self._get_parsed_node(parse_key(key), key, create_path, for_write)
 
-        parts = self._split_gre_key(key)
+    def _get_parsed_node(self, parts: Tuple[KeyPart, ...], key: str, create_path: bool = False,
+                         for_write: bool = False) -> Tuple[Any, Any]:
+        """
+        Like `_get_node`, but for a key already parsed with `template.parse_key`.
 
+        If `for_write` is True, the frozen definition nodes on the path are replaced with mutable copies (see
+        `util.thaw`), so that the returned node can be modified without modifying the definition shared by all
+        requests.
+        """
         gre_node: Any = self
-        for part_index, part in enumerate(parts):
-            is_last_part = part_index == len(parts) - 1
-            index_or_key: Optional[Union[str, int]] = None
-            p = part
-            if p[-1] == ']':
-                subparts = p.split('[')
-                if len(subparts) != 2:
-                    raise ValueError(f"Env array notation failed for {part} (from: {key})")
-                p = subparts[0]
-                iok = subparts[1][0:-1]
-                if iok.isdigit():
-                    index_or_key = int(iok)
-                elif iok[0] in ('"', "'"):
-                    if iok[-1] not in ('"', "'"):
-                        raise ValueError(f"Env dict notation failed for {part} (from: {key})")
-                    index_or_key = iok[1:-1]
-                else:
-                    index_or_key = self.get(iok)
+        last_part_index = len(parts) - 1
+        for part_index, (p, kind, iok) in enumerate(parts):
+            is_last_part = part_index == last_part_index
+            index_or_key: Optional[Union[str, int]] = iok if kind != DYNAMIC_KEY else self.get(iok)  # type: ignore
 
-            if isinstance(gre_node, dict) or isinstance(gre_node, CaseInsensitiveDict):
+            # Checking for dict first, as it is much faster than checking for the Mapping ABC
+            if isinstance(gre_node, dict) or isinstance(gre_node, Mapping):
                 # Current node is a dict
                 if p not in gre_node:
                     # Next key is not present in current node
                     if create_path:
                         # If create_path is True and next key is not the last one, create the next key
                         if not is_last_part:
-                            gre_node[p] = {}
+                            _writable(gre_node)[p] = {}
                         elif is_last_part and index_or_key is not None:
-                            raise KeyError(f"Env does not contain '{part}' (from: {key}) (1)")
+                            raise KeyError(f"Env does not contain '{_part(p, kind, iok)}' (from: {key}) (1)")
                     else:
-                        raise KeyError(f"Env does not contain '{part}' (from: {key}) (2)")
+                        raise KeyError(f"Env does not contain '{_part(p, kind, iok)}' (from: {key}) (2)")
 
                 # If this is the last key, return current node and the key (regardless if the key exists)
                 if is_last_part:
                     if index_or_key is not None:
-                        return gre_node[p], index_or_key
+                        return self._child(gre_node, p) if for_write else gre_node[p], index_or_key
                     return gre_node, p
-                gre_node = gre_node[p]
+                gre_node = self._child(gre_node, p) if for_write else gre_node[p]
 
             else:
                 # Current node is some object (like AGWRequest, AGWRequestResponse...)
                 if not hasattr(gre_node, p) and not is_last_part:
                     # We cannot create this types of objects dynamically, they should be present already so an error
                     # is raised always if not found.
-                    raise KeyError(f"Env does not contain '{part}' (from: {key}) (3)")
+                    raise KeyError(f"Env does not contain '{_part(p, kind, iok)}' (from: {key}) (3)")
 
                 if is_last_part:
                     return gre_node, p
-                gre_node = getattr(gre_node, p)
+                gre_node = self._attribute(gre_node, p) if for_write else getattr(gre_node, p)
 
             if index_or_key is not None:
                 if isinstance(index_or_key, int):
                     # Current node is a list (can be a list of AGWRequest)
                     if not isinstance(gre_node, list):
-                        raise KeyError(f"Env '{part}' is not a list (from: {key})")
+                        raise KeyError(f"Env '{_part(p, kind, iok)}' is not a list (from: {key})")
                     if is_last_part:
                         return gre_node, index_or_key
                     if len(gre_node) <= index_or_key:
-                        raise IndexError(f"Env '{part}' list index out of range (from: {key})")
-                    gre_node = gre_node[index_or_key]
+                        raise IndexError(f"Env '{_part(p, kind, iok)}' list index out of range (from: {key})")
+                    gre_node = self._child(gre_node, index_or_key) if for_write else gre_node[index_or_key]
                 else:
                     # Current node is a dict
-                    if not isinstance(gre_node, dict):
-                        raise KeyError(f"Env '{part}' is not a dict (from: {key})")
+                    if not isinstance(gre_node, dict) and not isinstance(gre_node, Mapping):
+                        raise KeyError(f"Env '{_part(p, kind, iok)}' is not a dict (from: {key})")
                     if index_or_key not in gre_node:
                         raise KeyError(f"Env '{p}' does not contain {index_or_key} (from: {key}) (4)")
-                    gre_node = gre_node[index_or_key]
+                    gre_node = self._child(gre_node, index_or_key) if for_write else gre_node[index_or_key]
 
         raise KeyError(f'Env {key} not found')
 
+    @staticmethod
+    def _child(node: Any, index_or_key: Union[str, int]) -> Any:
+        child = node[index_or_key]
+        if isinstance(child, (FrozenDict, FrozenList)):
+            child = node[index_or_key] = thaw(child)
+        return child
+
+    @staticmethod
+    def _attribute(node: Any, name: str) -> Any:
+        child = getattr(node, name)
+        if isinstance(child, (FrozenDict, FrozenList)):
+            child = thaw(child)
+            setattr(node, name, child)
+        return child
+
     def get(self, key: str) -> Any:
         """
         Get a value from GRE.
@@ -175,7 +212,7 @@ class GatewayRequestEnvironment:
         """
         try:
             node, node_key = self._get_node(key)
-            if isinstance(node, (list, dict, CaseInsensitiveDict)):
+            if isinstance(node, (list, dict, Mapping)):
                 return node[node_key]
             return getattr(node, node_key)
         except (ValueError, IndexError, KeyError, AttributeError) as e:
@@ -194,54 +231,158 @@ class GatewayRequestEnvironment:
         :raises EnvironmentReferenceError: If given key was not found in GRE or it was badly formed.
         """
         try:
-            node, node_key = self._get_node(key, create_path=True)
-            if isinstance(node, (dict, list, CaseInsensitiveDict)):
-                node[node_key] = value
+            node, node_key = self._get_node(key, create_path=True, for_write=True)
+            if isinstance(node, (list, Mapping)):
+                _writable(node)[node_key] = value
             else:
                 setattr(node, node_key, value)
-        except (ValueError, IndexError, KeyError) as e:
+        except (ValueError, IndexError, KeyError, TypeError) as e:
             raise EnvironmentReferenceError(e)
 
     def pop(self, key: str) -> Any:
         try:
-            node, node_key = self._get_node(key)
-            if isinstance(node, (dict, list, CaseInsensitiveDict)):
-                return node.pop(node_key)
+            node, node_key = self._get_node(key, for_write=True)
+            if isinstance(node, (list, Mapping)):
+                return _writable(node).pop(node_key)
             value = getattr(node, node_key)
             delattr(node, node_key)
             return value
-        except (ValueError, IndexError, KeyError) as e:
+        except (ValueError, IndexError, KeyError, TypeError, AttributeError) as e:
             raise EnvironmentReferenceError(e)
 
-    def _process_variable(self, node, index_or_key):
-        if not isinstance(node[index_or_key], str):
-            return
-        for m in re.finditer(r'\${([^}]+)}', node[index_or_key]):
-            # group 0: e.g. ${requests[0].response.json}
-            # group 1: e.g. requests[0].response.json
-            str_to_replace = m.group(0)
-            key = m.group(1)
-            try:
+    def _template_value(self, key: str, parts: Optional[Tuple[KeyPart, ...]]) -> str:
+        # Lookup of the passes memoizing repeated keys, the other passes use `_lookup_template_value` directly
+        rendered = self._rendered
+        if rendered is None or key not in self._memoized_keys:
+            return self._lookup_template_value(key, parts)
+        value = rendered.get(key)
+        if value is None:
+            value = rendered[key] = self._lookup_template_value(key, parts)
+        return value
+
+    def _lookup_template_value(self, key: str, parts: Optional[Tuple[KeyPart, ...]]) -> str:
+        if self.dynamic_indexes and parts is not None:
+            indexed = self._indexed_value(parts)
+            if indexed is not None:
+                return indexed
+        try:
+            if parts is None:
                 value = self.get(key)
-            except EnvironmentReferenceError as e:
-                raise InternalError(f'Gateway route reference error', log=f'Key not found in env: "{key}". Error: {e}')
-            if not isinstance(value, (str, numbers.Number)):
-                raise InternalError(f'Gateway route reference error',
-                                    log=f'Env {key} is not a Number or str, cannot replace.')
-            node[index_or_key] = node[index_or_key].replace(str_to_replace, str(value))
-
-    def _evaluate_variables(self, node):
-        if isinstance(node, AGWRequest) or isinstance(node, AGWResponse):
-            node = node.__dict__
-
-        if isinstance(node, dict):
-            for key in node.keys():
-                self._process_variable(node, key)
-                self._evaluate_variables(node[key])
-        elif isinstance(node, list):
-            for i in range(len(node)):
-                self._process_variable(node, i)
-                self._evaluate_variables(node[i])
+            else:
+                node, node_key = self._get_parsed_node(parts, key)
+                value = node[node_key] if isinstance(node, (list, dict, Mapping)) else getattr(node, node_key)
+        except (EnvironmentReferenceError, ValueError, IndexError, KeyError, AttributeError) as e:
+            raise InternalError(f'Gateway route reference error', log=f'Key not found in env: "{key}". Error: {e}')
+        if not isinstance(value, (str, numbers.Number)):
+            raise InternalError(f'Gateway route reference error',
+                                log=f'Env {key} is not a Number or str, cannot replace.')
+        return str(value)
+
+    def _indexed_value(self, parts: Tuple[KeyPart, ...]) -> Optional[str]:
+        index = self.dynamic_indexes.get(parts)  # type: ignore  # checked by the caller
+        if index is None:
+            return None
+        dynamic_key, values = index
+        try:
+            return values.get(self.get(dynamic_key))
+        except (EnvironmentReferenceError, TypeError):
+            # Not found or unhashable, reported by evaluating the key as usual
+            return None
+
+    def _memoize(self, keys: FrozenSet[str]) -> None:
+        # Starts an evaluation pass, memoizing the values of given keys if there are any
+        self._memoized_keys = keys
+        self._rendered = {} if keys else None
+
+    def _evaluate_variables(self, node: Union[AGWRequest, AGWResponse], memoized_keys: FrozenSet[str]) -> None:
+        self._memoize(memoized_keys)
+        try:
+            for key, value in node.__dict__.items():
+                evaluated = self._evaluate_value(value)
+                if evaluated is not value:
+                    setattr(node, key, evaluated)
+        finally:
+            self._rendered = None
+
+    def _evaluate_memoized(self, value: Any, memoized_keys: FrozenSet[str]) -> Any:
+        self._memoize(memoized_keys)
+        try:
+            return self._evaluate_value(value)
+        finally:
+            self._rendered = None
+
+    def render_body(self, body_template: BodyTemplate) -> bytes:
+        """
+        Render a request or response body compiled at load time, evaluating its templates like the other variables.
+
+        :param body_template: The compiled body.
+        :return: The encoded body.
+        """
+        if not body_template.repeated_keys:
+            return body_template.render(self._lookup_template_value)
+        self._memoize(body_template.repeated_keys)
+        try:
+            return body_template.render(self._template_value)
+        finally:
+            self._rendered = None
+
+    def _evaluate_value(self, value: Any) -> Any:
+        """
+        Evaluate the templates of given value.
+
+        Mutable dicts and lists are evaluated in place. Frozen definition nodes are copied on write: if templates are
+        found in a frozen node, a mutable copy of it with the evaluated values is returned, the nodes without templates
+        are kept shared. Frozen nodes known not to contain templates are not walked at all.
+
+        :param value: The value to evaluate.
+        :return: The evaluated value.
+        """
+        if isinstance(value, str):
+            template = get_template(value)
+            if template is None:
+                return value
+            return template.render(self._template_value if self._rendered is not None else self._lookup_template_value)
+        if isinstance(value, FrozenDict):
+            if not value.templated:
+                return value
+            dict_copy: Optional[dict] = None
+            for key, item in value.items():
+                evaluated = self._evaluate_value(item)
+                if evaluated is not item:
+                    if dict_copy is None:
+                        dict_copy = dict(value)
+                    dict_copy[key] = evaluated
+            return value if dict_copy is None else dict_copy
+        if isinstance(value, FrozenList):
+            if not value.templated:
+                return value
+            list_copy: Optional[list] = None
+            for i, item in enumerate(value):
+                evaluated = self._evaluate_value(item)
+                if evaluated is not item:
+                    if list_copy is None:
+                        list_copy = list(value)
+                    list_copy[i] = evaluated
+            return value if list_copy is None else list_copy
+        if isinstance(value, dict):
+            for key in value.keys():
+                value[key] = self._evaluate_value(value[key])
+        elif isinstance(value, list):
+            for i in range(len(value)):
+                value[i] = self._evaluate_value(value[i])
+        return value
+
+
+def _writable(node: Union[list, Mapping]) -> Union[list, MutableMapping]:
+    # Nodes got for writing are mutable copies of the definition, except read-only views such as response headers
+    if not isinstance(node, (list, MutableMapping)):
+        raise TypeError(f"'{type(node).__name__}' object is read-only")
+    return node
+
+
+def _part(p: str, kind: int, iok: Union[None, int, str]) -> str:
+    # The part of a key as written in it, for error messages
+    return p if kind == NO_INDEX else f'{p}[{iok}]'
 
 
 def multiDict_to_dict(multidict):
@@ -257,25 +398,50 @@ def multiDict_to_dict(multidict):
     return ret
 
 
+def read_json() -> Any:
+    """
+    Decode the JSON body of the current request with the JSON codec, like bottle's `request.json`.
+
+    :return: The decoded body, or None if the content type is not JSON or the body is empty.
+    """
+    if request.content_type.lower().split(';')[0] != 'application/json':
+        return None
+    body = request.body.read()
+    value = json_codec.loads(body) if body else None
+    return value if value else None
+
+
+# Readers of the request data of a route, by the name of the AGWRoute attribute they are stored in. Given the dynamic
+# parts of the route path.
+ROUTE_DATA: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+    'headers': lambda dynamic: dict(request.headers),
+    'dynamic': lambda dynamic: dynamic,
+    'query': lambda dynamic: multiDict_to_dict(request.query),
+    'text': lambda dynamic: request.body.getvalue().decode('utf-8'),
+    'json': lambda dynamic: read_json(),
+    'data': lambda dynamic: multiDict_to_dict(request.forms),
+}
+
+
 class GatewayRequestEnvironmentPlugin:
-    def __init__(self, constants: dict, route_definition: AGWRouteDefinition, after_hooks: Dict):
+    def __init__(self, constants: dict, route_definition: AGWRouteDefinition, after_hooks: Optional[List[Any]],
+                 dynamic_indexes: Optional[Dict[Tuple[KeyPart, ...], Tuple[str, Dict[Any, str]]]] = None):
         self.constants = constants
         self.route_definition = route_definition
         self.after_hooks = after_hooks
+        self.dynamic_indexes = dynamic_indexes
 
     def apply(self, callback, route):
         def wrapper(**kwargs):
             agw_route = AGWRoute(self.route_definition)
-            agw_route.headers = dict(request.headers)
-            agw_route.dynamic = kwargs
-            agw_route.query = multiDict_to_dict(request.query)
-            agw_route.text = request.body.getvalue().decode('utf-8')
-            agw_route.json = request.json if request.json else None
-            agw_route.data = multiDict_to_dict(request.forms)
+            for name, read in ROUTE_DATA.items():
+                setattr(agw_route, name, read(kwargs))
             gre = GatewayRequestEnvironment(
                 self.constants,
                 agw_route,
-                after_hooks=deepcopy(self.after_hooks)  # type: ignore
+                after_hooks=self.after_hooks,
+                dynamic_indexes=self.dynamic_indexes,
+                deadline=Deadline(self.route_definition.deadline or settings.ROUTE_DEADLINE)
             )
 
             ll.verbose(f'headers: {agw_route.headers}')
@@ -3,6 +3,7 @@ import os
 
 bind = '0.0.0.0:8171'
 workers = os.environ['GUNICORN_WORKERS'] if 'GUNICORN_WORKERS' in os.environ else 5
+threads = os.environ['GUNICORN_THREADS'] if 'GUNICORN_THREADS' in os.environ else 1
 preload_app = True
 
 
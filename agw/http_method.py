@@ -5,3 +5,7 @@ class HttpMethod(str, Enum):
     GET = "GET"
     POST = "POST"
     PUT = "PUT"
+
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+READ_METHODS = ('GET', 'HEAD')
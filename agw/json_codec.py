@@ -0,0 +1,52 @@
+import json
+from typing import Any, Union
+
+import settings
+
+try:
+    import orjson
+except ImportError:
+    # Optional, the standard library is used if not installed
+    orjson = None  # type: ignore[assignment]
+
+# Codecs that AGW_JSON_CODEC may select for encoding the request, upstream and response bodies. 'auto' uses orjson if it
+# is installed. The output of orjson is more compact (no whitespace, non-ASCII characters not escaped) and has NaN and
+# Infinity as null. The bodies are always decoded with the standard library, as orjson decodes integers over 64 bits
+# into floats, losing precision.
+CODECS = ('auto', 'orjson', 'json')
+
+
+def _json_dumps(value: Any) -> bytes:
+    return json.dumps(value).encode('utf-8')
+
+
+def _json_loads(data: Union[str, bytes]) -> Any:
+    return json.loads(data)
+
+
+def _orjson_dumps(value: Any) -> bytes:
+    try:
+        return orjson.dumps(value)
+    except TypeError:
+        # Values orjson does not support, e.g. integers over 64 bits or keys that are not strings
+        return _json_dumps(value)
+
+
+if settings.JSON_CODEC not in CODECS:
+    raise ValueError(f"AGW_JSON_CODEC should be one of {', '.join(CODECS)}, not '{settings.JSON_CODEC}'")
+if settings.JSON_CODEC == 'orjson' and orjson is None:
+    raise ImportError("AGW_JSON_CODEC is 'orjson' but orjson is not installed")
+
+if settings.JSON_CODEC != 'json' and orjson is not None:
+    NAME = 'orjson'
+    dumps = _orjson_dumps
+    loads = _json_loads
+    # Separators of the items and the keys and values of objects in the output of dumps
+    ITEM_SEPARATOR = b','
+    KEY_SEPARATOR = b':'
+else:
+    NAME = 'json'
+    dumps = _json_dumps
+    loads = _json_loads
+    ITEM_SEPARATOR = b', '
+    KEY_SEPARATOR = b': '
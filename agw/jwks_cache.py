@@ -0,0 +1,152 @@
+import os
+import time
+from threading import Event, Lock, Thread
+from typing import Any, Dict, Optional
+
+import requests
+from jwcrypto import jwk  # type: ignore
+
+from deadline import default_timeout
+from mds_logging import getLogger, timed
+from service_exception_handler_plugin import InternalError
+from shared_cache import Cache
+from stats import register_stats
+from upstream_pool import upstream_pool
+
+ll = getLogger("agw." + __name__)
+
+
+class JWKSCache:
+    """
+    Public signing keys of a JWKS endpoint by key id (kid).
+
+    The keys are refetched in a background thread every `refresh_interval` seconds, and when a key id that is not known
+    is requested, at most once every `min_refetch_interval` seconds, so that rotated keys are picked up without a
+    restart and tickets with unknown key ids cannot be used to flood the JWKS endpoint. If a refetch fails, the keys
+    fetched earlier are kept.
+
+    The keys can be fetched before the workers are forked with `warm`, so that the workers inherit them. The refresh
+    thread is started in each worker when a key is first requested, as threads do not survive a fork. With a cache
+    shared by the workers, a JWKS fetched by one worker is used by the others for `min_refetch_interval` seconds
+    instead of fetching it again.
+    """
+
+    def __init__(self, name: str, url: str, refresh_interval: float, min_refetch_interval: float,
+                 shared: Optional[Cache] = None) -> None:
+        """
+        :param name: Name of the cache, used for registering its stats.
+        :param url: URL of the JWKS endpoint.
+        :param refresh_interval: Seconds between background refreshes, 0 disables them.
+        :param min_refetch_interval: Minimum seconds between fetches triggered by unknown key ids.
+        :param shared: Optional cache shared with other workers.
+        """
+        self.url = url
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        self.shared = shared
+        self._lock = Lock()
+        self._keys: Dict[str, jwk.JWK] = {}
+        self._fetched_at: Optional[float] = None
+        self._refresher_pid: Optional[int] = None
+        self._stopped = Event()
+        self.fetches = 0
+        self.failures = 0
+        self.unknown_kids = 0
+        register_stats(name, self.stats)
+
+    def warm(self) -> None:
+        """
+        Fetch the keys, logging instead of raising if the fetch fails (the keys are then fetched on first use).
+        """
+        try:
+            self.refresh()
+        except InternalError as e:
+            ll.warning(f'Could not fetch JWKS from {self.url}, fetching it on first use: {e}')
+
+    def get_key(self, kid: str) -> Optional[jwk.JWK]:
+        """
+        Get a signing key.
+
+        :param kid: Key id.
+        :return: The key or None if the JWKS does not contain a signing key with the id.
+        :raises InternalError: If the JWKS has to be fetched and the fetch fails.
+        """
+        self._start_refresher()
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+        with self._lock:
+            key = self._keys.get(kid)
+            if key is not None:
+                # Fetched by another thread while waiting for the lock
+                return key
+            if self._fetched_at is not None and time.monotonic() - self._fetched_at < self.min_refetch_interval:
+                self.unknown_kids += 1
+                return None
+            self._fetch()
+        key = self._keys.get(kid)
+        if key is None:
+            self.unknown_kids += 1
+        return key
+
+    def refresh(self) -> None:
+        """
+        Fetch the keys.
+
+        :raises InternalError: If the fetch fails.
+        """
+        with self._lock:
+            self._fetch()
+
+    @timed
+    def _fetch(self) -> None:
+        # Called with the lock held. The fetch time is updated on failures too to rate limit the retries.
+        self._fetched_at = time.monotonic()
+        jwks = self.shared.get(self.url) if self.shared is not None else None
+        if jwks is not None:
+            # Fetched by another worker
+            jwkset = jwk.JWKSet.from_json(jwks)
+        else:
+            self.fetches += 1
+            try:
+                jwks_response = upstream_pool.get_session(self.url).get(self.url, timeout=default_timeout())
+                jwks_response.raise_for_status()
+                jwkset = jwk.JWKSet.from_json(jwks_response.text)
+            except (requests.RequestException, jwk.InvalidJWKValue, ValueError) as e:
+                self.failures += 1
+                raise InternalError(f'Cannot get JWKS: {e}')
+            if self.shared is not None:
+                self.shared.put(self.url, jwks_response.text, self.min_refetch_interval, len(jwks_response.text))
+        keys = {}
+        for key in jwkset['keys']:
+            if key.get('kid') and key.get('use', 'sig') == 'sig':
+                keys[key['kid']] = jwk.JWK(**key.export_public(as_dict=True))
+        ll.debug(f"Fetched JWKS with key ids: {', '.join(keys)}")
+        self._keys = keys
+
+    def _start_refresher(self) -> None:
+        if not self.refresh_interval or self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+            Thread(target=self._refresh_periodically, name='agw-jwks-refresh', daemon=True).start()
+
+    def _refresh_periodically(self) -> None:
+        while not self._stopped.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except InternalError as e:
+                ll.warning(f'JWKS refresh failed, keeping the keys fetched earlier: {e}')
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'keys': len(self._keys),
+            'fetches': self.fetches,
+            'failures': self.failures,
+            'unknown_kids': self.unknown_kids,
+        }
@@ -1,5 +1,4 @@
-from copy import deepcopy
-from typing import Dict, Any, List, Optional, Union
+from typing import Dict, Any, List, Optional, Union, Tuple
 
 from plugins import InternalError
 from util import EnvironmentReferenceError
@@ -10,7 +9,8 @@ ll = getLogger("agw." + __name__)
 
 class Operation:
     def __init__(self, definition: Dict[str, Any], required_keys: Optional[List[str]] = None) -> None:
-        self.definition = deepcopy(definition)
+        # Shallow copy, as operations only remove their own keys (e.g. 'builder') from the frozen definition
+        self.definition = dict(definition)
         self.required_keys = required_keys
         self.validate_definition()
 
@@ -24,6 +24,22 @@ class Operation:
                 return False
         return True
 
+    def _if_references(self) -> List[str]:
+        if 'if' in self.definition:
+            return [self.definition['if']]
+        return []
+
+    def get_references(self) -> Optional[Tuple[List[str], List[str]]]:
+        """
+        Get the GRE keys read and written by this operation.
+
+        Used for resolving the dependencies between requests. The keys are returned as defined, i.e. they may start
+        with 'self'.
+
+        :return: A tuple of the read keys and the written keys, or None if they are not known.
+        """
+        return None
+
     def _convert_self_key(self, key: Union[str, int], self_key: str) -> Union[str, int]:
         if not isinstance(key, str):
             return key
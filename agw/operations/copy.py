@@ -1,4 +1,4 @@
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
 
 from operations import Operation
 from mds_logging import getLogger
@@ -10,6 +10,9 @@ class CopyOperation(Operation):
     def __init__(self, definition: Dict[str, Any]) -> None:
         super().__init__(definition, ['to', 'from'])
 
+    def get_references(self) -> Tuple[List[str], List[str]]:
+        return [self.definition['from']] + self._if_references(), [self.definition['to']]
+
     def _run(self, environment, self_key: str) -> None:
         from_ = self._convert_self_key(self.definition['from'], self_key)
         to_ = self._convert_self_key(self.definition['to'], self_key)
@@ -1,4 +1,4 @@
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
 
 from operations import Operation
 from mds_logging import getLogger
@@ -10,6 +10,9 @@ class DeleteOperation(Operation):
     def __init__(self, definition: Dict[str, Any]) -> None:
         super().__init__(definition, ['key'])
 
+    def get_references(self) -> Tuple[List[str], List[str]]:
+        return self._if_references(), [self.definition['key']]
+
     def _run(self, environment, self_key: str) -> None:
         key = self._convert_self_key(self.definition['key'], self_key)
 
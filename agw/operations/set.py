@@ -1,3 +1,5 @@
+from typing import List, Tuple
+
 from operations import Operation
 from mds_logging import getLogger
 
@@ -5,6 +7,9 @@ ll = getLogger("agw." + __name__)
 
 
 class SetOperation(Operation):
+    def get_references(self) -> Tuple[List[str], List[str]]:
+        return self._if_references(), [key for key in self.definition.keys() if key != 'if']
+
     def _run(self, environment, self_key: str) -> None:
         if not self._check_if_statement(environment):
             ll.debug(f"Not setting as 'if' statement is false")
@@ -1,14 +1,26 @@
+import hashlib
+import time
 from typing import Optional, Dict, Any
 
 import json
 import bottle
 import requests
-from jwcrypto import jwk, jwt, jws  # type: ignore
+from jwcrypto import jwt, jws  # type: ignore
+from jwcrypto.common import base64url_decode, JWException  # type: ignore
 
+import settings
+from jwks_cache import JWKSCache
 from gateway_request_environment_plugin import GatewayRequestEnvironment
-from service_exception_handler_plugin import AuthorizationError, ForbiddenError, InternalError, BadRequestError
+import json_codec
+from circuit_breaker import circuit_breakers
+from service_exception_handler_plugin import AuthorizationError, ForbiddenError, InternalError, BadRequestError, \
+    GatewayTimeoutError, ServiceError
 from mds_logging import getLogger, timed
 from settings import get_required_setting
+from shared_cache import Cache, get_cache, CROSS_PROCESS
+from token_manager import TokenManager, get_mop_token_manager
+from upstream_pool import upstream_pool
+from util import freeze
 
 ll = getLogger("agw." + __name__)
 
@@ -88,83 +100,64 @@ def get_setting(key: str) -> str:
     return get_required_setting(f'MOP_REQUEST_TICKET_VALIDATION_{key}')
 
 
+class UnknownSigningKeyError(BadRequestError):
+    """Raised when the signing key of a request ticket is not in the JWKS (yet, if the JWKS has not been refetched)."""
+    pass
+
+
+# Rejections of request tickets that do not depend on the route, by error
+_REJECTIONS = {error.error: error for error in (BadRequestError, AuthorizationError)}
+
+
+def _digest(request_ticket: str) -> bytes:
+    # Cache key of a request ticket
+    return hashlib.sha256(request_ticket.encode('utf-8')).digest()
+
+
 class MopRequestTicketValidationPlugin:
-    _SESSION = requests.session()
-    _TOKEN_ENDPOINT: Optional[str] = None
-    _AGW_TOKEN: Optional[str] = None
-    _IDPROVIDER_OPENID_CONFIGURATION: Optional[str] = None
-    _IDPROVIDER_CLIENT_ID: Optional[str] = None
-    _IDPROVIDER_SECRET: Optional[str] = None
+    _TOKENS: Optional[TokenManager] = None
     _TICKET_INTROSPECTION_ENDPOINT: Optional[str] = None
     _JWKS_ENDPOINT: Optional[str] = None
     _KID: Optional[str] = None
     _EXP_LEEWAY_SECONDS = 60
     _ISS: Optional[str] = None
-    _PUBLIC_KEY: Optional[jwk.JWK] = None
+    _JWKS: Optional[JWKSCache] = None
+    # Claims of request tickets with verified signatures by hashes of the request tickets
+    _VERIFIED_TICKETS: Optional[Cache] = None
+    # Route extras generated from introspection results by hashes of the request tickets, without the AGW token
+    _INTROSPECTION_CACHE: Optional[Cache] = None
+    # Errors of rejected request tickets by hashes of the request tickets
+    _REJECTED_TICKETS: Optional[Cache] = None
 
     def __init__(self, plugin_definition: Dict[str, Any]):
-        self.__class__._IDPROVIDER_OPENID_CONFIGURATION = get_setting('IDPROVIDER_OPENID_CONFIGURATION')
-        self.__class__._IDPROVIDER_CLIENT_ID = get_setting('IDPROVIDER_CLIENT_ID')
-        self.__class__._IDPROVIDER_SECRET = get_setting('IDPROVIDER_SECRET')
+        self.__class__._TOKENS = get_mop_token_manager()
         self.__class__._TICKET_INTROSPECTION_ENDPOINT = get_setting('TICKET_INTROSPECTION_ENDPOINT')
         self.__class__._JWKS_ENDPOINT = get_setting('PUBLIC_SIGNATURE_JWKS_ENDPOINT')
         self.__class__._KID = get_setting('PUBLIC_SIGNATURE_KID')
         self.__class__._ISS = get_setting('ISS')
         self.__class__._EXP_LEEWAY_SECONDS = int(get_setting('PUBLIC_SIGNATURE_EXP_LEEWAY_SECONDS'))
+        if self.__class__._JWKS is None:
+            self.__class__._JWKS = JWKSCache('mop_jwks', str(self.__class__._JWKS_ENDPOINT),
+                                             settings.MOP_REQUEST_TICKET_VALIDATION_JWKS_REFRESH_INTERVAL,
+                                             settings.MOP_REQUEST_TICKET_VALIDATION_JWKS_MIN_REFETCH_INTERVAL,
+                                             get_cache('mop_jwks_shared', 1024 * 1024) if CROSS_PROCESS else None)
+            if settings.MOP_REQUEST_TICKET_VALIDATION_JWKS_PRELOAD:
+                # Plugins are created when the gateways are loaded, before gunicorn forks the workers
+                self.__class__._JWKS.warm()
+        if self.__class__._REJECTED_TICKETS is None and \
+                settings.MOP_REQUEST_TICKET_VALIDATION_REJECTED_TICKET_CACHE_TTL > 0:
+            self.__class__._REJECTED_TICKETS = get_cache(
+                'mop_rejected_tickets', settings.MOP_REQUEST_TICKET_VALIDATION_REJECTED_TICKET_CACHE_MAX_SIZE)
+        if self.__class__._VERIFIED_TICKETS is None and \
+                settings.MOP_REQUEST_TICKET_VALIDATION_VERIFIED_TICKET_CACHE_MAX_SIZE > 0:
+            self.__class__._VERIFIED_TICKETS = get_cache(
+                'mop_verified_tickets', settings.MOP_REQUEST_TICKET_VALIDATION_VERIFIED_TICKET_CACHE_MAX_SIZE)
+        if self.__class__._INTROSPECTION_CACHE is None and \
+                settings.MOP_REQUEST_TICKET_VALIDATION_INTROSPECTION_CACHE_TTL > 0:
+            self.__class__._INTROSPECTION_CACHE = get_cache(
+                'mop_introspection_cache', settings.MOP_REQUEST_TICKET_VALIDATION_INTROSPECTION_CACHE_MAX_SIZE)
         self.plugin_definition = plugin_definition
 
-    @classmethod
-    @timed
-    def _fetch_and_parse_openid_configuration(cls):
-        try:
-            ll.info(f"Fetching openid configuration from '{cls._IDPROVIDER_OPENID_CONFIGURATION}'")
-            r = requests.get(str(cls._IDPROVIDER_OPENID_CONFIGURATION))
-            r.raise_for_status()
-            open_id_config = r.json()
-            cls._TOKEN_ENDPOINT = open_id_config['token_endpoint']
-        except (ConnectionRefusedError, requests.RequestException) as e:
-            raise InternalError(f"Couldn't connect to IDP openid-configuration endpoint: {e}")
-        except (KeyError, ValueError) as e:
-            raise InternalError(f"Error parsing OpenId configuration: {e}")
-
-    @classmethod
-    @timed
-    def _get_agw_token(cls):
-        if not cls._TOKEN_ENDPOINT:
-            cls._fetch_and_parse_openid_configuration()
-
-        try:
-            token_response = cls._SESSION.post(
-                str(cls._TOKEN_ENDPOINT),
-                headers={'Content-Type': 'application/x-www-form-urlencoded'},
-                auth=requests.auth.HTTPBasicAuth(cls._IDPROVIDER_CLIENT_ID, cls._IDPROVIDER_SECRET),
-                data="grant_type=client_credentials&scope=agw"
-            )
-            ll.debug(f'Token endpoint response status={token_response.status_code}, '
-                     f'content={str(token_response.content)}')
-            token_response.raise_for_status()
-            json_response = token_response.json()
-            if 'access_token' not in json_response:
-                raise InternalError('access_token is not present in token endpoint response')
-            cls._AGW_TOKEN = json_response['access_token']
-        except requests.RequestException as e:
-            raise InternalError(f'Cannot get AGW token: {e}')
-        except ValueError:
-            raise InternalError(f'Did not receive JSON response from token endpoint')
-
-    @classmethod
-    @timed
-    def _get_public_key(cls):
-        try:
-            jwks_response = cls._SESSION.get(str(cls._JWKS_ENDPOINT))
-            jwks_response.raise_for_status()
-            jwkset = jwk.JWKSet.from_json(jwks_response.text)
-            sign_keys = jwkset.get_key(cls._KID)
-            cls._PUBLIC_KEY = jwk.JWK()
-            cls._PUBLIC_KEY.import_key(**sign_keys.export_public(as_dict=True))
-        except requests.RequestException as e:
-            raise InternalError(f'Cannot get JWKS: {e}')
-
     def apply(self, callback, route):
         def wrapper(gre: GatewayRequestEnvironment, **kwargs):
             request_ticket = self._get_request_ticket_from_headers(bottle.request.headers)
@@ -187,11 +180,10 @@ class MopRequestTicketValidationPlugin:
 
         return headers['MyDataShare-Request-Ticket']
 
-    def _generate_route_extra(self, json_response: Dict, claims: Dict):
-        cls = self.__class__
+    def _generate_route_extra(self, json_response: Dict, claims: Dict, agw_token: str):
         ret = {
             'access_item_uuid': json_response['access_item_uuid'],
-            'agw_token': cls._AGW_TOKEN,
+            'agw_token': agw_token,
             'claims': claims
         }
         if 'identifiers' in json_response:
@@ -233,25 +225,64 @@ class MopRequestTicketValidationPlugin:
         """
         Verifies the request ticket signature
 
+        The claims of verified request tickets are cached until the ticket expires (minus the leeway), so the signature
+        of a ticket used for many requests is verified only once.
+
         :param request_ticket: Request ticket to be validated
         :raises BadRequestError: If signature is invalid or claims cannot be read
         :raises InternalError: If connection to the JWKS enpoint fails
         :return: Request ticket claims
         """
         cls = self.__class__
-        if not cls._PUBLIC_KEY:
-            cls._get_public_key()
+        cache_key = None
+        if cls._VERIFIED_TICKETS is not None:
+            cache_key = _digest(request_ticket)
+            claims = cls._VERIFIED_TICKETS.get(cache_key)
+            if claims is not None:
+                return claims
+
+        kid = self._get_request_ticket_kid(request_ticket)
+        public_key = cls._JWKS.get_key(kid)  # type: ignore  # created in __init__
+        if public_key is None:
+            raise UnknownSigningKeyError(f"Unknown signing key: '{kid}'")
 
         token = jwt.JWT()
         token.leeway = cls._EXP_LEEWAY_SECONDS
         try:
-            token.deserialize(request_ticket, cls._PUBLIC_KEY)
-            return json.loads(token.claims)
+            token.deserialize(request_ticket, public_key)
+            claims = json_codec.loads(token.claims)
         except jws.InvalidJWSSignature as e:
             raise BadRequestError(f'Invalid signature: {str(e)}')
+        except jwt.JWTExpired as e:
+            raise AuthorizationError(f'Request ticket has expired: {str(e)}')
+        except JWException as e:
+            raise BadRequestError(f'Invalid request ticket: {str(e)}')
         except json.decoder.JSONDecodeError as e:
             raise BadRequestError(f'Error decoding JWT claims: {str(e)}')
 
+        if cache_key is not None and isinstance(claims, dict) and isinstance(claims.get('exp'), (int, float)):
+            # Frozen, as the claims are shared by the requests using the ticket
+            claims = freeze(claims)
+            cls._VERIFIED_TICKETS.put(  # type: ignore  # checked with cache_key
+                cache_key, claims, claims['exp'] - cls._EXP_LEEWAY_SECONDS - time.time(), len(request_ticket))
+        return claims
+
+    def _get_request_ticket_kid(self, request_ticket: str) -> str:
+        """
+        Read the key id from the header of the request ticket
+
+        :param request_ticket: Request ticket
+        :raises BadRequestError: If the header cannot be read
+        :return: The kid of the header, or the configured kid if the header does not have one
+        """
+        try:
+            header = json_codec.loads(base64url_decode(request_ticket.split('.', 1)[0]))
+        except ValueError as e:
+            raise BadRequestError(f'Error decoding JWT header: {str(e)}')
+        if not isinstance(header, dict):
+            raise BadRequestError('Error decoding JWT header: not an object')
+        return str(header.get('kid') or self.__class__._KID)
+
     def _verify_route(self, claims: Dict, gre: GatewayRequestEnvironment):
         """
         Verifies the request ticket and route matches
@@ -295,24 +326,37 @@ class MopRequestTicketValidationPlugin:
         """
 
         cls = self.__class__
-        if not cls._AGW_TOKEN:
-            cls._get_agw_token()
+        cache_key = None
+        if cls._INTROSPECTION_CACHE is not None:
+            cache_key = _digest(request_ticket)
+            cached = cls._INTROSPECTION_CACHE.get(cache_key)
+            if cached is not None:
+                ll.debug("Using cached request ticket introspection")
+                gre.route.extra['mop_request_ticket'] = dict(cached, agw_token=cls._TOKENS.get_token())  # type: ignore
+                return
+
+        agw_token = cls._TOKENS.get_token()  # type: ignore  # created in __init__
 
         max_tries = 3
         try_count = 1
         while try_count <= max_tries:
             try_count += 1
             try:
-                introspection_response = cls._SESSION.post(
+                introspection_response = circuit_breakers.call(
                     str(cls._TICKET_INTROSPECTION_ENDPOINT),
-                    headers={'Authorization': f'bearer {cls._AGW_TOKEN}'},
-                    json={'request_ticket': request_ticket})
+                    upstream_pool.get_session(str(cls._TICKET_INTROSPECTION_ENDPOINT)).post,
+                    str(cls._TICKET_INTROSPECTION_ENDPOINT),
+                    headers={'Authorization': f'bearer {agw_token}'},
+                    json={'request_ticket': request_ticket},
+                    timeout=gre.deadline.timeout())
+            except requests.Timeout as e:
+                raise GatewayTimeoutError('Gateway timeout', log=f'Request ticket introspection timed out: {str(e)}')
             except requests.RequestException as e:
                 raise InternalError(f'Connection to MOP failed: {str(e)}')
 
             if introspection_response.status_code == 200:
                 try:
-                    json_response = introspection_response.json()
+                    json_response = json_codec.loads(introspection_response.content)
                 except ValueError:
                     raise InternalError('IdProvider response is not valid JSON')
                 if json_response.get('active') is not True:
@@ -322,7 +366,10 @@ class MopRequestTicketValidationPlugin:
                     raise BadRequestError(err)
                 else:
                     if 'access_item_uuid' in json_response:
-                        gre.route.extra['mop_request_ticket'] = self._generate_route_extra(json_response, claims)
+                        route_extra = self._generate_route_extra(json_response, claims, agw_token)
+                        gre.route.extra['mop_request_ticket'] = route_extra
+                        if cache_key is not None:
+                            self._cache_route_extra(cache_key, route_extra, claims)
                     else:
                         ll.warning("access_item_uuid missing from introspection response")
                     return
@@ -330,12 +377,32 @@ class MopRequestTicketValidationPlugin:
                 # TODO: It seems we get other errors here too.... Handle those...
                 ll.info(f"AGW token has expired: {introspection_response.text}")
                 if try_count <= max_tries:
-                    cls._get_agw_token()
+                    agw_token = cls._TOKENS.renew(agw_token)  # type: ignore  # created in __init__
             else:
                 raise InternalError("Introspection response has unknown status code: "
                                     f"{introspection_response.status_code}, response: {introspection_response.text}")
         raise InternalError("Could not validate request ticket")
 
+    @classmethod
+    def _cache_route_extra(cls, cache_key: bytes, route_extra: Dict, claims: Dict) -> None:
+        """
+        Cache the route extra generated from an introspection result.
+
+        The entry expires after `INTROSPECTION_CACHE_TTL` seconds, but never after the request ticket expires. Until
+        then, a request ticket revoked or made inactive in MOP keeps being accepted, and the requests made with the
+        ticket share the access item of the introspection.
+
+        :param cache_key: Hash of the request ticket.
+        :param route_extra: The route extra.
+        :param claims: Request ticket claims.
+        """
+        ttl = settings.MOP_REQUEST_TICKET_VALIDATION_INTROSPECTION_CACHE_TTL
+        if isinstance(claims.get('exp'), (int, float)):
+            ttl = min(ttl, claims['exp'] - time.time())
+        # The AGW token is added when the entry is used, as the token may have been renewed
+        value = freeze({key: val for key, val in route_extra.items() if key != 'agw_token'})
+        cls._INTROSPECTION_CACHE.put(cache_key, value, ttl, len(json_codec.dumps(value)))  # type: ignore
+
     @timed
     def _validate_request_ticket(self, request_ticket: str, gre: GatewayRequestEnvironment):
         """
@@ -349,11 +416,47 @@ class MopRequestTicketValidationPlugin:
                                  invalid or claims cannot be read
         """
         cls = self.__class__
-        claims = self._verify_request_ticket_signature(request_ticket)
-        if cls._ISS != claims['iss']:
-            raise AuthorizationError(f"Bad issuer. Expected '{cls._ISS}' but got '{claims['iss']}'")
+        cache_key = None
+        if cls._REJECTED_TICKETS is not None:
+            cache_key = _digest(request_ticket)
+            rejection = cls._REJECTED_TICKETS.get(cache_key)
+            if rejection is not None:
+                ll.debug("Request ticket was rejected earlier")
+                raise _REJECTIONS[rejection['error']](rejection['description'], log=rejection['log'])
+
+        try:
+            claims = self._verify_request_ticket_signature(request_ticket)
+            if cls._ISS != claims.get('iss'):
+                raise AuthorizationError(f"Bad issuer. Expected '{cls._ISS}' but got '{claims.get('iss')}'")
+        except UnknownSigningKeyError:
+            # Not cached, the key may be found when the JWKS is refetched
+            raise
+        except (BadRequestError, AuthorizationError) as e:
+            self._cache_rejection(cache_key, e)
+            raise
+        # Not cached, as the audience depends on the route
         self._verify_route(claims, gre)
-        self._introspect_request_ticket(request_ticket, gre, claims)
+        try:
+            self._introspect_request_ticket(request_ticket, gre, claims)
+        except (BadRequestError, AuthorizationError) as e:
+            self._cache_rejection(cache_key, e)
+            raise
+
+    @classmethod
+    def _cache_rejection(cls, cache_key: Optional[bytes], error: ServiceError) -> None:
+        """
+        Cache the rejection of a request ticket, so that the ticket is rejected with the same error for
+        `REJECTED_TICKET_CACHE_TTL` seconds without verifying or introspecting it again.
+
+        :param cache_key: Hash of the request ticket, None if the cache is disabled.
+        :param error: The error the ticket was rejected with.
+        """
+        if cache_key is None:
+            return
+        value = {'error': error.error, 'description': error.description, 'log': error.log}
+        cls._REJECTED_TICKETS.put(  # type: ignore  # checked with cache_key
+            cache_key, value, settings.MOP_REQUEST_TICKET_VALIDATION_REJECTED_TICKET_CACHE_TTL,
+            len(json_codec.dumps(value)))
 
 
 AGW_PLUGIN_CLASS = MopRequestTicketValidationPlugin
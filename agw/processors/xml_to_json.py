@@ -1,4 +1,4 @@
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
 from xmltodict import parse  # type: ignore  # hints missing...
 from xml.parsers.expat import ExpatError
 
@@ -14,6 +14,9 @@ class XmlToJson:
     def __init__(self, processor_definition: Dict[str, Any]) -> None:
         pass
 
+    def get_references(self) -> Tuple[List[str], List[str]]:
+        return ['self.response'], ['self.response.json']
+
     @timed
     def run(self, gre: GatewayRequestEnvironment, self_key: str) -> None:
         try:
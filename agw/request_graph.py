@@ -0,0 +1,152 @@
+from typing import List, Set, Dict, Any, Optional
+
+from agw_request import AGWRequestDefinition
+from builders import get_builder
+from processors import get_processor
+from template import find_template_keys, split_key
+from mds_logging import getLogger
+
+ll = getLogger("agw." + __name__)
+
+
+# Roots of GRE keys that may be written to without sharing data with other requests, writing to any other root (e.g.
+# 'route' or 'constants') makes the request a barrier. Writes to 'requests' are checked separately.
+_PRIVATE_ROOTS = ('self', 'requests')
+
+
+class _AllRequests(Exception):
+    """Raised when a key references a request that cannot be resolved at load time."""
+    pass
+
+
+class RequestGraph:
+    """
+    Dependency graph of the request definitions of a gateway.
+
+    The graph is resolved from the `${...}` references, builders and processors of each request definition. Request
+    `i` depends on request `j` if it reads anything from `requests[j]` or `requests_by_name[...]` of it. A request
+    that writes to data shared with other requests (e.g. `route`), that references requests which cannot be resolved
+    at load time or that uses operations with unknown references is a barrier: it depends on all earlier requests and
+    all later requests depend on it, so it is run exactly as it would be run sequentially.
+    """
+
+    def __init__(self, request_definitions: List[AGWRequestDefinition]):
+        self.size = len(request_definitions)
+        effective_definitions = [self._effective_definition(req_def) for req_def in request_definitions]
+        self.names: Dict[str, int] = {}
+        for i, definition in enumerate(effective_definitions):
+            if definition.get('name') and definition['name'] not in self.names:
+                self.names[definition['name']] = i
+
+        self.dependencies: List[Set[int]] = [set() for _ in range(self.size)]
+        barriers = []
+        for i, definition in enumerate(effective_definitions):
+            try:
+                self.dependencies[i] = self._resolve_dependencies(i, definition)
+            except _AllRequests:
+                barriers.append(i)
+
+        for barrier in barriers:
+            self.dependencies[barrier] = set(range(barrier))
+            for i in range(barrier + 1, self.size):
+                self.dependencies[i].add(barrier)
+
+        ll.debug(f"Request dependencies: {self.dependencies}")
+
+    @property
+    def is_sequential(self) -> bool:
+        """True if every request depends on the previous one, i.e. nothing can be run concurrently."""
+        return all(i - 1 in deps for i, deps in enumerate(self.dependencies) if i > 0)
+
+    def ready(self, done: Set[int], started: Set[int]) -> List[int]:
+        """
+        Get the requests that can be started, in definition order.
+
+        :param done: Indices of the requests that have completed.
+        :param started: Indices of the requests that have been started.
+        :return: Indices of the requests whose dependencies have all completed.
+        """
+        return [i for i in range(self.size) if i not in started and self.dependencies[i] <= done]
+
+    @staticmethod
+    def _effective_definition(req_def: AGWRequestDefinition) -> Dict[str, Any]:
+        definition = dict(req_def.__dict__)
+        if req_def.includes:
+            for incl in req_def.includes:
+                # Includes are applied only when they have arguments, see GatewayRequestEnvironment
+                if 'arguments' in incl and 'include' in incl:
+                    definition.update(incl['include'])
+        return definition
+
+    def _resolve_dependencies(self, index: int, definition: Dict[str, Any]) -> Set[int]:
+        dependencies: Set[int] = set()
+        reads: List[str] = []
+        writes: List[str] = []
+
+        for key, value in definition.items():
+            if key not in ('builders', 'processors'):
+                reads.extend(find_template_keys(value))
+
+        for builder_definition in definition.get('builders') or []:
+            self._add_operation_references(get_builder(builder_definition), builder_definition, reads, writes)
+        for processor_definition in definition.get('processors') or []:
+            self._add_operation_references(get_processor(processor_definition), processor_definition, reads, writes)
+
+        for key in reads:
+            ref = self._referenced_request(key, index)
+            if ref is not None:
+                dependencies.add(ref)
+        for key in writes:
+            if self._referenced_request(key, index) is not None or _root(key) not in _PRIVATE_ROOTS:
+                # Writing to another request or shared data
+                raise _AllRequests()
+        return dependencies
+
+    @staticmethod
+    def _add_operation_references(operation, operation_definition: Dict[str, Any], reads: List[str],
+                                  writes: List[str]) -> None:
+        get_references = getattr(operation, 'get_references', None)
+        references = get_references() if get_references else None
+        if references is None:
+            raise _AllRequests()
+        reads.extend(references[0])
+        writes.extend(references[1])
+        reads.extend(find_template_keys(operation_definition))
+
+    def _referenced_request(self, key: str, index: int) -> Optional[int]:
+        """
+        Resolve the index of the request referenced by the given GRE key.
+
+        :return: The index of another request referenced by the key or None if the key does not reference one.
+        :raises _AllRequests: If the referenced request cannot be resolved or is not defined before the request.
+        """
+        root = _split_root(key)
+        if root in ('requests', 'requests_by_name'):
+            raise _AllRequests()
+        if not root.endswith(']'):
+            return None
+
+        name, _, index_or_key = root[:-1].partition('[')
+        ref: Optional[int] = None
+        if name == 'requests' and index_or_key.isdigit():
+            ref = int(index_or_key)
+        elif name == 'requests_by_name' and index_or_key[:1] in ('"', "'"):
+            ref = self.names.get(index_or_key[1:-1])
+        elif name not in ('requests', 'requests_by_name'):
+            return None
+
+        if ref is None or ref > index:
+            raise _AllRequests()
+        return ref if ref != index else None
+
+
+def _split_root(key: str) -> str:
+    try:
+        return split_key(key)[0]
+    except ValueError:
+        # Badly formed keys fail when the request is run, just as they would without the graph
+        raise _AllRequests()
+
+
+def _root(key: str) -> str:
+    return _split_root(key).split('[')[0]
@@ -0,0 +1,102 @@
+from typing import Any, Dict, Optional, Tuple, Mapping
+
+import settings
+from agw_request import AGWRequest, AGWRequestResponse
+from cache import LRUCache
+from mds_logging import getLogger
+from service_exception_handler_plugin import InternalError
+
+ll = getLogger("agw." + __name__)
+
+
+CacheKey = Tuple[str, str, Tuple[Optional[str], ...]]
+
+# Headers identifying the user, part of the cache key unless the definition sets `vary_credentials` to false
+CREDENTIAL_HEADERS = ('authorization', 'cookie')
+
+_cache = LRUCache('upstream_response_cache', settings.UPSTREAM_CACHE_MAX_SIZE)
+
+
+def validate_cache_policy(policy: Any) -> None:
+    """
+    Validate the `cache` block of a request definition.
+
+    :param policy: The value of the `cache` key of the request definition.
+    :return: None
+    :raises InternalError: If the policy is not valid.
+    """
+    if not isinstance(policy, dict):
+        raise InternalError("Request 'cache' definition should be a dict")
+    ttl = policy.get('ttl')
+    if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or ttl <= 0:
+        raise InternalError("Request 'cache' definition should have a positive 'ttl'")
+    vary_headers = policy.get('vary_headers', [])
+    if not isinstance(vary_headers, list) or not all(isinstance(h, str) for h in vary_headers):
+        raise InternalError("Request 'cache' definition 'vary_headers' should be a list of header names")
+    if not isinstance(policy.get('vary_credentials', True), bool):
+        raise InternalError("Request 'cache' definition 'vary_credentials' should be a boolean")
+    max_entry_size = policy.get('max_entry_size', settings.UPSTREAM_CACHE_MAX_ENTRY_SIZE)
+    if isinstance(max_entry_size, bool) or not isinstance(max_entry_size, int) or max_entry_size <= 0:
+        raise InternalError("Request 'cache' definition 'max_entry_size' should be a positive integer")
+
+
+def get_cache_key(agw_req: AGWRequest) -> Optional[CacheKey]:
+    """
+    Get the key under which the response of the request is cached.
+
+    Only GET requests of definitions with a `cache` block are cached. The key consists of the URL, the values of the
+    headers listed in `vary_headers` and, unless `vary_credentials` is false, the values of the `Authorization` and
+    `Cookie` headers, so that a response is only reused for the same credentials. All other headers are ignored.
+
+    :param agw_req: The request to be sent.
+    :return: The cache key or None if the response of the request should not be cached.
+    """
+    if not agw_req.cache or (agw_req.method or '').upper() != 'GET':
+        return None
+    headers = _lower_keys(agw_req.headers)
+    names = [name.lower() for name in agw_req.cache.get('vary_headers', [])]
+    if agw_req.cache.get('vary_credentials', True):
+        names.extend(CREDENTIAL_HEADERS)
+    vary = tuple(headers.get(name) for name in names)
+    return 'GET', agw_req.url, vary
+
+
+def get(key: CacheKey) -> Optional[AGWRequestResponse]:
+    """
+    Get a cached response.
+
+    :param key: Key returned by `get_cache_key`.
+    :return: A new response object built from the cached response or None if not cached.
+    """
+    cached = _cache.get(key)
+    if cached is None:
+        return None
+    status, headers, content, encoding = cached
+    return AGWRequestResponse(status=status, headers=headers, content=content, encoding=encoding)
+
+
+def put(key: CacheKey, agw_req: AGWRequest, agw_resp: AGWRequestResponse) -> None:
+    """
+    Cache a response, if it is successful and not larger than the maximum entry size of the request definition.
+
+    :param key: Key returned by `get_cache_key`.
+    :param agw_req: The sent request.
+    :param agw_resp: The received response.
+    :return: None
+    """
+    if not 200 <= agw_resp.status < 300:
+        return
+    headers = agw_resp.headers
+    size = len(agw_resp.content) + sum(len(k) + len(v) for k, v in headers.items()) + len(agw_req.url)
+    if size > agw_req.cache.get('max_entry_size', settings.UPSTREAM_CACHE_MAX_ENTRY_SIZE):
+        ll.debug(f"Response of {agw_req.url} too large to be cached: {size} bytes")
+        return
+    _cache.put(key, (agw_resp.status, headers, agw_resp.content, agw_resp.encoding), agw_req.cache['ttl'], size)
+
+
+def clear() -> None:
+    _cache.clear()
+
+
+def _lower_keys(headers: Optional[Mapping[str, str]]) -> Dict[str, str]:
+    return {k.lower(): v for k, v in headers.items()} if headers else {}
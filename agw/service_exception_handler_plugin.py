@@ -1,8 +1,8 @@
 import bottle
 import logging
-import json
 from typing import Optional
 
+import json_codec
 import mds_logging
 
 
@@ -58,6 +58,18 @@ class InternalError(ServiceError):
     log_level = logging.ERROR
 
 
+class ServiceUnavailableError(ServiceError):
+    error = "service_unavailable"
+    status = 503
+    log_level = logging.WARNING
+
+
+class GatewayTimeoutError(ServiceError):
+    error = "gateway_timeout"
+    status = 504
+    log_level = logging.WARNING
+
+
 class ServiceExceptionHandlerPlugin(object):
 
     _DEBUG_FLAG = False
@@ -75,8 +87,7 @@ class ServiceExceptionHandlerPlugin(object):
             # This is to hide all the unexpected errors
             except Exception as e:
                 ll.exception(e)
-                gre = bottle.request.environ['gre']
-                gre.error = UNEXPECTED_ERROR_MSG
+                ServiceExceptionHandlerPlugin._set_error(UNEXPECTED_ERROR_MSG)
 
                 if not ServiceExceptionHandlerPlugin._DEBUG_FLAG:
                     raise bottle.HTTPResponse(
@@ -85,7 +96,7 @@ class ServiceExceptionHandlerPlugin(object):
                             **bottle.response.headers,
                             'Content-Type': 'application/json',
                         },
-                        body=json.dumps({
+                        body=json_codec.dumps({
                             'error': 'internal_error',
                             'description': UNEXPECTED_ERROR_MSG,
                             'request_id': bottle.request.environ.get('request_id')
@@ -96,6 +107,13 @@ class ServiceExceptionHandlerPlugin(object):
 
         return wrapper
 
+    @staticmethod
+    def _set_error(msg: str) -> None:
+        # Routes served without GRE (see static_response) have nothing to record the error in
+        gre = bottle.request.environ.get('gre')
+        if gre is not None:
+            gre.error = msg
+
     @staticmethod
     def handle_service_error(service_error: ServiceError):
         """
@@ -117,8 +135,7 @@ class ServiceExceptionHandlerPlugin(object):
             log_msg = service_error.description
         ll.log(service_error.log_level, f"{service_error.__class__.__name__}: {log_msg}")
 
-        gre = bottle.request.environ['gre']
-        gre.error = log_msg
+        ServiceExceptionHandlerPlugin._set_error(log_msg)
 
         raise bottle.HTTPResponse(
             status=service_error.status,
@@ -126,7 +143,7 @@ class ServiceExceptionHandlerPlugin(object):
                 **bottle.response.headers,
                 'Content-Type': 'application/json',
             },
-            body=json.dumps({
+            body=json_codec.dumps({
                 'error': service_error.error,
                 'description': service_error.description,
                 'request_id': bottle.request.environ.get('request_id')
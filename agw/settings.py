@@ -1,4 +1,5 @@
 import os
+import tempfile
 from typing import Callable, Optional, Any, Dict, Tuple
 
 _SETTINGS: Dict[str, Tuple[Optional[str], bool]] = {}
@@ -37,6 +38,39 @@ INCLUDES_SEARCH_PATH: str = get_setting('INCLUDES_SEARCH_PATH')
 LOGGING_LEVEL: str = get_setting('LOGGING_LEVEL', 'INFO')
 LOGGING_COLOR: bool = True if get_setting('LOGGING_COLOR', 'true').lower() in ('true', 'y', 'yes') else False
 
+STATS_PATH: Optional[str] = get_setting('STATS_PATH')
+
+UPSTREAM_POOL_SIZE: int = int(get_setting('UPSTREAM_POOL_SIZE', '10'))
+UPSTREAM_POOL_BLOCK: bool = \
+    True if get_setting('UPSTREAM_POOL_BLOCK', 'false').lower() in ('true', 'y', 'yes') else False
+UPSTREAM_KEEP_ALIVE: bool = \
+    True if get_setting('UPSTREAM_KEEP_ALIVE', 'true').lower() in ('true', 'y', 'yes') else False
+UPSTREAM_KEEP_ALIVE_TIMEOUT: float = float(get_setting('UPSTREAM_KEEP_ALIVE_TIMEOUT', '60'))
+UPSTREAM_CONNECT_TIMEOUT: float = float(get_setting('UPSTREAM_CONNECT_TIMEOUT', '5'))
+UPSTREAM_READ_TIMEOUT: float = float(get_setting('UPSTREAM_READ_TIMEOUT', '30'))
+ROUTE_DEADLINE: Optional[float] = float(get_setting('ROUTE_DEADLINE')) if get_setting('ROUTE_DEADLINE') else None
+UPSTREAM_MAX_PARALLEL_REQUESTS: int = int(get_setting('UPSTREAM_MAX_PARALLEL_REQUESTS', '8'))
+UPSTREAM_CACHE_MAX_SIZE: int = int(get_setting('UPSTREAM_CACHE_MAX_SIZE', str(64 * 1024 * 1024)))
+UPSTREAM_CACHE_MAX_ENTRY_SIZE: int = int(get_setting('UPSTREAM_CACHE_MAX_ENTRY_SIZE', str(1024 * 1024)))
+
+CIRCUIT_BREAKER_ENABLED: bool = \
+    True if get_setting('CIRCUIT_BREAKER_ENABLED', 'true').lower() in ('true', 'y', 'yes') else False
+CIRCUIT_BREAKER_WINDOW: float = float(get_setting('CIRCUIT_BREAKER_WINDOW', '30'))
+CIRCUIT_BREAKER_MIN_CALLS: int = int(get_setting('CIRCUIT_BREAKER_MIN_CALLS', '20'))
+CIRCUIT_BREAKER_FAILURE_RATE: float = float(get_setting('CIRCUIT_BREAKER_FAILURE_RATE', '0.5'))
+CIRCUIT_BREAKER_SLOW_CALL_DURATION: float = float(get_setting('CIRCUIT_BREAKER_SLOW_CALL_DURATION', '10'))
+CIRCUIT_BREAKER_SLOW_CALL_RATE: float = float(get_setting('CIRCUIT_BREAKER_SLOW_CALL_RATE', '0.8'))
+CIRCUIT_BREAKER_OPEN_DURATION: float = float(get_setting('CIRCUIT_BREAKER_OPEN_DURATION', '30'))
+CIRCUIT_BREAKER_HALF_OPEN_CALLS: int = int(get_setting('CIRCUIT_BREAKER_HALF_OPEN_CALLS', '3'))
+
+JSON_CODEC: str = get_setting('JSON_CODEC', 'json').lower()
+
+SHARED_CACHE: str = get_setting('SHARED_CACHE', 'memory').lower()
+# In a directory of the user, created readable by the user only
+SHARED_CACHE_PATH: str = get_setting('SHARED_CACHE_PATH', os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), f'agw-{os.getuid()}',  # nosec
+    'shared-cache.sqlite'))
+
 CORS_ORIGIN_PATTERN: Optional[str] = get_setting('CORS_ORIGIN_PATTERN')
 
 MOP_REQUEST_TICKET_VALIDATION_IDPROVIDER_OPENID_CONFIGURATION: Optional[str] = \
@@ -47,3 +81,28 @@ MOP_REQUEST_TICKET_VALIDATION_IDPROVIDER_SECRET: Optional[str] = \
     get_setting('MOP_REQUEST_TICKET_VALIDATION_IDPROVIDER_SECRET', secret=True)
 MOP_REQUEST_TICKET_VALIDATION_TICKET_INTROSPECTION_ENDPOINT: Optional[str] = \
     get_setting('MOP_REQUEST_TICKET_VALIDATION_TICKET_INTROSPECTION_ENDPOINT')
+# Seconds before the expiry of the AGW token to refresh it in the background
+MOP_REQUEST_TICKET_VALIDATION_AGW_TOKEN_REFRESH_MARGIN: float = \
+    float(get_setting('MOP_REQUEST_TICKET_VALIDATION_AGW_TOKEN_REFRESH_MARGIN', '60'))
+# Seconds between background refreshes of the JWKS (0 disables them), and minimum seconds between the refetches
+# triggered by unknown key ids
+MOP_REQUEST_TICKET_VALIDATION_JWKS_REFRESH_INTERVAL: float = \
+    float(get_setting('MOP_REQUEST_TICKET_VALIDATION_JWKS_REFRESH_INTERVAL', '3600'))
+MOP_REQUEST_TICKET_VALIDATION_JWKS_MIN_REFETCH_INTERVAL: float = \
+    float(get_setting('MOP_REQUEST_TICKET_VALIDATION_JWKS_MIN_REFETCH_INTERVAL', '60'))
+# Fetch the JWKS when the gateways are loaded, before the workers are forked
+MOP_REQUEST_TICKET_VALIDATION_JWKS_PRELOAD: bool = \
+    get_setting('MOP_REQUEST_TICKET_VALIDATION_JWKS_PRELOAD', 'false').lower() in ('true', 'y', 'yes')
+# Maximum total size in bytes of the request tickets whose verified claims are cached, 0 disables caching
+MOP_REQUEST_TICKET_VALIDATION_VERIFIED_TICKET_CACHE_MAX_SIZE: int = \
+    int(get_setting('MOP_REQUEST_TICKET_VALIDATION_VERIFIED_TICKET_CACHE_MAX_SIZE', str(4 * 1024 * 1024)))
+# Time in seconds a rejected request ticket is rejected without validating it again, 0 disables caching
+MOP_REQUEST_TICKET_VALIDATION_REJECTED_TICKET_CACHE_TTL: float = \
+    float(get_setting('MOP_REQUEST_TICKET_VALIDATION_REJECTED_TICKET_CACHE_TTL', '30'))
+MOP_REQUEST_TICKET_VALIDATION_REJECTED_TICKET_CACHE_MAX_SIZE: int = \
+    int(get_setting('MOP_REQUEST_TICKET_VALIDATION_REJECTED_TICKET_CACHE_MAX_SIZE', str(1024 * 1024)))
+# Maximum time in seconds an introspection result is reused, 0 disables caching
+MOP_REQUEST_TICKET_VALIDATION_INTROSPECTION_CACHE_TTL: float = \
+    float(get_setting('MOP_REQUEST_TICKET_VALIDATION_INTROSPECTION_CACHE_TTL', '0'))
+MOP_REQUEST_TICKET_VALIDATION_INTROSPECTION_CACHE_MAX_SIZE: int = \
+    int(get_setting('MOP_REQUEST_TICKET_VALIDATION_INTROSPECTION_CACHE_MAX_SIZE', str(16 * 1024 * 1024)))
@@ -0,0 +1,260 @@
+import os
+import sqlite3
+import stat
+import time
+from threading import Lock
+from typing import Any, Dict, Hashable, List, Optional, Union
+
+import json_codec
+import settings
+from cache import LRUCache
+from mds_logging import getLogger
+from stats import register_stats
+
+ll = getLogger("agw." + __name__)
+
+# Backends that AGW_SHARED_CACHE may select for the caches of plugins and after hooks. 'memory' keeps the entries in
+# the memory of each worker, 'sqlite' in an SQLite database shared by the workers of the node (AGW_SHARED_CACHE_PATH,
+# by default in a directory of the user in /dev/shm so that it is not written to disk).
+BACKENDS = ('memory', 'sqlite')
+
+if settings.SHARED_CACHE not in BACKENDS:
+    raise ValueError(f"AGW_SHARED_CACHE should be one of {', '.join(BACKENDS)}, not '{settings.SHARED_CACHE}'")
+
+# True if the caches are shared by the workers, i.e. state a worker keeps in memory anyway (e.g. tokens) should be
+# shared through a cache too
+CROSS_PROCESS = settings.SHARED_CACHE != 'memory'
+
+# Connections opened before a fork, kept open in the forked process as closing them could release the locks of the
+# parent process
+_INHERITED_CONNECTIONS: List[sqlite3.Connection] = []
+
+
+class SqliteCache:
+    """
+    Memory-bounded cache with a TTL for each entry, shared by the processes using the same SQLite database.
+
+    Has the interface of `LRUCache`, except that the values must be JSON serializable, `get` returns a new decoded copy
+    of the value, and the size of an entry is the size of its encoded value. The caches of different names are kept in
+    the same table, and the total size of the entries of each cache is kept up to date by triggers in a table of its
+    own. When the total size of the entries of a cache would exceed `max_size`, the expired entries and then the
+    entries closest to expiry are evicted.
+
+    A connection is opened for each process when the cache is first used, so the cache can be created before the
+    workers are forked. The database is only used if neither it nor its directory can be read or replaced by other
+    users (see `_check_private`). Database errors are logged and treated as misses: the cache never fails a request.
+    """
+
+    def __init__(self, name: str, max_size: int, path: str) -> None:
+        """
+        :param name: Name of the cache, used for registering its stats and for separating its entries.
+        :param max_size: Maximum total size of the entries.
+        :param path: Path of the database file.
+        """
+        self.name = name
+        self.max_size = max_size
+        self.path = path
+        self._lock = Lock()
+        self._pid: Optional[int] = None
+        self._connection: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+        register_stats(name, self.stats)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Get a value from the cache.
+
+        :param key: Key of the entry, bytes or str.
+        :return: A copy of the cached value or None if the key is not cached or has expired.
+        """
+        try:
+            with self._lock:
+                row = self._connect().execute('SELECT value, expires_at FROM entries WHERE name = ? AND key = ?',
+                                              (self.name, _key(key))).fetchone()
+        except (sqlite3.Error, OSError) as e:
+            self._error(e)
+            row = None
+        if row is None or row[1] <= time.time():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json_codec.loads(row[0])
+
+    def put(self, key: Hashable, value: Any, ttl: float, size: Optional[int] = None) -> bool:
+        """
+        Add a value to the cache.
+
+        :param key: Key of the entry, bytes or str.
+        :param value: The value to cache, JSON serializable.
+        :param ttl: Time to live of the entry in seconds.
+        :param size: Ignored, the size of the encoded value is used.
+        :return: True if the value was cached, False if it is too large for the cache, the TTL is not positive or the
+            database cannot be written.
+        """
+        encoded = json_codec.dumps(value)
+        if ttl <= 0 or len(encoded) > self.max_size:
+            return False
+        now = time.time()
+        try:
+            with self._lock:
+                connection = self._connect()
+                with connection:
+                    connection.execute('DELETE FROM entries WHERE name = ? AND expires_at <= ?', (self.name, now))
+                    # Not INSERT OR REPLACE, as the rows it replaces do not fire the delete trigger
+                    if not connection.execute('UPDATE entries SET value = ?, expires_at = ? WHERE name = ? AND key = ?',
+                                              (encoded, now + ttl, self.name, _key(key))).rowcount:
+                        connection.execute('INSERT INTO entries VALUES (?, ?, ?, ?)',
+                                           (self.name, _key(key), encoded, now + ttl))
+                    self._evict(connection)
+            return True
+        except (sqlite3.Error, OSError) as e:
+            self._error(e)
+            return False
+
+    def delete(self, key: Hashable) -> None:
+        try:
+            with self._lock:
+                connection = self._connect()
+                with connection:
+                    connection.execute('DELETE FROM entries WHERE name = ? AND key = ?', (self.name, _key(key)))
+        except (sqlite3.Error, OSError) as e:
+            self._error(e)
+
+    def clear(self) -> None:
+        try:
+            with self._lock:
+                connection = self._connect()
+                with connection:
+                    connection.execute('DELETE FROM entries WHERE name = ?', (self.name,))
+        except (sqlite3.Error, OSError) as e:
+            self._error(e)
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        row = connection.execute('SELECT size FROM sizes WHERE name = ?', (self.name,)).fetchone()
+        size = row[0] if row is not None else 0
+        if size <= self.max_size:
+            return
+        evicted = []
+        cursor = connection.execute('SELECT key, LENGTH(value) FROM entries WHERE name = ? ORDER BY expires_at',
+                                    (self.name,))
+        for key, entry_size in cursor:
+            if size <= self.max_size:
+                break
+            evicted.append((self.name, key))
+            size -= entry_size
+        cursor.close()
+        connection.executemany('DELETE FROM entries WHERE name = ? AND key = ?', evicted)
+        self.evictions += len(evicted)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Called with the lock held
+        if self._connection is None or self._pid != os.getpid():
+            if self._connection is not None:
+                _INHERITED_CONNECTIONS.append(self._connection)
+            _check_private(self.path)
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode = WAL')
+            # The cache can be lost, e.g. in a power failure
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                _create_tables(connection)
+                connection.execute('COMMIT')
+            except sqlite3.Error:
+                connection.execute('ROLLBACK')
+                raise
+            connection.isolation_level = 'DEFERRED'
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def _error(self, e: Exception) -> None:
+        self.errors += 1
+        ll.warning(f"Shared cache '{self.name}' at '{self.path}' failed: {e}")
+
+    def __len__(self) -> int:
+        try:
+            with self._lock:
+                return self._connect().execute('SELECT COUNT(*) FROM entries WHERE name = ? AND expires_at > ?',
+                                               (self.name, time.time())).fetchone()[0]
+        except (sqlite3.Error, OSError) as e:
+            self._error(e)
+            return 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'entries': len(self),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'errors': self.errors,
+        }
+
+
+Cache = Union[LRUCache, SqliteCache]
+
+
+def get_cache(name: str, max_size: int) -> Cache:
+    """
+    Get a cache of the backend selected with AGW_SHARED_CACHE.
+
+    :param name: Name of the cache, used for registering its stats.
+    :param max_size: Maximum total size of the entries.
+    :return: The cache.
+    """
+    if settings.SHARED_CACHE == 'sqlite':
+        return SqliteCache(name, max_size, settings.SHARED_CACHE_PATH)
+    return LRUCache(name, max_size)
+
+
+def _create_tables(connection: sqlite3.Connection) -> None:
+    # Creates the tables if they do not exist. The total size of the entries of each cache is updated by triggers in the
+    # transaction changing the entries, so that it does not have to be summed up when adding an entry.
+    connection.execute('CREATE TABLE IF NOT EXISTS entries (name TEXT, key BLOB, value BLOB, expires_at REAL, '
+                       'PRIMARY KEY (name, key)) WITHOUT ROWID')
+    connection.execute('CREATE INDEX IF NOT EXISTS entries_expiry ON entries (name, expires_at)')
+    connection.execute('CREATE TABLE IF NOT EXISTS sizes (name TEXT PRIMARY KEY, size INTEGER NOT NULL)')
+    # Sizes of the entries of a database created before the sizes were tracked
+    connection.execute('INSERT OR IGNORE INTO sizes SELECT name, SUM(LENGTH(value)) FROM entries GROUP BY name')
+    connection.execute('CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN '
+                       'INSERT OR IGNORE INTO sizes VALUES (new.name, 0); '
+                       'UPDATE sizes SET size = size + LENGTH(new.value) WHERE name = new.name; END')
+    connection.execute('CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE ON entries BEGIN '
+                       'UPDATE sizes SET size = size + LENGTH(new.value) - LENGTH(old.value) '
+                       'WHERE name = new.name; END')
+    connection.execute('CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN '
+                       'UPDATE sizes SET size = size - LENGTH(old.value) WHERE name = old.name; END')
+
+
+def _check_private(path: str) -> None:
+    """
+    Check that a database file and its directory, where SQLite also creates the WAL files, belong to the user and cannot
+    be read (the entries may contain tokens and personal data) or replaced by other users. The directory and the file
+    are created if they do not exist.
+
+    :param path: Path of the database file.
+    :raises OSError: If the file or the directory is not private, the file is a symbolic link or cannot be created.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o022:
+        raise OSError(f"Directory '{directory}' is not owned by the user or is writable by other users")
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    try:
+        st = os.fstat(fd)
+    finally:
+        os.close(fd)
+    if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise OSError(f"'{path}' is not owned by the user or is accessible to other users")
+
+
+def _key(key: Hashable) -> bytes:
+    return key if isinstance(key, bytes) else str(key).encode('utf-8')
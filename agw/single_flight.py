@@ -0,0 +1,113 @@
+import json
+from threading import Event, Lock
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple, cast
+
+from agw_request import AGWRequest, AGWRequestResponse
+from deadline import Deadline
+from http_method import READ_METHODS
+from mds_logging import getLogger
+from service_exception_handler_plugin import GatewayTimeoutError
+from stats import register_stats
+
+ll = getLogger("agw." + __name__)
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = Event()
+        self.response: Optional[AGWRequestResponse] = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical upstream requests of a worker into a single in-flight call.
+
+    The first caller with a given key (the leader) sends the request, callers with the same key arriving while it is in
+    flight wait for its result instead of sending their own request. Every caller receives its own copy of the
+    response, so that processors of one request do not see the modifications made by the processors of another one. If
+    the call of the leader fails, the same exception is raised to all waiting callers.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, deadline: Deadline, fn: Callable[..., AGWRequestResponse],
+           *args: Any) -> AGWRequestResponse:
+        """
+        Call `fn` unless a call with the same key is already in flight, in which case wait for its result.
+
+        :param key: Key identifying identical calls.
+        :param deadline: Deadline of the calling route, bounds the time waited for a call in flight.
+        :param fn: Function sending the request.
+        :param args: Arguments of `fn`.
+        :return: A copy of the response of the call.
+        :raises GatewayTimeoutError: If the deadline expires while waiting for a call in flight.
+        """
+        with self._lock:
+            in_flight = self._calls.get(key)
+            if in_flight is None:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if in_flight is None:
+            try:
+                response = call.response = fn(*args)
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return response.copy()
+
+        call = in_flight
+        ll.debug("Waiting for an identical upstream request in flight")
+        if not call.done.wait(deadline.remaining()):
+            raise GatewayTimeoutError('Gateway timeout', log=f'Route deadline of {deadline.seconds}s expired while '
+                                                             f'waiting for an identical upstream request')
+        if call.error is not None:
+            raise call.error
+        # Without an error the leader has set the response before signalling
+        return cast(AGWRequestResponse, call.response).copy()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'in_flight': len(self._calls),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+        }
+
+
+def get_flight_key(agw_req: AGWRequest) -> Optional[Tuple[Any, ...]]:
+    """
+    Get the key identifying identical requests, consisting of the method, URL, headers and body of the request.
+
+    :param agw_req: The request to be sent.
+    :return: The key or None if single-flight is not enabled for the request or its method may change the resource.
+    """
+    if not agw_req.single_flight or (agw_req.method or '').upper() not in READ_METHODS:
+        return None
+    headers = tuple(sorted((k.lower(), v) for k, v in agw_req.headers.items())) if agw_req.headers else ()
+    return (
+        agw_req.method.upper(),
+        agw_req.url,
+        headers,
+        _dump(agw_req.data),
+        _dump(agw_req.json),
+        agw_req.body
+    )
+
+
+def _dump(body: Any) -> Optional[str]:
+    return json.dumps(body, sort_keys=True, default=str) if body else None
+
+
+upstream_flights = SingleFlight()
+register_stats('upstream_single_flight', upstream_flights.stats)
@@ -0,0 +1,198 @@
+from urllib.parse import urlencode
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+from bottle import response
+
+from agw_request import AGWRequestDefinition
+from agw_response import AGWResponseDefinition
+from agw_route import AGWRouteDefinition
+from gateway_request_environment_plugin import ROUTE_DATA
+from body_template import JsonTemplate
+import json_codec
+from mds_logging import getLogger, timed
+from service_exception_handler_plugin import InternalError
+from template import find_template_keys, get_template, parse_key, resolve_static, KeyPart, NO_INDEX, DYNAMIC_KEY
+from util import FrozenDict, FrozenList
+
+ll = getLogger("agw." + __name__)
+
+# Attributes of AGWRoute that are known from the route definition
+_ROUTE_DEFINITION_FIELDS = ('path', 'method')
+
+
+class _NotRouteData(Exception):
+    """Raised when a key references something else than the request data of the route."""
+    pass
+
+
+def get_route_response(route_definition: AGWRouteDefinition, request_definitions: List[AGWRequestDefinition],
+                       response_definition: AGWResponseDefinition,
+                       after_hooks: Optional[List[Any]]) -> Optional['RouteResponse']:
+    """
+    Get the response of a route that can be served without evaluating the route in GRE.
+
+    A route without requests, generators, after hooks and route plugins only returns its response definition, with
+    the references to the request data of the route (e.g. `${route.query.a}`) evaluated. Constants and the environment
+    have been substituted already when the definition was loaded.
+
+    :param route_definition: The definition of the route.
+    :param request_definitions: The request definitions of the gateway.
+    :param response_definition: The response definition of the gateway.
+    :param after_hooks: The after hooks of the gateway.
+    :return: A StaticResponse if the response does not reference anything, a RouteResponse if it only references the
+        request data of the route or None if the route has to be evaluated in GRE.
+    """
+    if request_definitions or after_hooks or route_definition.plugins or response_definition.generators:
+        return None
+    if not isinstance(response_definition.headers, dict):
+        return None
+
+    values = [getattr(response_definition, name) for name in RouteResponse.FIELDS]
+    try:
+        fields: Set[str] = set()
+        for key in find_template_keys(values):
+            fields.update(_route_fields(parse_key(key)))
+    except (ValueError, _NotRouteData):
+        return None
+
+    if not fields and not any(_is_templated(value) for value in values):
+        return StaticResponse(route_definition, response_definition)
+    return RouteResponse(route_definition, response_definition, fields)
+
+
+def _route_fields(parts: Tuple[KeyPart, ...]) -> Set[str]:
+    # The attributes of AGWRoute a parsed key references, including the ones referenced by its dynamic keys
+    if len(parts) < 2 or parts[0] != ('route', NO_INDEX, None):
+        raise _NotRouteData()
+    name = parts[1][0]
+    if name not in ROUTE_DATA and name not in _ROUTE_DEFINITION_FIELDS:
+        raise _NotRouteData()
+    fields = {name}
+    for _, kind, iok in parts[1:]:
+        if kind == DYNAMIC_KEY:
+            fields.update(_route_fields(parse_key(iok)))  # type: ignore  # dynamic keys are str
+    return fields
+
+
+def _is_templated(value: Any) -> bool:
+    if isinstance(value, str):
+        return get_template(value) is not None
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value.templated
+    return False
+
+
+def _render(value: Any, lookup: Any) -> Any:
+    # Frozen definition nodes without templates are returned as they are, the others as evaluated copies
+    if isinstance(value, str):
+        template = get_template(value)
+        return template.render(lookup) if template is not None else value
+    if isinstance(value, (FrozenDict, FrozenList)) and not value.templated:
+        return value
+    if isinstance(value, dict):
+        return {key: _render(item, lookup) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_render(item, lookup) for item in value]
+    return value
+
+
+def get_body(json_body: Optional[Dict[str, Any]], data: Optional[Dict[str, Any]],
+             text: Optional[str]) -> Union[Dict[str, Any], str]:
+    """
+    Get the body to return from the json, data or text of an evaluated response, in that order of precedence.
+
+    :return: The json as a dict (serialized by bottle), the urlencoded data or the text.
+    :raises InternalError: If the response does not contain json, data or text.
+    """
+    if json_body:
+        ll.verbose(f'returning json: {json_body}')
+        return json_body
+    elif data:
+        ret = urlencode(data)
+        ll.verbose(f'returning data: {ret}')
+        return ret
+    elif text:
+        ll.verbose(f'returning text: {text}')
+        return text
+    raise InternalError("Response does not contain json, data or text.")
+
+
+def set_status_and_headers(status: Any, headers: Dict[str, Any]) -> None:
+    response.status = status
+    response.headers.update(headers)
+    if 'Content-Length' in response.headers:
+        del response.headers['Content-Length']
+
+
+class RouteResponse:
+    """
+    Response of a route referencing only the request data of the route.
+
+    Only the request data referenced by the response is read from the request (e.g. the body is not parsed if the
+    response does not reference it), and the response is evaluated from it without creating an AGWRoute or GRE.
+    """
+
+    FIELDS = ('status', 'headers', 'json', 'data', 'text')
+
+    def __init__(self, route_definition: AGWRouteDefinition, response_definition: AGWResponseDefinition,
+                 fields: Set[str]):
+        self.definition = {name: getattr(response_definition, name) for name in self.FIELDS}
+        self.route_data = {name: getattr(route_definition, name) for name in _ROUTE_DEFINITION_FIELDS}
+        self.readers = {name: read for name, read in ROUTE_DATA.items() if name in fields}
+        self.json_template: Optional[JsonTemplate] = None
+        if response_definition.json and isinstance(response_definition.json, dict):
+            self.json_template = JsonTemplate(self.definition.pop('json'))
+
+    @timed
+    def respond(self, **kwargs: Any) -> Union[Dict[str, Any], str, bytes]:
+        route = dict(self.route_data)
+        for name, read in self.readers.items():
+            route[name] = read(kwargs)
+        root = {'route': route}
+
+        def lookup(key: str, parts: Optional[Tuple[KeyPart, ...]]) -> str:
+            value = resolve_static(root, parts) if parts is not None else None
+            if value is None:
+                raise InternalError('Gateway route reference error',
+                                    log=f'Key not found in env or not a Number or str: "{key}"')
+            return value
+
+        evaluated = {name: _render(value, lookup) for name, value in self.definition.items()}
+        set_status_and_headers(evaluated['status'], evaluated['headers'])
+        if self.json_template is not None:
+            # As bottle's JSON plugin would return the json
+            response.content_type = 'application/json'
+            return self.json_template.render(lookup)
+        return get_body(None, evaluated['data'], evaluated['text'])
+
+
+class StaticResponse(RouteResponse):
+    """
+    Response of a route that does not reference anything, returned as it is.
+
+    The body is serialized when the gateway is loaded: json is returned as pre-serialized bytes.
+    """
+
+    def __init__(self, route_definition: AGWRouteDefinition, response_definition: AGWResponseDefinition):
+        super().__init__(route_definition, response_definition, set())
+        self.content_type: Optional[str] = None
+        self.body: Union[str, bytes, None] = None
+        # In the order of precedence of get_body. If there is no body, an error is raised for every request, as it would
+        # be in GRE.
+        if response_definition.json:
+            # As bottle's JSON plugin would return it
+            self.body = json_codec.dumps(response_definition.json)
+            self.content_type = 'application/json'
+        elif response_definition.data:
+            self.body = urlencode(response_definition.data)
+        elif response_definition.text:
+            self.body = response_definition.text
+
+    @timed
+    def respond(self, **kwargs: Any) -> Union[Dict[str, Any], str, bytes]:
+        set_status_and_headers(self.definition['status'], self.definition['headers'])
+        if self.body is None:
+            raise InternalError("Response does not contain json, data or text.")
+        if self.content_type:
+            response.content_type = self.content_type
+        return self.body
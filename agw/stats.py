@@ -0,0 +1,18 @@
+from typing import Callable, Dict, Any
+
+_STATS_PROVIDERS: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+def register_stats(name: str, provider: Callable[[], Dict[str, Any]]) -> None:
+    """
+    Register a callable returning the current counters of a component.
+
+    :param name: Name of the component, used as the key in the combined stats.
+    :param provider: Callable returning a dict of counters.
+    :return: None
+    """
+    _STATS_PROVIDERS[name] = provider
+
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: provider() for name, provider in _STATS_PROVIDERS.items()}
@@ -0,0 +1,290 @@
+import numbers
+import re
+from collections import Counter
+from collections.abc import Mapping
+from functools import lru_cache
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple, Union
+
+TEMPLATE_RE = re.compile(r'\${([^}]+)}')
+
+# Kinds of the index or key in brackets of a part of a GRE key
+NO_INDEX = 0
+INDEX = 1           # requests[0]
+KEY = 2             # requests_by_name['name']
+DYNAMIC_KEY = 3     # constants.environments[route.json.environment]
+
+KeyPart = Tuple[str, int, Union[None, int, str]]
+
+
+def split_key(key: str) -> List[str]:
+    """
+    Split a GRE key into its dot separated parts, leaving dots inside square brackets intact.
+
+    :param key: The GRE key, e.g. `constants.environments[route.json.environment].mop`.
+    :return: The parts of the key.
+    :raises ValueError: If the brackets of the key do not match.
+    """
+    parts = []
+    pos = 0
+    open_sq_brackets = 0
+    for i, c in enumerate(key):
+        if c == '.' and open_sq_brackets == 0:
+            parts.append(key[pos:i])
+            pos = i + 1
+        elif c == '[':
+            open_sq_brackets += 1
+        elif c == ']':
+            open_sq_brackets -= 1
+            if open_sq_brackets < 0:
+                raise ValueError(f"Syntax error {key}")
+    parts.append(key[pos:])
+    return parts
+
+
+@lru_cache(maxsize=4096)
+def parse_key(key: str) -> Tuple[KeyPart, ...]:
+    """
+    Parse a GRE key into a tuple of (name, kind of index, index or key) parts.
+
+    The parsed keys are cached, so each distinct key of the gateway definitions is parsed only once.
+
+    :param key: The GRE key.
+    :return: The parsed parts of the key.
+    :raises ValueError: If the key is not properly formed.
+    """
+    parsed: List[KeyPart] = []
+    for part in split_key(key):
+        if not part:
+            raise ValueError(f"Empty part in {key}")
+        if part[-1] != ']':
+            parsed.append((part, NO_INDEX, None))
+            continue
+        subparts = part.split('[')
+        if len(subparts) != 2:
+            raise ValueError(f"Env array notation failed for {part} (from: {key})")
+        iok = subparts[1][0:-1]
+        if not iok:
+            raise ValueError(f"Env array notation failed for {part} (from: {key})")
+        if iok.isdigit():
+            parsed.append((subparts[0], INDEX, int(iok)))
+        elif iok[0] in ('"', "'"):
+            if iok[-1] not in ('"', "'"):
+                raise ValueError(f"Env dict notation failed for {part} (from: {key})")
+            parsed.append((subparts[0], KEY, iok[1:-1]))
+        else:
+            parsed.append((subparts[0], DYNAMIC_KEY, iok))
+    return tuple(parsed)
+
+
+class Template:
+    """
+    A string containing `${...}` references, compiled into literal segments and the parsed keys between them.
+
+    Rendering concatenates the literals and the string values of the keys, so the string is neither scanned nor its
+    keys parsed when it is evaluated.
+    """
+
+    __slots__ = ('source', 'literals', 'keys')
+
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.literals: List[str] = []
+        self.keys: List[Tuple[str, Optional[Tuple[KeyPart, ...]]]] = []
+        pos = 0
+        for m in TEMPLATE_RE.finditer(source):
+            self.literals.append(source[pos:m.start()])
+            try:
+                parsed: Optional[Tuple[KeyPart, ...]] = parse_key(m.group(1))
+            except ValueError:
+                # Reported when the template is rendered, as it would be without compiling
+                parsed = None
+            self.keys.append((m.group(1), parsed))
+            pos = m.end()
+        self.literals.append(source[pos:])
+
+    def render(self, lookup: Callable[[str, Optional[Tuple[KeyPart, ...]]], str]) -> str:
+        """
+        Render the template.
+
+        :param lookup: Function returning the string value of a key, given the key and its parsed parts (None if the
+            key could not be parsed).
+        :return: The rendered string.
+        """
+        literals = self.literals
+        out = [literals[0]]
+        for i, (key, parsed) in enumerate(self.keys):
+            out.append(lookup(key, parsed))
+            out.append(literals[i + 1])
+        return ''.join(out)
+
+    def fold(self, resolve: Callable[[str, Optional[Tuple[KeyPart, ...]]], Optional[str]]) -> str:
+        """
+        Substitute the keys whose values are known at load time.
+
+        :param resolve: Function returning the source to substitute a key with, given the key and its parsed parts, or
+            None if the value of the key is not known at load time.
+        :return: The source of the template with the known values substituted.
+        """
+        literals = self.literals
+        out = [literals[0]]
+        for i, (key, parsed) in enumerate(self.keys):
+            value = resolve(key, parsed)
+            out.append('${' + key + '}' if value is None else value)
+            out.append(literals[i + 1])
+        return ''.join(out)
+
+
+_TEMPLATES: Dict[str, Template] = {}
+
+
+def compile_templates(node: Any) -> None:
+    """
+    Compile all templated strings found in given definition node.
+
+    :param node: A gateway definition, or a part of it.
+    :return: None
+    """
+    if isinstance(node, str):
+        if node not in _TEMPLATES and '${' in node and TEMPLATE_RE.search(node):
+            _TEMPLATES[node] = Template(node)
+    elif isinstance(node, dict):
+        for value in node.values():
+            compile_templates(value)
+    elif isinstance(node, list):
+        for value in node:
+            compile_templates(value)
+
+
+def get_template(value: str) -> Optional[Template]:
+    """
+    Get the compiled template of a string.
+
+    Strings not compiled at load time (e.g. produced by substituting include arguments) are compiled on the fly without
+    being stored.
+
+    :param value: The string.
+    :return: The compiled template or None if the string does not contain any `${...}` references.
+    """
+    template = _TEMPLATES.get(value)
+    if template is None and '${' in value and TEMPLATE_RE.search(value):
+        template = Template(value)
+    return template
+
+
+def fold_templates(node: Any, resolve: Callable[[str, Optional[Tuple[KeyPart, ...]]], Optional[str]]) -> Any:
+    """
+    Substitute the keys whose values are known at load time in all templated strings of given definition node.
+
+    :param node: A gateway definition, or a part of it. It is not modified, as it may be shared (e.g. an include).
+    :param resolve: See `Template.fold`.
+    :return: A copy of the node with the known values substituted.
+    """
+    if isinstance(node, str):
+        template = get_template(node)
+        return template.fold(resolve) if template is not None else node
+    if isinstance(node, dict):
+        return {key: fold_templates(value, resolve) for key, value in node.items()}
+    if isinstance(node, list):
+        return [fold_templates(value, resolve) for value in node]
+    return node
+
+
+def find_template_keys(node: Any) -> Iterator[str]:
+    """Yield the keys of all `${...}` templates found in the strings of given node."""
+    if isinstance(node, str):
+        for m in TEMPLATE_RE.finditer(node):
+            yield m.group(1)
+    elif isinstance(node, dict):
+        for value in node.values():
+            yield from find_template_keys(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from find_template_keys(value)
+
+
+def repeated_keys(keys: Iterable[str]) -> FrozenSet[str]:
+    """
+    Get the keys occurring more than once, e.g. in the templates of a definition node, whose values are worth
+    memoizing when the node is evaluated.
+
+    :param keys: Template keys, e.g. from `find_template_keys`.
+    :return: The repeated keys.
+    """
+    return frozenset(key for key, count in Counter(keys).items() if count > 1)
+
+
+# Errors raised when a key cannot be resolved from static data
+_NOT_STATIC = (KeyError, IndexError, TypeError, ValueError)
+
+
+def resolve_static(root: Mapping, parts: Tuple[KeyPart, ...]) -> Optional[str]:
+    """
+    Resolve the string value of a parsed key from static data, e.g. the constants.
+
+    :param root: Mapping of the roots of the keys to their data, e.g. `{'constants': constants}`.
+    :param parts: The parsed key.
+    :return: The string value of the key, or None if the key cannot be resolved from the data (it does not exist,
+        its dynamic key cannot be resolved from the data or its value is not a str or a Number).
+    """
+    try:
+        value = _static_value(root, root, parts)
+    except _NOT_STATIC:
+        return None
+    return str(value) if isinstance(value, (str, numbers.Number)) else None
+
+
+def index_static(root: Mapping, parts: Tuple[KeyPart, ...]) -> Optional[Tuple[str, Dict[Any, str]]]:
+    """
+    Index a key with a dynamic key into static data by the possible values of the dynamic key.
+
+    E.g. `constants.environments[route.json.environment].mop` is indexed into the `mop` of each environment, so that
+    the key is resolved with a single lookup once `route.json.environment` is known.
+
+    :param root: See `resolve_static`.
+    :param parts: The parsed key.
+    :return: The dynamic key and the string values of the key by the values of the dynamic key, or None if the key
+        does not have exactly one dynamic key or it does not point to a dict in the data.
+    """
+    dynamic = [i for i, (_, kind, _) in enumerate(parts) if kind == DYNAMIC_KEY]
+    if len(dynamic) != 1:
+        return None
+    d = dynamic[0]
+    name, _, dynamic_key = parts[d]
+    if not isinstance(dynamic_key, str):
+        return None
+    try:
+        node = _static_value(root, root, parts[:d] + ((name, NO_INDEX, None),))
+    except _NOT_STATIC:
+        return None
+    if not isinstance(node, Mapping):
+        return None
+
+    index = {}
+    for key, item in node.items():
+        try:
+            value = _static_value(root, item, parts[d + 1:]) if d + 1 < len(parts) else item
+        except _NOT_STATIC:
+            continue
+        if isinstance(value, (str, numbers.Number)):
+            index[key] = str(value)
+    return dynamic_key, index
+
+
+def _static_value(root: Mapping, node: Any, parts: Tuple[KeyPart, ...]) -> Any:
+    # Traverses the data like GatewayRequestEnvironment.get, raising one of _NOT_STATIC if the key cannot be resolved
+    for name, kind, iok in parts:
+        if not isinstance(node, Mapping):
+            raise KeyError(name)
+        node = node[name]
+        if kind == NO_INDEX:
+            continue
+        key = _static_value(root, root, parse_key(str(iok))) if kind == DYNAMIC_KEY else iok
+        if isinstance(key, int):
+            if not isinstance(node, list):
+                raise KeyError(key)
+            node = node[key]
+        elif isinstance(node, Mapping):
+            node = node[key]
+        else:
+            raise KeyError(key)
+    return node
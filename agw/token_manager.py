@@ -0,0 +1,270 @@
+import os
+import random  # nosec
+import time
+from threading import Event, Lock, Thread
+from typing import Any, Dict, Optional, Tuple, cast
+
+import requests
+
+import settings
+from deadline import default_timeout
+from mds_logging import getLogger, timed
+from service_exception_handler_plugin import InternalError
+from settings import get_required_setting
+from shared_cache import Cache, get_cache, CROSS_PROCESS
+from stats import register_stats
+from upstream_pool import upstream_pool
+
+ll = getLogger("agw." + __name__)
+
+# Seconds to wait before retrying a failed background refresh
+_RETRY_INTERVAL = 10
+
+
+class _Refresh:
+    def __init__(self) -> None:
+        self.done = Event()
+        self.token: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+
+class TokenManager:
+    """
+    OAuth 2.0 client credentials access token of the gateway.
+
+    The token is fetched from the token endpoint of the OpenID configuration when first requested, and refreshed in a
+    background thread `refresh_margin` seconds (at most half of its lifetime) before it expires, as told by the
+    `expires_in` of the token response, so that requests do not have to wait for a refresh. Concurrent callers needing
+    a new token share a single fetch in flight. If the token endpoint does not return `expires_in`, the token is only
+    renewed when it is rejected (see `renew`).
+
+    The refresh thread is started in each worker when the token is first requested, as threads do not survive a fork.
+    With a cache shared by the workers, a token fetched by one worker is used by the others, and the refresh times of
+    the workers are spread so that the first one refreshes the token for the others.
+    """
+
+    def __init__(self, name: str, openid_configuration: str, client_id: str, secret: str, scope: str,
+                 refresh_margin: float, shared: Optional[Cache] = None) -> None:
+        """
+        :param name: Name of the token manager, used for registering its stats.
+        :param openid_configuration: URL of the OpenID configuration of the identity provider.
+        :param client_id: Client id of the gateway.
+        :param secret: Client secret of the gateway.
+        :param scope: Scope of the requested token.
+        :param refresh_margin: Seconds before the expiry of the token to refresh it.
+        :param shared: Optional cache shared with other workers.
+        """
+        self.openid_configuration = openid_configuration
+        self.client_id = client_id
+        self.secret = secret
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self.shared = shared
+        self._lock = Lock()
+        self._token_endpoint: Optional[str] = None
+        self._token: Optional[str] = None
+        self._expires_at: Optional[float] = None
+        self._refresh_at: Optional[float] = None
+        self._refresh: Optional[_Refresh] = None
+        self._refresher_pid: Optional[int] = None
+        self._changed = Event()
+        self.fetches = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.renewals = 0
+        register_stats(name, self.stats)
+
+    def get_token(self) -> str:
+        """
+        Get a valid token, fetching one if there is none or it has expired.
+
+        :return: The access token.
+        :raises InternalError: If the token has to be fetched and the fetch fails.
+        """
+        self._start_refresher()
+        token = self._token
+        if token is not None and (self._expires_at is None or time.monotonic() < self._expires_at):
+            return token
+        return self.refresh()
+
+    def renew(self, rejected_token: str) -> str:
+        """
+        Get a new token to replace a token rejected by a server (e.g. with 401). If the token has already been
+        replaced, the current token is returned without fetching a new one.
+
+        :param rejected_token: The rejected token.
+        :return: The access token.
+        :raises InternalError: If a new token has to be fetched and the fetch fails.
+        """
+        token = self._token
+        if token is not None and token != rejected_token:
+            return token
+        self.renewals += 1
+        return self.refresh()
+
+    def refresh(self) -> str:
+        """
+        Fetch a new token, or wait for the fetch in flight.
+
+        :return: The new access token.
+        :raises InternalError: If the fetch fails.
+        """
+        with self._lock:
+            call = self._refresh
+            leader = call is None
+            if call is None:
+                call = self._refresh = _Refresh()
+            else:
+                self.coalesced += 1
+
+        if leader:
+            try:
+                token = call.token = self._fetch()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    self._refresh = None
+                call.done.set()
+            return token
+
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        # Without an error the leader has set the token before signalling
+        return cast(str, call.token)
+
+    def _fetch(self) -> str:
+        shared = self.shared.get(self.client_id) if self.shared is not None else None
+        if shared is not None and shared['access_token'] != self._token and shared['refresh_at'] > time.time():
+            # Fetched by another worker
+            now = time.time()
+            self._set_token(shared['access_token'], shared['expires_at'] - now, shared['refresh_at'] - now)
+            return shared['access_token']
+
+        token, expires_in = self._request_token()
+        if expires_in is None:
+            self._set_token(token, None, None)
+            return token
+        refresh_in = expires_in - min(self.refresh_margin, expires_in / 2)
+        self._set_token(token, expires_in, refresh_in)
+        if self.shared is not None:
+            now = time.time()
+            self.shared.put(self.client_id, {'access_token': token, 'expires_at': now + expires_in,
+                                             'refresh_at': now + refresh_in}, expires_in)
+        return token
+
+    def _set_token(self, token: str, expires_in: Optional[float], refresh_in: Optional[float]) -> None:
+        now = time.monotonic()
+        if expires_in is not None and refresh_in is not None:
+            self._expires_at = now + expires_in
+            self._refresh_at = now + refresh_in
+            if self.shared is not None:
+                # Spread the refreshes of the workers sharing the token, the first one refreshes it for the others
+                self._refresh_at -= random.uniform(0, (expires_in - refresh_in) / 2)  # nosec
+        else:
+            self._expires_at = self._refresh_at = None
+        self._token = token
+        self._changed.set()
+
+    @timed
+    def _request_token(self) -> Tuple[str, Optional[float]]:
+        # Gets a token and its lifetime, if known, from the token endpoint
+        self.fetches += 1
+        try:
+            if not self._token_endpoint:
+                self._token_endpoint = self._fetch_token_endpoint()
+            token_response = upstream_pool.get_session(self._token_endpoint).post(
+                self._token_endpoint,
+                headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                auth=requests.auth.HTTPBasicAuth(self.client_id, self.secret),
+                data=f"grant_type=client_credentials&scope={self.scope}",
+                timeout=default_timeout()
+            )
+            ll.debug(f'Token endpoint response status={token_response.status_code}')
+            token_response.raise_for_status()
+            json_response = token_response.json()
+            if 'access_token' not in json_response:
+                raise InternalError('access_token is not present in token endpoint response')
+        except requests.RequestException as e:
+            self.failures += 1
+            raise InternalError(f'Cannot get AGW token: {e}')
+        except ValueError:
+            self.failures += 1
+            raise InternalError('Did not receive JSON response from token endpoint')
+        except InternalError:
+            self.failures += 1
+            raise
+
+        expires_in = json_response.get('expires_in')
+        if isinstance(expires_in, (int, float)) and expires_in > 0:
+            return json_response['access_token'], expires_in
+        return json_response['access_token'], None
+
+    def _fetch_token_endpoint(self) -> str:
+        try:
+            ll.info(f"Fetching openid configuration from '{self.openid_configuration}'")
+            r = upstream_pool.get_session(self.openid_configuration).get(self.openid_configuration,
+                                                                         timeout=default_timeout())
+            r.raise_for_status()
+            return r.json()['token_endpoint']
+        except requests.RequestException as e:
+            raise InternalError(f"Couldn't connect to IDP openid-configuration endpoint: {e}")
+        except (KeyError, TypeError, ValueError) as e:
+            raise InternalError(f"Error parsing OpenId configuration: {e}")
+
+    def _start_refresher(self) -> None:
+        if self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+            Thread(target=self._refresh_periodically, name='agw-token-refresh', daemon=True).start()
+
+    def _refresh_periodically(self) -> None:
+        while True:
+            refresh_at = self._refresh_at
+            timeout = refresh_at - time.monotonic() if refresh_at is not None else None
+            if timeout is None or timeout > 0:
+                # Woken up early when a new token is fetched, to wait for its refresh time instead
+                self._changed.wait(timeout)
+                self._changed.clear()
+                continue
+            try:
+                self.refresh()
+            except InternalError as e:
+                ll.warning(f'AGW token refresh failed, retrying in {_RETRY_INTERVAL} seconds: {e}')
+                self._refresh_at = time.monotonic() + _RETRY_INTERVAL
+
+    def stats(self) -> Dict[str, Any]:
+        expires_at = self._expires_at
+        return {
+            'fetches': self.fetches,
+            'failures': self.failures,
+            'coalesced': self.coalesced,
+            'renewals': self.renewals,
+            'expires_in': round(expires_at - time.monotonic()) if expires_at is not None else None,
+        }
+
+
+_MOP_TOKEN_MANAGER: Optional[TokenManager] = None
+
+
+def get_mop_token_manager() -> TokenManager:
+    """
+    Get the token manager of the AGW token used for calling MOP, shared by the MOP plugin and after hooks.
+
+    :raises MissingEnvironmentVariableError: If the identity provider settings are missing.
+    """
+    global _MOP_TOKEN_MANAGER
+    if _MOP_TOKEN_MANAGER is None:
+        _MOP_TOKEN_MANAGER = TokenManager(
+            'mop_agw_token',
+            get_required_setting('MOP_REQUEST_TICKET_VALIDATION_IDPROVIDER_OPENID_CONFIGURATION'),
+            get_required_setting('MOP_REQUEST_TICKET_VALIDATION_IDPROVIDER_CLIENT_ID'),
+            get_required_setting('MOP_REQUEST_TICKET_VALIDATION_IDPROVIDER_SECRET', secret=True),
+            'agw', settings.MOP_REQUEST_TICKET_VALIDATION_AGW_TOKEN_REFRESH_MARGIN,
+            get_cache('mop_agw_token_shared', 64 * 1024) if CROSS_PROCESS else None)
+    return _MOP_TOKEN_MANAGER
@@ -0,0 +1,215 @@
+import random  # nosec
+import time
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
+from threading import Lock
+from typing import Any, Callable, Deque, Dict, Optional
+
+import bottle
+import requests
+
+from agw_request import AGWRequest, AGWRequestResponse
+from deadline import Deadline
+from http_method import IDEMPOTENT_METHODS
+from mds_logging import getLogger
+from service_exception_handler_plugin import InternalError, GatewayTimeoutError
+from stats import register_stats
+from upstream_pool import upstream_pool, run_in_request_context
+
+ll = getLogger("agw." + __name__)
+
+
+DEFAULT_RETRY_STATUSES = (502, 503, 504)
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF = 0.1
+DEFAULT_MAX_BACKOFF = 2.0
+DEFAULT_HEDGE_MIN_SAMPLES = 20
+
+# Latency samples kept for each request definition with a hedge policy
+_SAMPLES = 100
+
+Send = Callable[[AGWRequest, Deadline], AGWRequestResponse]
+
+
+def validate_retry_policy(policy: Any) -> None:
+    """
+    Validate the `retry` block of a request definition.
+
+    :param policy: The value of the `retry` key of the request definition.
+    :return: None
+    :raises InternalError: If the policy is not valid.
+    """
+    if not isinstance(policy, dict):
+        raise InternalError("Request 'retry' definition should be a dict")
+    _validate_number(policy, 'retry', 'max_attempts', integer=True, minimum=1)
+    _validate_number(policy, 'retry', 'backoff')
+    _validate_number(policy, 'retry', 'max_backoff')
+    statuses = policy.get('statuses', [])
+    if not isinstance(statuses, list) or not all(isinstance(s, int) for s in statuses):
+        raise InternalError("Request 'retry' definition 'statuses' should be a list of status codes")
+
+
+def validate_hedge_policy(policy: Any) -> None:
+    """
+    Validate the `hedge` block of a request definition.
+
+    :param policy: The value of the `hedge` key of the request definition.
+    :return: None
+    :raises InternalError: If the policy is not valid.
+    """
+    if not isinstance(policy, dict):
+        raise InternalError("Request 'hedge' definition should be a dict")
+    if 'percentile' not in policy and 'delay' not in policy:
+        raise InternalError("Request 'hedge' definition should have a 'percentile' or a 'delay'")
+    _validate_number(policy, 'hedge', 'percentile', maximum=100)
+    _validate_number(policy, 'hedge', 'delay')
+    _validate_number(policy, 'hedge', 'min_samples', integer=True, minimum=1)
+
+
+def _validate_number(policy: Dict[str, Any], name: str, key: str, integer: bool = False, minimum: float = 0,
+                     maximum: Optional[float] = None) -> None:
+    if key not in policy:
+        return
+    value = policy[key]
+    if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)) or value < minimum or \
+            (maximum is not None and value > maximum):
+        raise InternalError(f"Request '{name}' definition '{key}' should be a "
+                            f"{'n integer' if integer else ' number'} of at least {minimum}"
+                            f"{f' and at most {maximum}' if maximum is not None else ''}")
+
+
+class UpstreamPolicy:
+    """
+    Retries and hedging of idempotent upstream requests.
+
+    A request with a `retry` policy is sent again after a connection error, a timeout or a response with one of the
+    retried statuses, waiting an exponentially growing, randomized (full jitter) time between the attempts. A request
+    with a `hedge` policy gets a duplicate request sent if no response has been received after the given percentile of
+    the recent latencies of the request definition (or after a fixed delay), and the response received first is used.
+    All attempts are bounded by the deadline of the route: no attempt or duplicate is started if the remaining time
+    budget would not suffice.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._latencies: Dict[int, Deque[float]] = {}
+        self.retries = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def send(self, agw_req: AGWRequest, deadline: Deadline, send: Send) -> AGWRequestResponse:
+        """
+        Send a request according to the retry and hedge policies of its definition.
+
+        :param agw_req: The request to send.
+        :param deadline: Deadline of the route.
+        :param send: Function sending the request once.
+        :return: The response.
+        """
+        idempotent = (agw_req.method or '').upper() in IDEMPOTENT_METHODS
+
+        def attempt() -> AGWRequestResponse:
+            if agw_req.hedge and idempotent:
+                return self._send_hedged(agw_req, deadline, send)
+            return send(agw_req, deadline)
+
+        if agw_req.retry is None or not idempotent:
+            return attempt()
+
+        policy = agw_req.retry
+        max_attempts = policy.get('max_attempts', DEFAULT_MAX_ATTEMPTS)
+        statuses = policy.get('statuses', DEFAULT_RETRY_STATUSES)
+        attempts = 0
+        while True:
+            attempts += 1
+            agw_resp: Optional[AGWRequestResponse] = None
+            try:
+                agw_resp = attempt()
+                if agw_resp.status not in statuses or attempts == max_attempts:
+                    return agw_resp
+                reason = f'status {agw_resp.status}'
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempts == max_attempts:
+                    raise
+                reason = str(e)
+
+            backoff = random.uniform(0, min(policy.get('max_backoff', DEFAULT_MAX_BACKOFF),  # nosec
+                                            policy.get('backoff', DEFAULT_BACKOFF) * 2 ** (attempts - 1)))
+            remaining = deadline.remaining()
+            if remaining is not None and remaining <= backoff:
+                if agw_resp is not None:
+                    return agw_resp
+                raise GatewayTimeoutError('Gateway timeout', log=f'Route deadline of {deadline.seconds}s does not '
+                                                                 f'allow retrying request to {agw_req.url}: {reason}')
+            ll.info(f"Retrying request to {agw_req.url} in {backoff:.3f}s ({reason}), "
+                    f"attempt {attempts + 1}/{max_attempts}")
+            self.retries += 1
+            time.sleep(backoff)
+
+    def _send_hedged(self, agw_req: AGWRequest, deadline: Deadline, send: Send) -> AGWRequestResponse:
+        policy = agw_req.hedge
+        latencies = self._get_latencies(policy)
+        delay = self._hedge_delay(policy, latencies)
+        remaining = deadline.remaining()
+        if delay is None or (remaining is not None and remaining <= delay):
+            return self._timed_send(latencies, agw_req, deadline, send)
+
+        executor = upstream_pool.get_hedge_executor()
+        environ = bottle.request.environ
+        primary = executor.submit(run_in_request_context, environ, self._timed_send, latencies, agw_req, deadline,
+                                  send)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        ll.debug(f"No response from {agw_req.url} in {delay:.3f}s, sending a hedged request")
+        self.hedged += 1
+        hedge = executor.submit(run_in_request_context, environ, self._timed_send, latencies, agw_req, deadline, send)
+        pending = {primary, hedge}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, timeout=deadline.remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                raise GatewayTimeoutError('Gateway timeout', log=f'Route deadline of {deadline.seconds}s expired '
+                                                                 f'while waiting for hedged request to {agw_req.url}')
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.hedge_wins += 1
+                    return future.result()
+                error = future.exception()
+        raise error  # type: ignore
+
+    @staticmethod
+    def _timed_send(latencies: Deque[float], agw_req: AGWRequest, deadline: Deadline,
+                    send: Send) -> AGWRequestResponse:
+        start = time.monotonic()
+        agw_resp = send(agw_req, deadline)
+        latencies.append(time.monotonic() - start)
+        return agw_resp
+
+    def _get_latencies(self, policy: Dict[str, Any]) -> Deque[float]:
+        # Policies are shared by all requests of a definition, so they identify the definition
+        latencies = self._latencies.get(id(policy))
+        if latencies is None:
+            with self._lock:
+                latencies = self._latencies.setdefault(id(policy), deque(maxlen=_SAMPLES))
+        return latencies
+
+    @staticmethod
+    def _hedge_delay(policy: Dict[str, Any], latencies: Deque[float]) -> Optional[float]:
+        if 'percentile' in policy and len(latencies) >= policy.get('min_samples', DEFAULT_HEDGE_MIN_SAMPLES):
+            samples = sorted(latencies)
+            return samples[min(len(samples) - 1, int(len(samples) * policy['percentile'] / 100))]
+        return policy.get('delay')
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'retries': self.retries,
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+        }
+
+
+upstream_policy = UpstreamPolicy()
+register_stats('upstream_policy', upstream_policy.stats)
@@ -0,0 +1,151 @@
+import os
+import time
+import weakref
+from http.cookiejar import DefaultCookiePolicy
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Dict, Optional, Tuple, Any, Callable
+from urllib.parse import urlsplit
+
+import bottle
+import requests
+from requests.adapters import HTTPAdapter
+
+import settings
+from mds_logging import getLogger
+from stats import register_stats
+
+ll = getLogger("agw." + __name__)
+
+
+PoolKey = Tuple[str, str, int, bool]
+
+
+def run_in_request_context(environ: Dict, fn: Callable, *args) -> Any:
+    # Bind the request of the calling thread so that logging (request id) works in executor threads
+    bottle.request.bind(environ)
+    return fn(*args)
+
+
+class UpstreamPool:
+    """
+    Per worker pool of keep-alive HTTP clients for upstream requests.
+
+    A `requests.Session` is kept for each scheme+host (and pool options) combination, so that consecutive requests to
+    the same host reuse already opened TCP/TLS connections. Sessions are never shared between processes: if the pool is
+    used in a forked worker, the sessions inherited from the parent are dropped. The pool also owns the bounded executor
+    used for sending independent requests of a gateway concurrently.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pid = os.getpid()
+        self._sessions: Dict[PoolKey, requests.Session] = {}
+        self._last_used: Dict[PoolKey, float] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._hedge_executor: Optional[ThreadPoolExecutor] = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get_session(self, url: str, pool_options: Optional[Dict[str, Any]] = None) -> requests.Session:
+        """
+        Get a pooled session for the host of the given URL.
+
+        :param url: The URL to be requested with the session.
+        :param pool_options: Optional per request definition overrides for 'size' and 'keep_alive'.
+        :return: A session with connection pooling configured.
+        """
+        pool_options = pool_options if pool_options else {}
+        size = int(pool_options.get('size', settings.UPSTREAM_POOL_SIZE))
+        keep_alive = bool(pool_options.get('keep_alive', settings.UPSTREAM_KEEP_ALIVE))
+        parts = urlsplit(url)
+        key = (parts.scheme.lower(), parts.netloc.lower(), size, keep_alive)
+
+        with self._lock:
+            self._check_pid()
+            now = time.monotonic()
+            session = self._sessions.get(key)
+            if session is not None and now - self._last_used[key] > settings.UPSTREAM_KEEP_ALIVE_TIMEOUT:
+                # Not closed here, as another thread may still be using the session. Its connections are closed when
+                # the session is no longer referenced.
+                ll.debug(f"Dropping idle upstream session for {key[0]}://{key[1]}")
+                session = None
+                self.expired += 1
+
+            if session is None:
+                self.misses += 1
+                session = self._create_session(size, keep_alive)
+                self._sessions[key] = session
+            else:
+                self.hits += 1
+            self._last_used[key] = now
+            return session
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        """
+        Get the bounded executor used for sending independent upstream requests concurrently.
+
+        :return: The executor of this worker.
+        """
+        with self._lock:
+            self._check_pid()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=settings.UPSTREAM_MAX_PARALLEL_REQUESTS,
+                                                    thread_name_prefix='agw-upstream')
+            return self._executor
+
+    def get_hedge_executor(self) -> ThreadPoolExecutor:
+        """
+        Get the executor used for sending hedged requests.
+
+        Hedged requests are waited for by threads of the executor returned by `get_executor`, so they are run by a
+        separate executor to avoid exhausting it.
+
+        :return: The hedge executor of this worker.
+        """
+        with self._lock:
+            self._check_pid()
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(max_workers=2 * settings.UPSTREAM_MAX_PARALLEL_REQUESTS,
+                                                          thread_name_prefix='agw-hedge')
+            return self._hedge_executor
+
+    def _check_pid(self) -> None:
+        if self._pid != os.getpid():
+            # Forked after sessions were created, connections and threads of the parent cannot be used.
+            self._pid = os.getpid()
+            self._sessions = {}
+            self._last_used = {}
+            self._executor = None
+            self._hedge_executor = None
+
+    @staticmethod
+    def _create_session(size: int, keep_alive: bool) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=settings.UPSTREAM_POOL_BLOCK)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        # The session is shared by the requests of all users, the cookies set for one must not be sent for the others
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        weakref.finalize(session, _close_adapter, adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pools': len(self._sessions),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+        }
+
+
+def _close_adapter(adapter: HTTPAdapter) -> None:
+    # Closes the connections of a session that is no longer referenced
+    adapter.close()
+
+
+upstream_pool = UpstreamPool()
+register_stats('upstream_pool', upstream_pool.stats)
@@ -1,13 +1,135 @@
 import os
 import base64
 import json
+from collections.abc import Mapping
 from pathlib import Path
+from typing import Any, Iterator
 
 
 class EnvironmentReferenceError(Exception):
     pass
 
 
+class ReadOnlyMapping(Mapping):
+    """
+    Read-only view of a mapping.
+
+    Lookups are delegated to the wrapped mapping, so e.g. a wrapped `CaseInsensitiveDict` keeps its case-insensitivity.
+    """
+
+    def __init__(self, mapping: Mapping) -> None:
+        self._mapping = mapping
+
+    def __getitem__(self, key: Any) -> Any:
+        return self._mapping[key]
+
+    def __iter__(self) -> Iterator:
+        return iter(self._mapping)
+
+    def __len__(self) -> int:
+        return len(self._mapping)
+
+    def __repr__(self) -> str:
+        return repr(dict(self._mapping))
+
+
+def _immutable(self: Any, *args: Any, **kwargs: Any) -> None:
+    raise TypeError(f"'{type(self).__name__}' object is immutable")
+
+
+def _may_contain_templates(value: Any) -> bool:
+    if isinstance(value, str):
+        return '${' in value
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value.templated
+    return isinstance(value, (dict, list))
+
+
+class FrozenDict(dict):
+    """
+    Immutable dict of a gateway definition.
+
+    Gateway definitions are frozen when they are loaded and shared by all requests. Being a dict, a frozen node is read,
+    iterated and serialized like any other, but modifying it raises a TypeError: a node that a request needs to modify
+    is replaced with a mutable copy of it instead (see `thaw`).
+
+    `templated` tells if any string in the node or its children may contain templates, so that evaluating the templates
+    of a request can skip the nodes without them.
+    """
+
+    __slots__ = ('templated',)
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.templated = any(_may_contain_templates(value) for value in self.values())
+
+    __setitem__ = __delitem__ = __ior__ = _immutable  # type: ignore[assignment]
+    clear = pop = popitem = setdefault = update = _immutable  # type: ignore[assignment]
+
+    def __copy__(self) -> 'FrozenDict':
+        return self
+
+    def __deepcopy__(self, memo: Any) -> 'FrozenDict':
+        return self
+
+    def __reduce__(self) -> Any:
+        return FrozenDict, (dict(self),)
+
+
+class FrozenList(list):
+    """
+    Immutable list of a gateway definition, see `FrozenDict`.
+    """
+
+    __slots__ = ('templated',)
+
+    def __init__(self, *args: Any) -> None:
+        super().__init__(*args)
+        self.templated = any(_may_contain_templates(value) for value in self)
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable  # type: ignore[assignment]
+    append = clear = extend = insert = pop = remove = reverse = sort = _immutable  # type: ignore[assignment]
+
+    def __copy__(self) -> 'FrozenList':
+        return self
+
+    def __deepcopy__(self, memo: Any) -> 'FrozenList':
+        return self
+
+    def __reduce__(self) -> Any:
+        return FrozenList, (list(self),)
+
+
+def freeze(node: Any) -> Any:
+    """
+    Get an immutable copy of given definition node, with all its dicts and lists frozen.
+
+    :param node: The node, e.g. a parsed gateway definition.
+    :return: The frozen node.
+    """
+    if isinstance(node, (FrozenDict, FrozenList)):
+        return node
+    if isinstance(node, dict):
+        return FrozenDict((key, freeze(value)) for key, value in node.items())
+    if isinstance(node, list):
+        return FrozenList(freeze(value) for value in node)
+    return node
+
+
+def thaw(node: Any) -> Any:
+    """
+    Get a mutable shallow copy of a frozen node. The children of the copy are still frozen.
+
+    :param node: The node.
+    :return: The copy, or the node itself if it is not frozen.
+    """
+    if isinstance(node, FrozenDict):
+        return dict(node)
+    if isinstance(node, FrozenList):
+        return list(node)
+    return node
+
+
 def decode_base64(input_str: str) -> str:
     base64_bytes = input_str.encode("utf-8")
     message_bytes = base64.b64decode(base64_bytes)
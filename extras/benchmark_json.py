@@ -0,0 +1,59 @@
+"""
+Microbenchmark of the JSON codecs of `json_codec` on payloads shaped like the ones the gateway handles.
+
+Compares encoding each payload with the standard library and with orjson (if installed), and decoding it with the
+standard library (bodies are always decoded with it).
+
+Usage (from the repository root): python extras/benchmark_json.py [iterations]
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'agw'))
+os.environ.setdefault('AGW_GATEWAYS_SEARCH_PATH', 'gateways')
+
+import json_codec  # noqa: E402
+
+IDENTIFIER = {'id': '170677-924F', 'id_type': 'ssn', 'country': 'FIN', 'id_source': 'Signicat_FTN',
+              'first_name': 'Helmi Aurora', 'last_name': 'Nieminen', 'verified_at': '2021-01-29T10:18:07.436398+00:00'}
+
+PAYLOADS = {
+    # Body of a route request
+    'route request': {'environment': 'beta', 'predefined_payload': 'default', 'query': {'lang': 'fi', 'page': 1}},
+    # Response of the request ticket introspection
+    'introspection': {'active': True, 'access_item_uuid': 'a7c5e2b4-3f0e-4d8a-9c1b-2e6f7a8b9c0d',
+                      'identifiers': [dict(IDENTIFIER, id=f'{i:06d}-924F') for i in range(5)]},
+    # Provider response listing processing records
+    'records': {'count': 100, 'next': None, 'results': [
+        {'uuid': f'{i:08d}-3f0e-4d8a-9c1b-2e6f7a8b9c0d', 'name': f'Record {i}', 'description': 'Käsittelytoimi ' * 5,
+         'created': '2021-01-29T10:18:07.436398+00:00', 'active': i % 2 == 0, 'version': i, 'score': i / 3,
+         'tags': ['consent', 'marketing'], 'controller': {'name': 'Controller Oy', 'country': 'FIN'}}
+        for i in range(100)]},
+    # Error response of the gateway
+    'error': {'error': 'internal_error', 'description': 'Unexpected error', 'request_id': 'abc123'},
+}
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    columns = ['json loads', 'json dumps']
+    if json_codec.orjson is not None:
+        columns.append('orjson dumps')
+    else:
+        print('orjson is not installed, benchmarking the standard library only')
+
+    print(f"{'payload':<16}{'bytes':>8}" + ''.join(f'{name:>16}' for name in columns))
+    for name, payload in PAYLOADS.items():
+        encoded = json.dumps(payload).encode('utf-8')
+        runs = [lambda: json_codec._json_loads(encoded), lambda: json_codec._json_dumps(payload)]
+        if json_codec.orjson is not None:
+            assert json_codec.loads(json_codec._orjson_dumps(payload)) == payload
+            runs.append(lambda: json_codec._orjson_dumps(payload))
+        times = [timeit.timeit(run, number=iterations) / iterations * 1e6 for run in runs]
+        print(f"{name:<16}{len(encoded):>8}" + ''.join(f'{t:>13.2f} us' for t in times))
+
+
+if __name__ == '__main__':
+    main()
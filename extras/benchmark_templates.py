@@ -0,0 +1,70 @@
+"""
+Microbenchmark of `${...}` template substitution.
+
+Compares substituting the templates of a string with `str.replace` for each match, as the gateway used to, to
+rendering the template compiled at load time, and to evaluating the definition node containing it in GRE, memoizing
+the values of all its keys or only of the keys it references more than once (as the gateway does).
+
+Usage (from the repository root): python extras/benchmark_templates.py [iterations]
+"""
+import os
+import re
+import sys
+import timeit
+from typing import FrozenSet
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'agw'))
+os.environ.setdefault('AGW_GATEWAYS_SEARCH_PATH', 'gateways')
+os.environ.setdefault('AGW_LOGGING_LEVEL', 'ERROR')
+
+from agw_route import AGWRoute, AGWRouteDefinition  # noqa: E402
+from gateway_request_environment_plugin import GatewayRequestEnvironment  # noqa: E402
+from template import find_template_keys, get_template, repeated_keys  # noqa: E402
+from util import FrozenDict, freeze  # noqa: E402
+
+
+CASES = {
+    'url': 'https://${route.json.host}/api/v2/records/${route.dynamic.id}?lang=${route.query.lang}',
+    'long text': ' '.join(f'field {i}: ${{route.json.values[{i}]}} lorem ipsum dolor sit amet' for i in range(40)),
+    'repeated keys': ' '.join('${route.json.token}' for _ in range(20)),
+}
+
+
+def replace_each(gre: GatewayRequestEnvironment, value: str) -> str:
+    for m in re.finditer(r'\${([^}]+)}', value):
+        value = value.replace(m.group(0), str(gre.get(m.group(1))))
+    return value
+
+
+def render(gre: GatewayRequestEnvironment, value: str) -> str:
+    return get_template(value).render(gre._lookup_template_value)  # type: ignore
+
+
+def evaluate(gre: GatewayRequestEnvironment, node: FrozenDict, keys: FrozenSet[str]) -> str:
+    # Takes the frozen definition node containing the string, as it is frozen at load time, and the memoized keys
+    return gre._evaluate_memoized(node, keys)['value']
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    route = AGWRoute(AGWRouteDefinition(path='/records/<id>', method='GET'))
+    route.json = {'host': 'example.com', 'token': 'x' * 40, 'values': [f'value {i}' for i in range(40)]}
+    route.dynamic = {'id': '123'}
+    route.query = {'lang': 'fi'}
+    gre = GatewayRequestEnvironment({}, route)
+
+    print(f"{'case':<16}{'str.replace':>14}{'compiled':>14}{'memoize all':>14}{'memoize rep.':>14}")
+    for name, value in CASES.items():
+        node = freeze({'value': value})
+        all_keys = frozenset(find_template_keys(node))
+        repeated = repeated_keys(find_template_keys(node))
+        assert replace_each(gre, value) == render(gre, value) == evaluate(gre, node, all_keys) == \
+            evaluate(gre, node, repeated)
+        runs = (lambda: replace_each(gre, value), lambda: render(gre, value), lambda: evaluate(gre, node, all_keys),
+                lambda: evaluate(gre, node, repeated))
+        times = [timeit.timeit(run, number=iterations) / iterations * 1e6 for run in runs]
+        print(f"{name:<16}" + ''.join(f'{t:>11.2f} us' for t in times))
+
+
+if __name__ == '__main__':
+    main()
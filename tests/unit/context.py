@@ -10,4 +10,22 @@ import agw_request  # noqa
 import agw_response  # noqa
 import agw_route  # noqa
 from gateway_request_environment_plugin import GatewayRequestEnvironment # noqa
-from util import EnvironmentReferenceError  # noqa
+from util import EnvironmentReferenceError, freeze  # noqa
+from request_graph import RequestGraph  # noqa
+from cache import LRUCache  # noqa
+from single_flight import SingleFlight, get_flight_key  # noqa
+from deadline import Deadline  # noqa
+from circuit_breaker import CircuitBreaker, CircuitBreakers  # noqa
+from service_exception_handler_plugin import ServiceUnavailableError  # noqa
+import settings  # noqa
+import upstream_policy  # noqa
+import response_cache  # noqa
+import template  # noqa
+from builders import get_builder  # noqa
+from gateway_controller import GatewayController  # noqa
+from static_response import RouteResponse, StaticResponse  # noqa
+from plugins.mop_request_ticket_validation import MopRequestTicketValidationPlugin  # noqa
+from jwks_cache import JWKSCache  # noqa
+from token_manager import TokenManager  # noqa
+from shared_cache import SqliteCache  # noqa
+from upstream_pool import UpstreamPool  # noqa
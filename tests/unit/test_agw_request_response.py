@@ -0,0 +1,46 @@
+from unittest import TestCase, main
+
+from requests.structures import CaseInsensitiveDict
+
+from .context import agw_request
+
+
+def response(content: bytes, content_type: str, encoding=None):
+    return agw_request.AGWRequestResponse(200, CaseInsensitiveDict({'Content-Type': content_type}), content, encoding)
+
+
+class TestAGWRequestResponse(TestCase):
+    def test_json_is_decoded_lazily(self):
+        resp = response(b'{"a": 1}', 'application/json')
+        self.assertIs(agw_request._NOT_DECODED, resp._json)
+        self.assertEqual({'a': 1}, resp.json)
+        self.assertIs(resp.json, resp.json)
+
+    def test_json_of_other_content_type(self):
+        self.assertIsNone(response(b'<a/>', 'application/xml').json)
+
+    def test_data(self):
+        resp = response(b'a=1&b=2&b=3', 'application/x-www-form-urlencoded')
+        self.assertEqual({'a': ['1'], 'b': ['2', '3']}, resp.data)
+        self.assertIsNone(resp.json)
+
+    def test_text_encoding(self):
+        self.assertEqual('ä', response('ä'.encode('latin-1'), 'text/plain', 'ISO-8859-1').text)
+        self.assertEqual('ä', response('ä'.encode('utf-8'), 'text/plain', 'utf-8').text)
+        text = 'Käsittelytoimen tiedot: määrä, päivämäärä ja yhteyshenkilö.'
+        self.assertEqual(text, response(text.encode('utf-8'), 'text/plain').text)
+
+    def test_set_json(self):
+        resp = response(b'<a/>', 'application/xml')
+        resp.json = {'a': None}
+        self.assertEqual({'a': None}, resp.json)
+
+    def test_headers_are_read_only_and_case_insensitive(self):
+        resp = response(b'', 'text/plain')
+        self.assertEqual('text/plain', resp.headers['content-type'])
+        with self.assertRaises(TypeError):
+            resp.headers['X'] = 'y'  # type: ignore
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+from unittest import TestCase, main
+
+import requests
+
+from .context import agw_response, agw_route, freeze, GatewayRequestEnvironment
+import json_codec
+from body_template import FormTemplate, JsonTemplate
+
+
+class TestJsonTemplate(TestCase):
+    def setUp(self):
+        route = agw_route.AGWRoute(agw_route.AGWRouteDefinition(path='/a', method='GET'))
+        route.json = {'name': 'Åke "A"', 'n': 1}
+        self.gre = GatewayRequestEnvironment({}, route)
+
+    def evaluate(self, node):
+        agw_resp = agw_response.AGWResponse(agw_response.AGWResponseDefinition(status=200, headers={}, json=node))
+        self.gre.evaluate_and_add_response(agw_resp)
+        return agw_resp.json
+
+    def test_same_as_evaluated(self):
+        node = freeze({
+            'static': {'a': [1, 2.5, None, True], 'b': 'Ä', 'c': {}},
+            'name': '${route.json.name}',
+            'list': ['x', '${route.json.n}/${route.json.name}', {'k': '${route.json.n}', 'l': []}],
+            'dollar': '${',
+        })
+        self.assertEqual(json_codec.dumps(self.evaluate(node)), self.gre.render_body(JsonTemplate(node)))
+
+    def test_fragments(self):
+        node = freeze({'static': {'a': [1, 2], 'b': 'c'}, 'name': '${route.json.name}', 'list': ['${route.json.n}']})
+        compiled = JsonTemplate(node)
+        self.assertEqual(3, len(compiled.fragments))
+        self.assertIn(json_codec.dumps({'a': [1, 2], 'b': 'c'}), compiled.fragments[0])
+        self.assertEqual(['route.json.name', 'route.json.n'], [slot.source[2:-1] for slot in compiled.slots])
+
+    def test_static(self):
+        compiled = JsonTemplate(freeze({'a': [1, {'b': 'c'}]}))
+        self.assertEqual([], compiled.slots)
+        self.assertEqual([json_codec.dumps({'a': [1, {'b': 'c'}]})], compiled.fragments)
+
+
+class TestFormTemplate(TestCase):
+    def test_same_as_requests(self):
+        route = agw_route.AGWRoute(agw_route.AGWRouteDefinition(path='/a', method='GET'))
+        route.json = {'scope': 'a b&c=ä', 'n': 1}
+        gre = GatewayRequestEnvironment({}, route)
+        data = freeze({'grant_type': 'client_credentials', 'scope': '${route.json.scope}', 'n': '${route.json.n}',
+                       'x y': 2, 'z': 'ö/'})
+        self.assertTrue(FormTemplate.supports(data))
+        expected = requests.Request('POST', 'http://a', data={key: gre._evaluate_value(value)
+                                                              for key, value in data.items()}).prepare().body
+        self.assertEqual(expected.encode('ascii'), gre.render_body(FormTemplate(data)))
+
+    def test_supports(self):
+        self.assertFalse(FormTemplate.supports({'a': ['b', 'c']}))
+        self.assertFalse(FormTemplate.supports({'a': None}))
+        self.assertFalse(FormTemplate.supports('a=b'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import time
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from .context import LRUCache
+
+
+class TestLRUCache(TestCase):
+    def test_get_and_put(self):
+        cache = LRUCache('test_get_and_put', 100)
+        self.assertIsNone(cache.get('a'))
+        self.assertTrue(cache.put('a', 1, ttl=10))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_expiration(self):
+        cache = LRUCache('test_expiration', 100)
+        cache.put('a', 1, ttl=10)
+        with patch.object(time, 'monotonic', return_value=time.monotonic() + 11):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(1, cache.expirations)
+        self.assertEqual(0, len(cache))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache('test_least_recently_used_is_evicted', 10)
+        cache.put('a', 1, ttl=10, size=4)
+        cache.put('b', 2, ttl=10, size=4)
+        cache.get('a')
+        cache.put('c', 3, ttl=10, size=4)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(8, cache.size)
+
+    def test_max_entries(self):
+        cache = LRUCache('test_max_entries', 100, max_entries=2)
+        for key in 'abc':
+            cache.put(key, key, ttl=10)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('a'))
+
+    def test_too_large_entry_is_not_cached(self):
+        cache = LRUCache('test_too_large_entry_is_not_cached', 10)
+        cache.put('a', 1, ttl=10, size=4)
+        self.assertFalse(cache.put('b', 2, ttl=10, size=11))
+        self.assertEqual(1, cache.get('a'))
+
+    def test_replace(self):
+        cache = LRUCache('test_replace', 10)
+        cache.put('a', 1, ttl=10, size=4)
+        cache.put('a', 2, ttl=10, size=6)
+        self.assertEqual(2, cache.get('a'))
+        self.assertEqual(6, cache.size)
+
+
+if __name__ == '__main__':
+    main()
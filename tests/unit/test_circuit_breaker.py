@@ -0,0 +1,100 @@
+import time
+from unittest import TestCase, main
+from unittest.mock import patch
+
+import requests
+
+from .context import CircuitBreaker, CircuitBreakers, Deadline, ServiceUnavailableError, settings
+
+
+class Response:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+
+
+@patch.multiple(settings, CIRCUIT_BREAKER_ENABLED=True, CIRCUIT_BREAKER_WINDOW=30, CIRCUIT_BREAKER_MIN_CALLS=4,
+                CIRCUIT_BREAKER_FAILURE_RATE=0.5, CIRCUIT_BREAKER_SLOW_CALL_DURATION=1,
+                CIRCUIT_BREAKER_SLOW_CALL_RATE=0.5, CIRCUIT_BREAKER_OPEN_DURATION=10,
+                CIRCUIT_BREAKER_HALF_OPEN_CALLS=2)
+class TestCircuitBreaker(TestCase):
+    def open(self, breaker: CircuitBreaker):
+        for success in (True, True, False, False):
+            breaker.before_call()
+            breaker.record(success, 0.1)
+
+    def test_opens_on_failure_rate(self):
+        breaker = CircuitBreaker('http://a')
+        for success in (True, True, False):
+            breaker.before_call()
+            breaker.record(success, 0.1)
+        self.assertEqual('closed', breaker.state)
+        breaker.before_call()
+        breaker.record(False, 0.1)
+        self.assertEqual('open', breaker.state)
+        self.assertRaises(ServiceUnavailableError, breaker.before_call)
+        self.assertEqual(1, breaker.rejected)
+
+    def test_opens_on_slow_calls(self):
+        breaker = CircuitBreaker('http://a')
+        for duration in (0.1, 0.1, 2, 2):
+            breaker.before_call()
+            breaker.record(True, duration)
+        self.assertEqual('open', breaker.state)
+
+    def test_half_open_trials_close_the_circuit(self):
+        breaker = CircuitBreaker('http://a')
+        self.open(breaker)
+        with patch.object(time, 'monotonic', return_value=time.monotonic() + 11):
+            breaker.before_call()
+            breaker.before_call()
+            self.assertEqual('half_open', breaker.state)
+            self.assertRaises(ServiceUnavailableError, breaker.before_call)
+            breaker.record(True, 0.1)
+            breaker.record(True, 0.1)
+        self.assertEqual('closed', breaker.state)
+        breaker.before_call()
+
+    def test_failed_trial_opens_the_circuit(self):
+        breaker = CircuitBreaker('http://a')
+        self.open(breaker)
+        with patch.object(time, 'monotonic', return_value=time.monotonic() + 11):
+            breaker.before_call()
+            breaker.record(False, 0.1)
+            self.assertEqual('open', breaker.state)
+            self.assertRaises(ServiceUnavailableError, breaker.before_call)
+
+    def test_call_records_server_errors(self):
+        breakers = CircuitBreakers()
+        for status in (200, 200, 500, 503):
+            breakers.call('http://a/foo', lambda s: Response(s), status)
+        self.assertEqual('open', breakers.get('http://a/bar').state)
+        self.assertEqual('closed', breakers.get('http://b/foo').state)
+        self.assertRaises(ServiceUnavailableError, breakers.call, 'http://a/foo', lambda: Response(200))
+
+    def test_truncated_timeouts_not_recorded(self):
+        def timeout(timeout):
+            raise requests.Timeout()
+
+        breakers = CircuitBreakers()
+        with patch('deadline.time.monotonic', return_value=100):
+            deadline = Deadline(1)
+            for _ in range(4):
+                self.assertRaises(requests.Timeout, breakers.call, 'http://a', timeout, timeout=deadline.timeout(2, 5))
+        self.assertEqual((0, 'closed'), (breakers.get('http://a')._failures, breakers.get('http://a').state))
+        for _ in range(4):
+            self.assertRaises(requests.Timeout, breakers.call, 'http://a', timeout, timeout=Deadline().timeout(2, 5))
+        self.assertEqual('open', breakers.get('http://a').state)
+
+    def test_truncated_trial_released(self):
+        breaker = CircuitBreaker('http://a')
+        self.open(breaker)
+        with patch.object(time, 'monotonic', return_value=time.monotonic() + 11):
+            breaker.before_call()
+            breaker.before_call()
+            breaker.cancel()
+            breaker.before_call()
+            self.assertEqual('half_open', breaker.state)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from .context import Deadline, settings
+from service_exception_handler_plugin import GatewayTimeoutError
+
+
+class TestDeadline(TestCase):
+    def test_no_deadline(self):
+        deadline = Deadline()
+        self.assertIsNone(deadline.remaining())
+        deadline.check()
+        with patch.object(settings, 'UPSTREAM_CONNECT_TIMEOUT', 2), patch.object(settings, 'UPSTREAM_READ_TIMEOUT', 5):
+            self.assertEqual((2, 5), deadline.timeout())
+            self.assertEqual((1, 3), deadline.timeout(1, 3))
+            self.assertFalse(deadline.timeout().truncated)
+
+    def test_remaining(self):
+        with patch('deadline.time.monotonic', return_value=100):
+            deadline = Deadline(10)
+        with patch('deadline.time.monotonic', return_value=104):
+            self.assertEqual(6, deadline.remaining())
+            deadline.check()
+        with patch('deadline.time.monotonic', return_value=111):
+            self.assertEqual(-1, deadline.remaining())
+
+    def test_check_expired(self):
+        with patch('deadline.time.monotonic', return_value=100):
+            deadline = Deadline(10)
+        with patch('deadline.time.monotonic', return_value=110), self.assertRaises(GatewayTimeoutError):
+            deadline.check()
+
+    def test_timeout_limited(self):
+        with patch('deadline.time.monotonic', return_value=100):
+            deadline = Deadline(10)
+        with patch('deadline.time.monotonic', return_value=106):
+            self.assertEqual((2, 4), deadline.timeout(2, 30))
+            self.assertEqual((4, 4), deadline.timeout(5, 30))
+            self.assertTrue(deadline.timeout(2, 30).truncated)
+            self.assertFalse(deadline.timeout(2, 4).truncated)
+        with patch('deadline.time.monotonic', return_value=110), self.assertRaises(GatewayTimeoutError):
+            deadline.timeout(2, 30)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+import json
+import os
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from threading import Barrier, Event
+from unittest import TestCase, main
+from unittest.mock import patch
+from wsgiref.util import setup_testing_defaults
+
+import bottle
+
+from .context import agw_route, Deadline, GatewayController, GatewayRequestEnvironment, get_builder, template, \
+    RouteResponse, ServiceUnavailableError, StaticResponse, settings
+from agw_request import AGWRequestResponse
+from service_exception_handler_plugin import GatewayTimeoutError, InternalError
+
+
+def request(url='http://a', method='GET', **fields):
+    return {'url': url, 'method': method, **fields}
+
+
+class GatewayTestCase(TestCase):
+    def definition(self, *requests, constants=None, **response):
+        """
+        Build the definition of a gateway of the route GET /a.
+
+        :param requests: Definitions of the requests, none for a route without requests.
+        :param constants: Constants of the gateway.
+        :param response: Fields of the response definition, a None value removes the field.
+        """
+        definition = {'route': {'path': '/a', 'method': 'GET'}}
+        if requests:
+            definition['requests'] = list(requests)
+        if constants is not None:
+            definition['constants'] = constants
+        response = {'status': 200, 'headers': {}, 'json': {'a': 1}, **response}
+        definition['response'] = {name: value for name, value in response.items() if value is not None}
+        return definition
+
+    def load(self, definition, includes=None):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(definition, f)
+        self.addCleanup(os.remove, path)
+        return GatewayController(path, includes or {})
+
+    def bind_request(self, **environ):
+        environ = {'wsgi.input': BytesIO(b''), **environ}
+        setup_testing_defaults(environ)
+        bottle.request.bind(environ)
+        bottle.response.bind()
+
+    def gre(self, controller, deadline=None, **route_data):
+        route = agw_route.AGWRoute(controller.route_definition)
+        for name, value in route_data.items():
+            setattr(route, name, value)
+        return GatewayRequestEnvironment(controller.constants, route, deadline=deadline)
+
+
+class TestOperations(GatewayTestCase):
+    def test_operations_instantiated_once(self):
+        controller = self.load(self.definition(request(builders=[{'builder': 'builders.set', 'self.headers.a': 'b'}])))
+        definition = controller.request_definitions[0].builders[0]
+        self.assertIs(controller._operation(get_builder, definition), controller._operation(get_builder, definition))
+
+    def test_evaluated_definition(self):
+        controller = self.load(self.definition(
+            request(builders=[{'builder': 'builders.set', 'self.headers.a': '${route.query.a}'}])))
+        evaluated = dict(controller.request_definitions[0].builders[0])
+        evaluated['self.headers.a'] = 'b'
+        self.assertEqual({'self.headers.a': 'b'}, controller._operation(get_builder, evaluated).definition)
+
+    def test_invalid_operation_fails_at_load(self):
+        for definition in (self.definition(request(builders=[{'builder': 'builders.copy', 'from': 'route.query.a'}])),
+                           self.definition(request(), generators=[{'generator': 'generators.does_not_exist'}])):
+            with self.subTest(definition=definition), self.assertRaises(InternalError):
+                self.load(definition)
+
+
+class TestFolding(GatewayTestCase):
+    def test_environment_folded(self):
+        controller = self.load(self.definition(request(), json={'a': '${environment.AGW_GATEWAYS_SEARCH_PATH}'}))
+        self.assertEqual({'a': os.environ['AGW_GATEWAYS_SEARCH_PATH']}, controller.response_definition.json)
+
+    def test_not_folded_when_written(self):
+        controller = self.load(self.definition(
+            request(builders=[{'builder': 'builders.set', 'environment.AGW_GATEWAYS_SEARCH_PATH': 'b'}]),
+            json={'a': '${environment.AGW_GATEWAYS_SEARCH_PATH}'}))
+        self.assertEqual({'a': '${environment.AGW_GATEWAYS_SEARCH_PATH}'}, controller.response_definition.json)
+
+    def test_constants_folded(self):
+        controller = self.load(self.definition(
+            request('${constants.envs.a.url}/${constants.v}/${route.json.p}/${constants.d}'),
+            constants={'envs': {'a': {'url': 'http://a'}, 'b': {'url': 'http://b'}}, 'v': 2, 'd': '$x'},
+            json={'a': '${constants.envs[route.json.env].url}'}))
+        self.assertEqual('http://a/2/${route.json.p}/${constants.d}', controller.request_definitions[0].url)
+        self.assertEqual({'a': '${constants.envs[route.json.env].url}'}, controller.response_definition.json)
+        parts = template.parse_key('constants.envs[route.json.env].url')
+        self.assertEqual(('route.json.env', {'a': 'http://a', 'b': 'http://b'}), controller.dynamic_indexes[parts])
+
+    def test_include_merged(self):
+        include = {'url': '${arguments.host}/token', 'method': 'POST', 'data': 'scope=${arguments.scope}'}
+        controller = self.load(self.definition(
+            request(includes=[{'file': 'incl.json',
+                               'arguments': {'host': '${constants.host}', 'scope': '${route.json.scope}'}}]),
+            constants={'host': 'http://idp'}), {'incl.json': include})
+        req_def = controller.request_definitions[0]
+        self.assertEqual(('http://idp/token', 'POST', 'scope=${route.json.scope}'),
+                         (req_def.url, req_def.method, req_def.data))
+        self.assertNotIn('include', req_def.includes[0])
+        self.assertEqual('${arguments.host}/token', include['url'])
+
+    def test_include_not_merged(self):
+        controller = self.load(self.definition(request(includes=[{'file': 'incl.json', 'arguments': {}}])),
+                               {'incl.json': {'url': '${arguments.host}'}})
+        self.assertEqual({'url': '${arguments.host}'}, controller.request_definitions[0].includes[0]['include'])
+        self.assertEqual('http://a', controller.request_definitions[0].url)
+
+
+class TestRouteResponse(GatewayTestCase):
+    def setUp(self):
+        self.bind_request(QUERY_STRING='a=1', HTTP_X_A='b')
+
+    def test_static(self):
+        controller = self.load(self.definition(json={'a': '${environment.AGW_GATEWAYS_SEARCH_PATH}'}))
+        route_response = controller.route_response
+        self.assertIsInstance(route_response, StaticResponse)
+        body = route_response.respond()
+        self.assertEqual({'a': os.environ['AGW_GATEWAYS_SEARCH_PATH']}, json.loads(body))
+        self.assertEqual((200, 'application/json'), (bottle.response.status_code, bottle.response.content_type))
+
+    def test_route_data(self):
+        route_response = self.load(self.definition(
+            headers={'X-B': '${route.query.a}'},
+            json={'a': '${route.headers.X-A}', 'b': [{'c': 'd'}], 'p': '${route.path}'})).route_response
+        self.assertEqual(RouteResponse, type(route_response))
+        self.assertEqual({'headers', 'query'}, set(route_response.readers))
+        self.assertEqual({'a': 'b', 'b': [{'c': 'd'}], 'p': '/a'}, json.loads(route_response.respond()))
+        self.assertEqual('1', bottle.response.headers['X-B'])
+
+        with self.assertRaises(InternalError):
+            self.load(self.definition(json=None, text='${route.query.b}')).route_response.respond()
+
+    def test_json_template(self):
+        controller = self.load(self.definition(request(), json={'a': '${route.query.a}', 'b': [1]}))
+        body = self.gre(controller, query={'a': 'ä'}).render_body(controller.json_template)
+        self.assertEqual({'a': 'ä', 'b': [1]}, json.loads(body))
+        # Generators modify the json after it is evaluated
+        self.assertIsNone(self.load(self.definition(
+            request(), generators=[{'generator': 'generators.set', 'response.json.b': 'c'}])).json_template)
+
+    def test_evaluated_in_gre(self):
+        for reason, definition in (
+                ('requests', self.definition(request())),
+                ('generators', self.definition(generators=[{'generator': 'generators.set', 'response.json.a': 'b'}])),
+                ('constants', self.definition(json={'a': '${constants.a}'})),
+                ('dynamic key', self.definition(json={'a': '${route.query[route.extra.a]}'}))):
+            with self.subTest(reason):
+                self.assertIsNone(self.load(definition).route_response)
+
+
+class TestRequestBodies(GatewayTestCase):
+    def definition(self, *requests, **response):
+        if not requests:
+            requests = (request(builders=[{'builder': 'builders.set', 'self.headers.a': 'b'}], headers={},
+                                json={'a': '${route.json.a}', 'b': [1]}),
+                        request('http://b', 'POST', name='b', data={'a': 'c d'}))
+        return super().definition(*requests, **response)
+
+    def compiled(self, definition):
+        return {i: field for i, (field, _) in self.load(definition)._body_templates.items()}
+
+    def test_compiled(self):
+        controller = self.load(self.definition())
+        gre = self.gre(controller, json={'a': 'ä'})
+        agw_req = controller._prepare_request(gre, 0, controller.request_definitions[0])
+        self.assertEqual((None, {'a': 'ä', 'b': [1]}, 'application/json'),
+                         (agw_req.json, json.loads(agw_req.body), agw_req.body_content_type))
+        agw_req = controller._prepare_request(gre, 1, controller.request_definitions[1])
+        self.assertEqual((None, b'a=c+d'), (agw_req.data, agw_req.body))
+
+    def test_referenced(self):
+        self.assertEqual({0: 'json', 1: 'data'}, self.compiled(self.definition()))
+        for name, value in (('json', {'a': '${requests[0].json.a}', 'b': "${requests_by_name['b'].data.a}"}),
+                            ('generators', [{'generator': 'generators.copy', 'from': 'requests', 'to': 'response.a'}])):
+            with self.subTest(name):
+                self.assertEqual({}, self.compiled(self.definition(**{name: value})))
+        # Builders of the request modify its body after it is evaluated
+        definition = self.definition()
+        definition['requests'][0]['builders'].append({'builder': 'builders.set', 'self.json.c': 'd'})
+        self.assertEqual({1: 'data'}, self.compiled(definition))
+
+
+class TestRunRequests(GatewayTestCase):
+    def setUp(self):
+        self.bind_request()
+        self.release = Event()
+        self.addCleanup(self.release.set)
+        self.sent = []
+
+    def run_requests(self, request_defs, send_request, workers=2, deadline=None):
+        controller = self.load(self.definition(*request_defs))
+        gre = self.gre(controller, deadline=deadline)
+
+        def send(agw_req, gre):
+            self.sent.append(agw_req.url)
+            return send_request(agw_req)
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        self.addCleanup(executor.shutdown)
+        try:
+            with patch.object(settings, 'UPSTREAM_MAX_PARALLEL_REQUESTS', 2), \
+                    patch('gateway_controller.upstream_pool.get_executor', return_value=executor), \
+                    patch.object(controller, '_send_request', side_effect=send):
+                controller._run_requests(gre)
+        finally:
+            self.release.set()
+            executor.shutdown()
+        return gre
+
+    def test_dependent_request_sees_parallel_responses(self):
+        # Both independent requests have to be in flight at the same time to pass the barrier
+        barrier = Barrier(2, timeout=5)
+
+        def send_request(agw_req):
+            if agw_req.url.startswith('http://c'):
+                return AGWRequestResponse(200, {}, b'')
+            barrier.wait()
+            return AGWRequestResponse(200, {'Content-Type': 'application/json'},
+                                      json.dumps({'id': agw_req.url[-1]}).encode())
+
+        gre = self.run_requests([
+            request('http://a'),
+            request('http://b'),
+            request('http://c/${requests[0].response.json.id}/${requests[1].response.json.id}'),
+        ], send_request)
+        self.assertEqual({'http://a', 'http://b'}, set(self.sent[:2]))
+        self.assertEqual('http://c/a/b', self.sent[2])
+        self.assertEqual(['http://a', 'http://b', 'http://c/a/b'], [agw_req.url for agw_req in gre.requests])
+
+    def test_failing_request_cancels_pending(self):
+        def send_request(agw_req):
+            if agw_req.url == 'http://a':
+                raise ServiceUnavailableError('Service unavailable')
+            self.release.wait(5)
+
+        with patch.object(Future, 'cancel', autospec=True, side_effect=Future.cancel) as cancel, \
+                self.assertRaises(ServiceUnavailableError):
+            self.run_requests([request(f'http://{host}') for host in 'abc'], send_request)
+        # The running and the waiting request
+        self.assertEqual(2, cancel.call_count)
+        self.assertNotIn('http://c', self.sent[:2])
+
+    def test_deadline_expired(self):
+        def send_request(agw_req):
+            self.release.wait(5)
+
+        with self.assertRaises(GatewayTimeoutError):
+            self.run_requests([request('http://a'), request('http://b')], send_request, workers=1,
+                              deadline=Deadline(0.1))
+        # The second request was waiting for a thread and is not sent
+        self.assertEqual(['http://a'], self.sent)
+
+
+if __name__ == '__main__':
+    main()
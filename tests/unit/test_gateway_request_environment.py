@@ -1,10 +1,12 @@
+import pickle
 from unittest import TestCase, main
+from unittest.mock import patch
 
 from .context import agw_request
 from .context import agw_response
 from .context import agw_route
 
-from .context import EnvironmentReferenceError
+from .context import EnvironmentReferenceError, freeze, get_builder
 from .context import GatewayRequestEnvironment
 
 REQUEST_DEF_1 = {
@@ -60,10 +62,10 @@ ROUTE_DEF = {
 
 class TestGetFromRequest(TestCase):
     def setUp(self):
-        self.agw_route = agw_route.AGWRoute(agw_route.AGWRouteDefinition(**ROUTE_DEF))
-        self.agw_request_1 = agw_request.AGWRequest(agw_request.AGWRequestDefinition(**REQUEST_DEF_1))
-        self.agw_request_2 = agw_request.AGWRequest(agw_request.AGWRequestDefinition(**REQUEST_DEF_2))
-        self.agw_response = agw_response.AGWResponse(agw_response.AGWResponseDefinition(**RESPONSE_DEF))
+        self.agw_route = agw_route.AGWRoute(agw_route.AGWRouteDefinition(**freeze(ROUTE_DEF)))
+        self.agw_request_1 = agw_request.AGWRequest(agw_request.AGWRequestDefinition(**freeze(REQUEST_DEF_1)))
+        self.agw_request_2 = agw_request.AGWRequest(agw_request.AGWRequestDefinition(**freeze(REQUEST_DEF_2)))
+        self.agw_response = agw_response.AGWResponse(agw_response.AGWResponseDefinition(**freeze(RESPONSE_DEF)))
         self.gre = GatewayRequestEnvironment({}, self.agw_route, requests=[self.agw_request_1, self.agw_request_2],
                                              response=self.agw_response)
 
@@ -120,10 +122,10 @@ class TestGetFromRequest(TestCase):
 
 class TestSetToResponse(TestCase):
     def setUp(self):
-        self.agw_route = agw_route.AGWRoute(agw_route.AGWRouteDefinition(**ROUTE_DEF))
-        self.agw_request_1 = agw_request.AGWRequest(agw_request.AGWRequestDefinition(**REQUEST_DEF_1))
-        self.agw_request_2 = agw_request.AGWRequest(agw_request.AGWRequestDefinition(**REQUEST_DEF_2))
-        self.agw_response = agw_response.AGWResponse(agw_response.AGWResponseDefinition(**RESPONSE_DEF))
+        self.agw_route = agw_route.AGWRoute(agw_route.AGWRouteDefinition(**freeze(ROUTE_DEF)))
+        self.agw_request_1 = agw_request.AGWRequest(agw_request.AGWRequestDefinition(**freeze(REQUEST_DEF_1)))
+        self.agw_request_2 = agw_request.AGWRequest(agw_request.AGWRequestDefinition(**freeze(REQUEST_DEF_2)))
+        self.agw_response = agw_response.AGWResponse(agw_response.AGWResponseDefinition(**freeze(RESPONSE_DEF)))
         self.gre = GatewayRequestEnvironment({}, self.agw_route, requests=[self.agw_request_1, self.agw_request_2],
                                              response=self.agw_response)
 
@@ -158,10 +160,10 @@ class TestSetToResponse(TestCase):
 
 class TestPopFromResponse(TestCase):
     def setUp(self):
-        self.agw_route = agw_route.AGWRoute(agw_route.AGWRouteDefinition(**ROUTE_DEF))
-        self.agw_request_1 = agw_request.AGWRequest(agw_request.AGWRequestDefinition(**REQUEST_DEF_1))
-        self.agw_request_2 = agw_request.AGWRequest(agw_request.AGWRequestDefinition(**REQUEST_DEF_2))
-        self.agw_response = agw_response.AGWResponse(agw_response.AGWResponseDefinition(**RESPONSE_DEF))
+        self.agw_route = agw_route.AGWRoute(agw_route.AGWRouteDefinition(**freeze(ROUTE_DEF)))
+        self.agw_request_1 = agw_request.AGWRequest(agw_request.AGWRequestDefinition(**freeze(REQUEST_DEF_1)))
+        self.agw_request_2 = agw_request.AGWRequest(agw_request.AGWRequestDefinition(**freeze(REQUEST_DEF_2)))
+        self.agw_response = agw_response.AGWResponse(agw_response.AGWResponseDefinition(**freeze(RESPONSE_DEF)))
         self.gre = GatewayRequestEnvironment({}, self.agw_route, requests=[self.agw_request_1, self.agw_request_2],
                                              response=self.agw_response)
 
@@ -181,5 +183,73 @@ class TestPopFromResponse(TestCase):
         self.assertEqual({'a': 1, 'b': 2, 'c': [4]}, self.agw_response.json['test_agw_response_json_val_dict'])
 
 
+class TestCopyOnWrite(TestCase):
+    def setUp(self):
+        self.definition = agw_request.AGWRequestDefinition(**freeze(REQUEST_DEF_1))
+        self.agw_request = agw_request.AGWRequest(self.definition)
+        self.gre = GatewayRequestEnvironment({'a': {'b': 1}}, agw_route.AGWRoute(
+            agw_route.AGWRouteDefinition(**freeze(ROUTE_DEF))), requests=[self.agw_request])
+
+    def test_definition_is_frozen(self):
+        with self.assertRaises(TypeError):
+            self.definition.json['test_agw_request_1_json_val_dict']['a'] = 2
+        with self.assertRaises(TypeError):
+            self.definition.json['test_agw_request_1_json_val_list'].append('d')
+
+    def test_set_copies_written_path_only(self):
+        self.gre.set('requests[0].json.test_agw_request_1_json_val_dict.c[0]', 5)
+        self.assertEqual([5, 4], self.gre.get('requests[0].json.test_agw_request_1_json_val_dict.c'))
+        self.assertEqual([3, 4], self.definition.json['test_agw_request_1_json_val_dict']['c'])
+        self.assertIs(self.definition.json['test_agw_request_1_json_val_list'],
+                      self.agw_request.json['test_agw_request_1_json_val_list'])
+
+    def test_pop(self):
+        self.assertEqual('a', self.gre.pop('requests[0].json.test_agw_request_1_json_val_list[0]'))
+        self.assertEqual(['b', 'c'], self.agw_request.json['test_agw_request_1_json_val_list'])
+        self.assertEqual(['a', 'b', 'c'], self.definition.json['test_agw_request_1_json_val_list'])
+
+    def test_evaluate_shares_nodes_without_templates(self):
+        definition = agw_request.AGWRequestDefinition(url='u', **freeze({
+            'headers': {'a': 'b'},
+            'json': {'static': {'x': [1]}, 'templated': {'x': ['${constants.a.b}']}}
+        }))
+        agw_req = agw_request.AGWRequest(definition)
+        self.gre.evaluate_and_add_request(agw_req)
+        self.assertIs(definition.headers, agw_req.headers)
+        self.assertIs(definition.json['static'], agw_req.json['static'])
+        self.assertEqual({'x': ['1']}, agw_req.json['templated'])
+        self.assertEqual({'x': ['${constants.a.b}']}, definition.json['templated'])
+
+    def test_templated(self):
+        node = freeze({'a': {'b': [1, 'c', None]}, 'd': ['${e}'], 'f': {'g': {'h': 'i ${j}'}}})
+        self.assertEqual((True, False, False, True, True), (node.templated, node['a'].templated,
+                                                            node['a']['b'].templated, node['d'].templated,
+                                                            node['f'].templated))
+        self.assertTrue(pickle.loads(pickle.dumps(node))['f'].templated)
+
+    def test_evaluate_skips_nodes_without_templates(self):
+        static = freeze({'a': ['b', {'c': 1, 'd': 'e $ {f}'}], 'g': 'h'})
+        self.assertFalse(static.templated)
+        with patch('gateway_request_environment_plugin.get_template') as get_template, \
+                patch.object(self.gre, '_lookup_template_value') as lookup:
+            self.assertIs(static, self.gre._evaluate_value(static))
+        get_template.assert_not_called()
+        lookup.assert_not_called()
+
+    def test_builder(self):
+        definition = freeze({'builder': 'builders.set', 'requests[0].json.new': {'a': 1}})
+        get_builder(definition).run(self.gre, 'requests[0]')
+        self.assertEqual(1, self.gre.get('requests[0].json.new.a'))
+        self.assertNotIn('new', self.definition.json)
+        self.assertIn('builder', definition)
+
+    def test_set_constants(self):
+        constants = freeze({'a': {'b': 1}})
+        gre = GatewayRequestEnvironment(constants, self.gre.route)
+        gre.set('constants.a.b', 2)
+        self.assertEqual(2, gre.get('constants.a.b'))
+        self.assertEqual(1, constants['a']['b'])
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,27 @@
+import json
+from unittest import TestCase, main
+
+from .context import freeze
+import json_codec
+
+
+class TestJsonCodec(TestCase):
+    def test_round_trip(self):
+        value = {'a': [1, 2.5, None, True, 'Ä "b"'], 'c': {}}
+        self.assertEqual(value, json_codec.loads(json_codec.dumps(value)))
+        self.assertEqual(value, json_codec.loads(json_codec.dumps(value).decode('utf-8')))
+        self.assertEqual(value, json.loads(json_codec.dumps(freeze(value))))
+
+    def test_fallback(self):
+        self.assertEqual({'1': 2 ** 70}, json.loads(json_codec.dumps({1: 2 ** 70})))
+        self.assertEqual([123456789012345678901], json_codec.loads(b'[123456789012345678901]'))
+        with self.assertRaises(ValueError):
+            json_codec.loads(b'{"a": ')
+
+    def test_separators(self):
+        self.assertEqual(b'{"a"' + json_codec.KEY_SEPARATOR + b'1' + json_codec.ITEM_SEPARATOR + b'"b"' +
+                         json_codec.KEY_SEPARATOR + b'2}', json_codec.dumps({'a': 1, 'b': 2}))
+
+
+if __name__ == '__main__':
+    main()
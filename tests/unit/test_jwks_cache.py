@@ -0,0 +1,78 @@
+import os
+import tempfile
+import time
+from unittest import TestCase, main
+from unittest.mock import MagicMock, patch
+
+import requests
+from jwcrypto import jwk  # type: ignore
+
+from .context import JWKSCache, SqliteCache
+
+KEYS = {kid: jwk.JWK.generate(kty='EC', crv='P-256', kid=kid, use='sig') for kid in ('old', 'new')}
+
+
+def jwks(*kids):
+    keyset = jwk.JWKSet()
+    for kid in kids:
+        keyset.add(KEYS[kid])
+    return MagicMock(text=keyset.export(private_keys=False))
+
+
+class TestJWKSCache(TestCase):
+    def setUp(self):
+        self.get = MagicMock(return_value=jwks('old'))
+        patch('jwks_cache.upstream_pool.get_session', return_value=MagicMock(get=self.get)).start()
+        self.addCleanup(patch.stopall)
+        self.cache = JWKSCache('test_jwks', 'http://mop/jwks', 0, 60)
+
+    def test_keys_are_fetched_once(self):
+        self.assertEqual(KEYS['old'].thumbprint(), self.cache.get_key('old').thumbprint())
+        self.cache.get_key('old')
+        self.assertEqual(1, self.get.call_count)
+        self.assertFalse(self.cache.get_key('old').has_private)
+
+    def test_unknown_kid_refetches(self):
+        self.cache.warm()
+        self.get.return_value = jwks('old', 'new')
+        self.cache.min_refetch_interval = 0
+        self.assertEqual(KEYS['new'].thumbprint(), self.cache.get_key('new').thumbprint())
+        self.assertEqual(2, self.get.call_count)
+
+    def test_unknown_kid_refetches_are_rate_limited(self):
+        self.cache.warm()
+        self.get.return_value = jwks('old', 'new')
+        self.assertIsNone(self.cache.get_key('new'))
+        self.assertIsNone(self.cache.get_key('new'))
+        self.assertEqual(1, self.get.call_count)
+        self.assertEqual(2, self.cache.stats()['unknown_kids'])
+
+    def test_failed_refresh_keeps_keys(self):
+        self.cache.warm()
+        self.get.side_effect = requests.ConnectionError('refused')
+        self.cache.warm()
+        self.assertIsNotNone(self.cache.get_key('old'))
+        self.assertEqual({'keys': 1, 'fetches': 2, 'failures': 1, 'unknown_kids': 0}, self.cache.stats())
+
+    def test_background_refresh(self):
+        self.cache.refresh_interval = 0.01
+        self.cache.get_key('old')
+        self.get.return_value = jwks('new')
+        deadline = time.monotonic() + 5
+        while self.cache._keys.get('new') is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.cache.stop()
+        self.assertIsNotNone(self.cache.get_key('new'))
+
+    def test_shared_jwks(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        shared = SqliteCache('test_jwks_shared', 64 * 1024, os.path.join(directory.name, 'cache.sqlite'))
+        workers = [JWKSCache(f'test_jwks_{i}', 'http://mop/jwks', 0, 60, shared) for i in range(2)]
+        self.assertIsNotNone(workers[0].get_key('old'))
+        self.assertIsNotNone(workers[1].get_key('old'))
+        self.assertEqual(1, self.get.call_count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import json
+import time
+from types import SimpleNamespace
+from unittest import TestCase, main
+from unittest.mock import MagicMock, patch
+
+from jwcrypto import jwk, jwt  # type: ignore
+
+from .context import MopRequestTicketValidationPlugin, LRUCache, Deadline, settings
+from service_exception_handler_plugin import AuthorizationError, BadRequestError
+
+INTROSPECTION = {
+    'active': True,
+    'access_item_uuid': 'asd-123',
+    'identifiers': [{'id': 'asdasd', 'id_type': 'pairwise'}],
+}
+
+
+def introspection_response():
+    return MagicMock(status_code=200, content=json.dumps(INTROSPECTION).encode())
+
+
+def gre():
+    return SimpleNamespace(route=SimpleNamespace(extra={}), deadline=Deadline())
+
+
+class TestIntrospectionCache(TestCase):
+    def setUp(self):
+        self.plugin = MopRequestTicketValidationPlugin.__new__(MopRequestTicketValidationPlugin)
+        cls = MopRequestTicketValidationPlugin
+        patches = [
+            patch.object(cls, '_TOKENS', MagicMock(**{'get_token.return_value': 'token'})),
+            patch.object(cls, '_TICKET_INTROSPECTION_ENDPOINT', 'http://mop/introspect'),
+            patch.object(cls, '_INTROSPECTION_CACHE', LRUCache('test_introspection_cache', 1024 * 1024)),
+            patch.object(settings, 'MOP_REQUEST_TICKET_VALIDATION_INTROSPECTION_CACHE_TTL', 60),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.post = MagicMock(return_value=introspection_response())
+        patch('plugins.mop_request_ticket_validation.upstream_pool.get_session',
+              return_value=MagicMock(post=self.post)).start()
+        self.addCleanup(patch.stopall)
+
+    def test_introspection_is_cached(self):
+        claims = {'exp': time.time() + 300}
+        first, second = gre(), gre()
+        self.plugin._introspect_request_ticket('ticket', first, claims)
+        MopRequestTicketValidationPlugin._TOKENS.get_token.return_value = 'renewed'
+        self.plugin._introspect_request_ticket('ticket', second, claims)
+
+        self.assertEqual(1, self.post.call_count)
+        self.assertEqual('asd-123', second.route.extra['mop_request_ticket']['access_item_uuid'])
+        self.assertEqual('asdasd', second.route.extra['mop_request_ticket']['identifiers']['pairwise']['id'])
+        self.assertEqual('renewed', second.route.extra['mop_request_ticket']['agw_token'])
+        self.assertEqual({'entries': 1, 'hits': 1, 'misses': 1},
+                         {k: v for k, v in MopRequestTicketValidationPlugin._INTROSPECTION_CACHE.stats().items()
+                          if k in ('entries', 'hits', 'misses')})
+
+    def test_expired_token_is_renewed(self):
+        tokens = MopRequestTicketValidationPlugin._TOKENS
+        tokens.renew.return_value = 'renewed'
+        self.post.side_effect = [MagicMock(status_code=401, text='expired'), introspection_response()]
+        route = gre()
+        self.plugin._introspect_request_ticket('ticket', route, {})
+
+        tokens.renew.assert_called_once_with('token')
+        self.assertEqual('bearer renewed', self.post.call_args.kwargs['headers']['Authorization'])
+        self.assertEqual('renewed', route.route.extra['mop_request_ticket']['agw_token'])
+
+    def test_other_tickets_are_introspected(self):
+        claims = {'exp': time.time() + 300}
+        self.plugin._introspect_request_ticket('ticket', gre(), claims)
+        self.plugin._introspect_request_ticket('other ticket', gre(), claims)
+        self.assertEqual(2, self.post.call_count)
+
+    def test_ttl_is_capped_by_exp(self):
+        claims = {'exp': time.time() - 1}
+        self.plugin._introspect_request_ticket('ticket', gre(), claims)
+        self.plugin._introspect_request_ticket('ticket', gre(), claims)
+        self.assertEqual(2, self.post.call_count)
+        self.assertEqual(0, len(MopRequestTicketValidationPlugin._INTROSPECTION_CACHE))
+
+    def test_cache_disabled(self):
+        with patch.object(MopRequestTicketValidationPlugin, '_INTROSPECTION_CACHE', None):
+            self.plugin._introspect_request_ticket('ticket', gre(), {})
+            self.plugin._introspect_request_ticket('ticket', gre(), {})
+        self.assertEqual(2, self.post.call_count)
+
+
+class TestSignature(TestCase):
+    key = jwk.JWK.generate(kty='EC', crv='P-256')
+
+    def setUp(self):
+        self.plugin = MopRequestTicketValidationPlugin.__new__(MopRequestTicketValidationPlugin)
+        keys = {'rotated': self.key}
+        self.jwks = jwks = MagicMock(get_key=MagicMock(side_effect=keys.get))
+        for p in (patch.object(MopRequestTicketValidationPlugin, '_JWKS', jwks),
+                  patch.object(MopRequestTicketValidationPlugin, '_KID', 'configured')):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def ticket(self, header, exp=60):
+        token = jwt.JWT(header=header, claims={'aud': 'http://agw', 'exp': int(time.time()) + exp})
+        token.make_signed_token(self.key)
+        return token.serialize()
+
+    def test_key_is_selected_by_kid(self):
+        claims = self.plugin._verify_request_ticket_signature(self.ticket({'alg': 'ES256', 'kid': 'rotated'}))
+        self.assertEqual('http://agw', claims['aud'])
+
+    def test_unknown_kid(self):
+        with self.assertRaises(BadRequestError):
+            self.plugin._verify_request_ticket_signature(self.ticket({'alg': 'ES256', 'kid': 'other'}))
+
+    def test_configured_kid_is_used_without_kid(self):
+        with self.assertRaisesRegex(BadRequestError, "'configured'"):
+            self.plugin._verify_request_ticket_signature(self.ticket({'alg': 'ES256'}))
+
+    def test_verified_tickets_are_cached(self):
+        with patch.object(MopRequestTicketValidationPlugin, '_VERIFIED_TICKETS', LRUCache('test_verified', 4096)):
+            ticket = self.ticket({'alg': 'ES256', 'kid': 'rotated'}, exp=300)
+            first = self.plugin._verify_request_ticket_signature(ticket)
+            second = self.plugin._verify_request_ticket_signature(ticket)
+            self.assertIs(first, second)
+            self.assertEqual(1, self.jwks.get_key.call_count)
+
+            # Not cached past the expiry minus the leeway
+            ticket = self.ticket({'alg': 'ES256', 'kid': 'rotated'}, exp=30)
+            self.plugin._verify_request_ticket_signature(ticket)
+            self.plugin._verify_request_ticket_signature(ticket)
+            self.assertEqual(3, self.jwks.get_key.call_count)
+
+    def test_invalid_header(self):
+        with self.assertRaises(BadRequestError):
+            self.plugin._verify_request_ticket_signature('not a ticket')
+
+
+class TestRejectedTickets(TestCase):
+    key = jwk.JWK.generate(kty='EC', crv='P-256')
+
+    def setUp(self):
+        self.plugin = MopRequestTicketValidationPlugin.__new__(MopRequestTicketValidationPlugin)
+        self.plugin.plugin_definition = {'aud': 'http://agw'}
+        cls = MopRequestTicketValidationPlugin
+        self.jwks = MagicMock(get_key=MagicMock(side_effect={'kid': self.key}.get))
+        self.post = MagicMock(return_value=MagicMock(status_code=200, content=b'{"active": false}'))
+        for p in (patch.object(cls, '_JWKS', self.jwks),
+                  patch.object(cls, '_ISS', 'http://mop'),
+                  patch.object(cls, '_TICKET_INTROSPECTION_ENDPOINT', 'http://mop/introspect'),
+                  patch.object(cls, '_TOKENS', MagicMock(**{'get_token.return_value': 'token'})),
+                  patch.object(cls, '_REJECTED_TICKETS', LRUCache('test_rejected', 4096)),
+                  patch('plugins.mop_request_ticket_validation.upstream_pool.get_session',
+                        return_value=MagicMock(post=self.post)),
+                  patch('bottle.request', MagicMock(url='http://agw/route'))):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def ticket(self, kid='kid', exp=300, **claims):
+        claims = dict({'aud': 'http://agw', 'iss': 'http://mop', 'exp': int(time.time()) + exp}, **claims)
+        token = jwt.JWT(header={'alg': 'ES256', 'kid': kid}, claims=claims)
+        token.make_signed_token(self.key)
+        return token.serialize()
+
+    def validate(self, ticket, error):
+        with self.assertRaises(error) as context:
+            self.plugin._validate_request_ticket(ticket, gre())
+        return context.exception
+
+    def test_rejection_is_cached(self):
+        ticket = self.ticket(iss='http://other')
+        first = self.validate(ticket, AuthorizationError)
+        second = self.validate(ticket, AuthorizationError)
+        self.assertEqual(first.description, second.description)
+        self.assertEqual(1, self.jwks.get_key.call_count)
+
+    def test_inactive_ticket_is_introspected_once(self):
+        ticket = self.ticket()
+        self.validate(ticket, BadRequestError)
+        self.validate(ticket, BadRequestError)
+        self.assertEqual(1, self.post.call_count)
+
+    def test_expired_ticket(self):
+        ticket = self.ticket(exp=-600)
+        self.assertIn('expired', self.validate(ticket, AuthorizationError).description)
+        self.validate(ticket, AuthorizationError)
+        self.assertEqual(1, self.jwks.get_key.call_count)
+
+    def test_unknown_signing_key_is_not_cached(self):
+        ticket = self.ticket(kid='other')
+        self.validate(ticket, BadRequestError)
+        self.validate(ticket, BadRequestError)
+        self.assertEqual(2, self.jwks.get_key.call_count)
+
+
+if __name__ == '__main__':
+    main()
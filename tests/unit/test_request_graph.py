@@ -0,0 +1,95 @@
+from unittest import TestCase, main
+
+from .context import agw_request
+from .context import RequestGraph
+
+
+def graph(*request_defs):
+    return RequestGraph([agw_request.AGWRequestDefinition(**req) for req in request_defs])
+
+
+class TestRequestGraph(TestCase):
+    def test_independent_requests(self):
+        g = graph(
+            {'url': 'http://a/${route.json.a}', 'method': 'GET'},
+            {'url': 'http://b/${route.json.b}', 'method': 'GET'},
+        )
+        self.assertEqual([set(), set()], g.dependencies)
+        self.assertFalse(g.is_sequential)
+        self.assertEqual([0, 1], g.ready(set(), set()))
+
+    def test_index_reference(self):
+        g = graph(
+            {'url': 'http://a', 'method': 'GET'},
+            {'url': 'http://b', 'method': 'GET'},
+            {'url': 'http://c/${requests[0].response.json.id}', 'method': 'GET'},
+        )
+        self.assertEqual([set(), set(), {0}], g.dependencies)
+        self.assertEqual([0, 1], g.ready(set(), set()))
+        self.assertEqual([2], g.ready({0}, {0, 1}))
+
+    def test_name_reference(self):
+        g = graph(
+            {'url': 'http://a', 'method': 'GET'},
+            {'url': 'http://b', 'method': 'GET', 'name': 'b'},
+            {'url': 'http://c', 'method': 'GET', 'headers': {'x': "${requests_by_name['b'].response.text}"}},
+        )
+        self.assertEqual([set(), set(), {1}], g.dependencies)
+
+    def test_name_from_include(self):
+        g = graph(
+            {'includes': [{'file': 'f', 'arguments': {'a': '${route.json.a}'},
+                           'include': {'name': 'token', 'url': 'http://a/${arguments.a}', 'method': 'POST'}}]},
+            {'url': 'http://b', 'method': 'GET'},
+            {'url': 'http://c', 'method': 'GET', 'headers': {'x': "${requests_by_name['token'].response.text}"}},
+        )
+        self.assertEqual([set(), set(), {0}], g.dependencies)
+
+    def test_builder_reads(self):
+        g = graph(
+            {'url': 'http://a', 'method': 'GET'},
+            {'url': 'http://b', 'method': 'GET', 'builders': [
+                {'builder': 'builders.copy', 'from': 'requests[0].response.json', 'to': 'self.json'}
+            ]},
+        )
+        self.assertEqual([set(), {0}], g.dependencies)
+        self.assertTrue(g.is_sequential)
+
+    def test_self_reference_is_not_a_dependency(self):
+        g = graph(
+            {'url': 'http://a', 'method': 'GET'},
+            {'url': 'http://b', 'method': 'GET', 'builders': [
+                {'builder': 'builders.copy', 'from': 'route.headers.X', 'to': 'requests[1].headers.x'}
+            ], 'processors': [{'processor': 'processors.xml_to_json'}]},
+        )
+        self.assertEqual([set(), set()], g.dependencies)
+
+    def test_write_to_shared_data_is_a_barrier(self):
+        g = graph(
+            {'url': 'http://a', 'method': 'GET'},
+            {'url': 'http://b', 'method': 'GET', 'builders': [
+                {'builder': 'builders.set', 'route.extra.x': 'y'}
+            ]},
+            {'url': 'http://c', 'method': 'GET'},
+        )
+        self.assertEqual([set(), {0}, {1}], g.dependencies)
+
+    def test_dynamic_reference_is_a_barrier(self):
+        g = graph(
+            {'url': 'http://a', 'method': 'GET'},
+            {'url': 'http://b', 'method': 'GET'},
+            {'url': 'http://c/${requests[route.json.i].response.text}', 'method': 'GET'},
+            {'url': 'http://d', 'method': 'GET'},
+        )
+        self.assertEqual([set(), set(), {0, 1}, {2}], g.dependencies)
+
+    def test_forward_reference_is_a_barrier(self):
+        g = graph(
+            {'url': 'http://a/${requests[1].response.text}', 'method': 'GET'},
+            {'url': 'http://b', 'method': 'GET'},
+        )
+        self.assertEqual([set(), {0}], g.dependencies)
+
+
+if __name__ == '__main__':
+    main()
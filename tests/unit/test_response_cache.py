@@ -0,0 +1,37 @@
+from unittest import TestCase, main
+
+from .context import agw_request, freeze, response_cache
+from service_exception_handler_plugin import InternalError
+
+
+def request(headers, **cache):
+    definition = {'url': 'http://a', 'method': 'GET', 'headers': headers, 'cache': {'ttl': 10, **cache}}
+    return agw_request.AGWRequest(agw_request.AGWRequestDefinition(**freeze(definition)))
+
+
+class TestCacheKey(TestCase):
+    def test_credentials_in_key(self):
+        for name in ('Authorization', 'Cookie'):
+            a = response_cache.get_cache_key(request({name: 'a'}))
+            b = response_cache.get_cache_key(request({name.lower(): 'b'}))
+            self.assertNotEqual(a, b)
+            self.assertEqual(a, response_cache.get_cache_key(request({name: 'a', 'X-Other': 'c'})))
+
+    def test_credentials_not_in_key(self):
+        self.assertEqual(response_cache.get_cache_key(request({'Authorization': 'Bearer a'}, vary_credentials=False)),
+                         response_cache.get_cache_key(request({'Authorization': 'Bearer b'}, vary_credentials=False)))
+
+    def test_vary_headers(self):
+        self.assertNotEqual(
+            response_cache.get_cache_key(request({'Accept-Language': 'fi'}, vary_headers=['Accept-Language'])),
+            response_cache.get_cache_key(request({'Accept-Language': 'en'}, vary_headers=['Accept-Language'])))
+
+    def test_not_cached(self):
+        self.assertIsNone(response_cache.get_cache_key(agw_request.AGWRequest(
+            agw_request.AGWRequestDefinition(url='http://a', method='GET'))))
+        with self.assertRaises(InternalError):
+            response_cache.validate_cache_policy({'ttl': 10, 'vary_credentials': 'no'})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import os
+import sqlite3
+import tempfile
+import time
+from unittest import TestCase, main, skipUnless
+from unittest.mock import patch
+
+from .context import SqliteCache
+
+
+class TestSqliteCache(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'cache.sqlite')
+        self.cache = SqliteCache('test_shared', 1024, self.path)
+
+    def test_put_and_get(self):
+        self.assertTrue(self.cache.put(b'key', {'a': [1, 'b']}, 60))
+        self.assertEqual({'a': [1, 'b']}, self.cache.get(b'key'))
+        self.assertIsNone(self.cache.get(b'other'))
+        self.assertEqual(1, len(self.cache))
+        self.assertEqual({'hits': 1, 'misses': 1}, {k: v for k, v in self.cache.stats().items()
+                                                    if k in ('hits', 'misses')})
+        self.assertEqual(0o600, os.stat(self.path).st_mode & 0o777)
+
+    def test_expiry(self):
+        self.cache.put('key', 'value', 0.01)
+        time.sleep(0.02)
+        self.assertIsNone(self.cache.get('key'))
+        self.assertFalse(self.cache.put('key', 'value', 0))
+
+    def test_eviction(self):
+        self.cache.put('first', 'x' * 500, 10)
+        self.cache.put('second', 'x' * 500, 20)
+        self.cache.put('third', 'x' * 500, 30)
+        self.assertIsNone(self.cache.get('first'))
+        self.assertEqual('x' * 500, self.cache.get('third'))
+        self.assertFalse(self.cache.put('large', 'x' * 2000, 10))
+
+    def sizes(self):
+        connection = self.cache._connection
+        return (connection.execute('SELECT size FROM sizes WHERE name = ?', ('test_shared',)).fetchone()[0],
+                connection.execute('SELECT SUM(LENGTH(value)) FROM entries WHERE name = ?',
+                                   ('test_shared',)).fetchone()[0] or 0)
+
+    def test_size_tracked(self):
+        self.cache.put('a', 'x' * 100, 60)
+        self.cache.put('a', 'x' * 10, 60)
+        self.cache.put('b', 'x' * 800, 60)
+        self.assertEqual((814, 814), self.sizes())
+        self.cache.put('c', 'x' * 300, 90)
+        self.assertEqual(2, self.cache.evictions)
+        self.assertEqual((302, 302), self.sizes())
+        self.cache.put('d', 'x' * 100, 60)
+        self.cache.delete('c')
+        self.assertEqual((102, 102), self.sizes())
+        self.cache.clear()
+        self.assertEqual((0, 0), self.sizes())
+
+    def test_size_of_existing_entries(self):
+        connection = sqlite3.connect(self.path)
+        with connection:
+            connection.execute('CREATE TABLE entries (name TEXT, key BLOB, value BLOB, expires_at REAL, '
+                               'PRIMARY KEY (name, key)) WITHOUT ROWID')
+            connection.execute('INSERT INTO entries VALUES (?, ?, ?, ?)',
+                               ('test_shared', b'a', b'"x"', time.time() + 60))
+        connection.close()
+        os.chmod(self.path, 0o600)
+        self.cache.put('b', 'y', 60)
+        self.assertEqual((6, 6), self.sizes())
+        self.assertEqual('x', self.cache.get('a'))
+
+    def test_names_are_separate(self):
+        other = SqliteCache('test_shared_other', 1024, self.path)
+        self.cache.put('key', 1, 60)
+        self.assertIsNone(other.get('key'))
+        other.put('key', 2, 60)
+        self.assertEqual(1, self.cache.get('key'))
+        self.cache.clear()
+        self.assertEqual(2, other.get('key'))
+
+    @skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_shared_with_forked_processes(self):
+        self.cache.put('parent', 1, 60)
+        pid = os.fork()
+        if pid == 0:
+            ok = self.cache.get('parent') == 1 and self.cache.put('child', 2, 60)
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+        self.assertEqual(2, self.cache.get('child'))
+
+    def test_errors_are_misses(self):
+        cache = SqliteCache('test_shared_error', 1024, os.path.join(self.path, 'missing', 'cache.sqlite'))
+        self.assertFalse(cache.put('key', 1, 60))
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(2, cache.errors)
+
+
+class TestPrivateDatabase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(self.directory, 'cache.sqlite')
+
+    def assertRejected(self, path):
+        cache = SqliteCache('test_shared_rejected', 1024, path)
+        self.assertFalse(cache.put('key', 1, 60))
+        self.assertEqual(1, cache.errors)
+
+    def test_directory_created(self):
+        path = os.path.join(self.directory, 'agw', 'cache.sqlite')
+        self.assertTrue(SqliteCache('test_shared_created', 1024, path).put('key', 1, 60))
+        self.assertEqual(0o700, os.stat(os.path.dirname(path)).st_mode & 0o777)
+
+    def test_loose_permissions_rejected(self):
+        with open(self.path, 'w'):
+            pass
+        os.chmod(self.path, 0o644)
+        self.assertRejected(self.path)
+        os.chmod(self.path, 0o600)
+        os.chmod(self.directory, 0o777)
+        self.assertRejected(self.path)
+
+    @skipUnless(hasattr(os, 'getuid') and os.getuid() == 0, 'requires root')
+    def test_file_of_other_user_rejected(self):
+        with open(self.path, 'w'):
+            pass
+        os.chmod(self.path, 0o600)
+        os.chown(self.path, 65534, -1)
+        self.assertRejected(self.path)
+
+    def test_directory_of_other_user_rejected(self):
+        with patch('shared_cache.os.getuid', return_value=os.getuid() + 1):
+            self.assertRejected(self.path)
+
+    def test_symlink_rejected(self):
+        target = os.path.join(self.directory, 'target')
+        os.symlink(target, self.path)
+        self.assertRejected(self.path)
+        self.assertFalse(os.path.exists(target))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import time
+from threading import Event, Thread
+from unittest import TestCase, main
+
+from requests.structures import CaseInsensitiveDict
+
+from .context import agw_request, freeze, get_flight_key, SingleFlight, Deadline
+
+
+def response(n: int):
+    return agw_request.AGWRequestResponse(200, CaseInsensitiveDict({'Content-Type': 'application/json'}),
+                                          f'{{"n": {n}}}'.encode())
+
+
+class TestSingleFlight(TestCase):
+    def test_concurrent_calls_are_coalesced(self):
+        flights = SingleFlight()
+        started = Event()
+        release = Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return response(len(calls))
+
+        results = []
+        leader = Thread(target=lambda: results.append(flights.do('key', Deadline(), fetch)))
+        leader.start()
+        started.wait(5)
+        follower = Thread(target=lambda: results.append(flights.do('key', Deadline(), fetch)))
+        follower.start()
+        while flights.coalesced == 0:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual([{'n': 1}, {'n': 1}], [r.json for r in results])
+        self.assertIsNot(results[0], results[1])
+        results[0].json['n'] = 2
+        self.assertEqual({'n': 1}, results[1].json)
+
+    def test_sequential_calls_are_not_coalesced(self):
+        flights = SingleFlight()
+        self.assertEqual({'n': 1}, flights.do('key', Deadline(), response, 1).json)
+        self.assertEqual({'n': 2}, flights.do('key', Deadline(), response, 2).json)
+        self.assertEqual(2, flights.leaders)
+
+    def test_error_is_raised(self):
+        def fail():
+            raise ValueError('fail')
+
+        with self.assertRaises(ValueError):
+            SingleFlight().do('key', Deadline(), fail)
+
+    def test_only_read_methods_have_a_key(self):
+        def request(method: str):
+            return agw_request.AGWRequest(agw_request.AGWRequestDefinition(**freeze({
+                'url': 'http://a', 'method': method, 'single_flight': True})))
+
+        self.assertIsNotNone(get_flight_key(request('GET')))
+        self.assertIsNotNone(get_flight_key(request('head')))
+        self.assertIsNone(get_flight_key(request('PUT')))
+        self.assertIsNone(get_flight_key(request('DELETE')))
+        self.assertIsNone(get_flight_key(request('POST')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from .context import agw_request, agw_route, freeze, template, GatewayRequestEnvironment
+from service_exception_handler_plugin import InternalError
+
+
+class TestParseKey(TestCase):
+    def test_parts(self):
+        self.assertEqual((
+            ('constants', template.NO_INDEX, None),
+            ('environments', template.DYNAMIC_KEY, 'route.json.environment'),
+            ('mop', template.NO_INDEX, None),
+        ), template.parse_key('constants.environments[route.json.environment].mop'))
+        self.assertEqual((
+            ('requests', template.INDEX, 0),
+            ('response', template.NO_INDEX, None),
+        ), template.parse_key('requests[0].response'))
+        self.assertEqual((('requests_by_name', template.KEY, 'a'),), template.parse_key("requests_by_name['a']"))
+
+    def test_invalid_keys(self):
+        for key in ('a..b', 'a[]', "a['b]", 'a[b[0]]', 'a]'):
+            with self.assertRaises(ValueError, msg=key):
+                template.parse_key(key)
+
+
+class TestTemplate(TestCase):
+    def setUp(self):
+        route = agw_route.AGWRoute(agw_route.AGWRouteDefinition(path='/a', method='GET'))
+        route.json = {'environment': 'beta', 'n': 1, 'obj': {}}
+        self.gre = GatewayRequestEnvironment({'environments': {'beta': {'mop': 'https://mop'}}}, route)
+
+    def evaluate(self, url):
+        agw_req = agw_request.AGWRequest(agw_request.AGWRequestDefinition(url=url))
+        self.gre.evaluate_and_add_request(agw_req)
+        return agw_req.url
+
+    def test_segments(self):
+        compiled = template.Template('a${b}c${d.e[0]}')
+        self.assertEqual(['a', 'c', ''], compiled.literals)
+        self.assertEqual(['b', 'd.e[0]'], [key for key, _ in compiled.keys])
+
+    def test_no_template(self):
+        self.assertIsNone(template.get_template('no templates $ {here}'))
+
+    def test_render(self):
+        template.compile_templates({'url': '${constants.environments[route.json.environment].mop}/v${route.json.n}'})
+        self.assertEqual('https://mop/v1', self.evaluate('${constants.environments[route.json.environment].mop}'
+                                                         '/v${route.json.n}'))
+        self.assertEqual('1-1', self.evaluate('${route.json.n}-${route.json.n}'))
+
+    def test_memoized_repeated_keys(self):
+        node = freeze({'a': '${route.json.n}-${route.json.environment}', 'b': ['${route.json.n}']})
+        keys = template.repeated_keys(template.find_template_keys(node))
+        self.assertEqual({'route.json.n'}, keys)
+        with patch.object(self.gre, '_lookup_template_value', wraps=self.gre._lookup_template_value) as lookup:
+            self.assertEqual({'a': '1-beta', 'b': ['1']}, self.gre._evaluate_memoized(node, keys))
+            self.assertEqual(['route.json.n', 'route.json.environment'], [c.args[0] for c in lookup.call_args_list])
+            lookup.reset_mock()
+            self.gre._evaluate_memoized(node, frozenset())
+            self.assertEqual(3, lookup.call_count)
+        self.assertIsNone(self.gre._rendered)
+
+    def test_reference_errors(self):
+        for url in ('${route.json.missing}', '${route.json.obj}', '${route..json}'):
+            with self.assertRaises(InternalError, msg=url):
+                self.evaluate(url)
+
+
+class TestFold(TestCase):
+    STATIC = {
+        'environment': {'A': 'a', 'N': 'b'},
+        'constants': {'l': [1, {'b': True}], 'd': {'k': 'v'}, 'envs': {'a': {'x': 'ax'}, 'b': {'x': 'bx'}, 'c': {}}}
+    }
+
+    def setUp(self):
+        route = agw_route.AGWRoute(agw_route.AGWRouteDefinition(path='/a', method='GET'))
+        route.json = {'environment': 'beta'}
+        self.gre = GatewayRequestEnvironment({'environments': {}}, route)
+
+    def resolve(self, key, parts):
+        return template.resolve_static(self.STATIC, parts) if parts is not None else None
+
+    def test_resolve_static(self):
+        for key, value in (('environment.A', 'a'), ('constants.l[0]', '1'), ('constants.l[1].b', 'True'),
+                           ("constants.d['k']", 'v'), ('constants.envs[environment.A].x', 'ax'),
+                           ('environment.MISSING', None), ('constants.l', None), ('constants.l[2]', None),
+                           ('constants.d[environment.A]', None), ('constants.d[route.json.a]', None),
+                           ('route.json', None)):
+            self.assertEqual(value, template.resolve_static(self.STATIC, template.parse_key(key)), msg=key)
+
+    def test_index_static(self):
+        self.assertEqual(('route.json.env', {'a': 'ax', 'b': 'bx'}),
+                         template.index_static(self.STATIC, template.parse_key('constants.envs[route.json.env].x')))
+        self.assertEqual(('route.json.env', {'k': 'v'}),
+                         template.index_static(self.STATIC, template.parse_key('constants.d[route.json.env]')))
+        for key in ('constants.l[route.json.i]', 'constants.envs.a', 'constants.envs[route.a].x[route.b]'):
+            self.assertIsNone(template.index_static(self.STATIC, template.parse_key(key)), msg=key)
+
+    def test_fold(self):
+        definition = {'url': '${environment.A}/${route.json.a}/${environment.MISSING}', 'list': ['${environment.A}'],
+                      'n': 1}
+        self.assertEqual({'url': 'a/${route.json.a}/${environment.MISSING}', 'list': ['a'], 'n': 1},
+                         template.fold_templates(definition, self.resolve))
+        self.assertEqual('${environment.A}', definition['list'][0])
+
+    def test_indexed_value(self):
+        parts = template.parse_key('constants.environments[route.json.environment].mop')
+        self.gre.dynamic_indexes = {parts: ('route.json.environment', {'beta': 'https://indexed'})}
+        self.assertEqual('https://indexed', self.gre._template_value('', parts))
+        self.gre.route.json['environment'] = 'alpha'
+        with self.assertRaises(InternalError):
+            self.gre._template_value('constants.environments[route.json.environment].mop', parts)
+
+
+if __name__ == '__main__':
+    main()
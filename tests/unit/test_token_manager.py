@@ -0,0 +1,133 @@
+import os
+import tempfile
+import time
+from threading import Event, Thread
+from unittest import TestCase, main
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from .context import TokenManager, SqliteCache
+from service_exception_handler_plugin import InternalError
+
+
+def token_response(token, expires_in=None):
+    body = {'access_token': token, 'token_type': 'bearer'}
+    if expires_in is not None:
+        body['expires_in'] = expires_in
+    return MagicMock(status_code=200, json=MagicMock(return_value=body))
+
+
+class TestTokenManager(TestCase):
+    def setUp(self):
+        self.post = MagicMock(return_value=token_response('first', 3600))
+        openid_configuration = MagicMock(json=MagicMock(return_value={'token_endpoint': 'http://idp/token'}))
+        session = MagicMock(post=self.post, get=MagicMock(return_value=openid_configuration))
+        patch('token_manager.upstream_pool.get_session', return_value=session).start()
+        self.addCleanup(patch.stopall)
+        self.tokens = TokenManager('test_agw_token', 'http://idp/.well-known/openid-configuration', 'agw', 'secret',
+                                   'agw', 60)
+        # Keep the refresh thread from starting
+        self.tokens._start_refresher = MagicMock()
+
+    def test_token_is_reused(self):
+        self.assertEqual('first', self.tokens.get_token())
+        self.assertEqual('first', self.tokens.get_token())
+        self.assertEqual(1, self.post.call_count)
+        self.assertEqual('http://idp/token', self.post.call_args.args[0])
+        self.assertEqual(3600, self.tokens.stats()['expires_in'])
+
+    def test_expired_token_is_fetched(self):
+        self.tokens.get_token()
+        self.tokens._expires_at = time.monotonic() - 1
+        self.post.return_value = token_response('second', 3600)
+        self.assertEqual('second', self.tokens.get_token())
+
+    def test_renew(self):
+        self.tokens.get_token()
+        self.post.return_value = token_response('second')
+        self.assertEqual('second', self.tokens.renew('first'))
+        # Already renewed by another caller
+        self.assertEqual('second', self.tokens.renew('first'))
+        self.assertEqual(2, self.post.call_count)
+        self.assertIsNone(self.tokens.stats()['expires_in'])
+
+    def test_concurrent_refreshes_are_coalesced(self):
+        started = Event()
+        release = Event()
+
+        def post(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return token_response('first', 3600)
+
+        self.post.side_effect = post
+        results = []
+        leader = Thread(target=lambda: results.append(self.tokens.get_token()))
+        leader.start()
+        started.wait(5)
+        follower = Thread(target=lambda: results.append(self.tokens.refresh()))
+        follower.start()
+        while self.tokens.coalesced == 0:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(['first', 'first'], results)
+        self.assertEqual(1, self.post.call_count)
+
+    def test_failure(self):
+        self.post.side_effect = requests.ConnectionError('refused')
+        with self.assertRaises(InternalError):
+            self.tokens.get_token()
+        self.assertEqual(1, self.tokens.stats()['failures'])
+
+    def test_refresh_before_expiry(self):
+        self.post.return_value = token_response('first', 0.2)
+        del self.tokens._start_refresher
+        self.tokens.refresh_margin = 0.15
+        self.assertEqual('first', self.tokens.get_token())
+        self.post.return_value = token_response('second', 3600)
+        deadline = time.monotonic() + 5
+        while self.tokens._token != 'second' and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual('second', self.tokens.get_token())
+        self.assertEqual(2, self.post.call_count)
+
+
+class TestSharedToken(TestCase):
+    def setUp(self):
+        self.post = MagicMock(return_value=token_response('first', 3600))
+        openid_configuration = MagicMock(json=MagicMock(return_value={'token_endpoint': 'http://idp/token'}))
+        session = MagicMock(post=self.post, get=MagicMock(return_value=openid_configuration))
+        patch('token_manager.upstream_pool.get_session', return_value=session).start()
+        self.addCleanup(patch.stopall)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'cache.sqlite')
+        # Managers of two workers
+        self.workers = [TokenManager(f'test_agw_token_{i}', 'http://idp/.well-known/openid-configuration', 'agw',
+                                     'secret', 'agw', 60, SqliteCache('test_agw_token_shared', 4096, path))
+                        for i in range(2)]
+        for tokens in self.workers:
+            tokens._start_refresher = MagicMock()
+
+    def test_token_is_shared(self):
+        self.assertEqual('first', self.workers[0].get_token())
+        self.assertEqual('first', self.workers[1].get_token())
+        self.assertEqual(1, self.post.call_count)
+        self.assertLessEqual(self.workers[1]._refresh_at, self.workers[1]._expires_at - 60)
+
+    def test_rejected_token_is_not_shared(self):
+        self.workers[0].get_token()
+        self.workers[1].get_token()
+        self.post.return_value = token_response('second', 3600)
+        self.assertEqual('second', self.workers[1].renew('first'))
+        # Renewed by the other worker
+        self.assertEqual('second', self.workers[0].renew('first'))
+        self.assertEqual(2, self.post.call_count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+from collections import deque
+from unittest import TestCase, main
+from unittest.mock import patch
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from .context import agw_request, upstream_policy, Deadline
+
+
+def request(**kwargs):
+    return agw_request.AGWRequest(agw_request.AGWRequestDefinition(url='http://a/b', method='GET', **kwargs))
+
+
+def responses(*outcomes):
+    calls = []
+
+    def send(agw_req, deadline):
+        outcome = outcomes[len(calls)]
+        calls.append(outcome)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return agw_request.AGWRequestResponse(outcome, CaseInsensitiveDict())
+
+    return send, calls
+
+
+@patch.object(upstream_policy.time, 'sleep')
+class TestRetry(TestCase):
+    def test_retry_on_status(self, sleep):
+        send, calls = responses(503, 502, 200)
+        agw_resp = upstream_policy.UpstreamPolicy().send(request(retry={'max_attempts': 3}), Deadline(), send)
+        self.assertEqual(200, agw_resp.status)
+        self.assertEqual(3, len(calls))
+        self.assertEqual(2, sleep.call_count)
+
+    def test_last_response_is_returned(self, sleep):
+        send, calls = responses(503, 503)
+        agw_resp = upstream_policy.UpstreamPolicy().send(request(retry={'max_attempts': 2}), Deadline(), send)
+        self.assertEqual(503, agw_resp.status)
+        self.assertEqual(2, len(calls))
+
+    def test_retry_on_connection_error(self, sleep):
+        send, calls = responses(requests.ConnectionError(), 200)
+        agw_resp = upstream_policy.UpstreamPolicy().send(request(retry={}), Deadline(), send)
+        self.assertEqual(200, agw_resp.status)
+
+    def test_last_error_is_raised(self, sleep):
+        send, calls = responses(requests.ConnectionError(), requests.ConnectionError())
+        with self.assertRaises(requests.ConnectionError):
+            upstream_policy.UpstreamPolicy().send(request(retry={'max_attempts': 2}), Deadline(), send)
+
+    def test_other_statuses_and_methods_are_not_retried(self, sleep):
+        send, calls = responses(500)
+        upstream_policy.UpstreamPolicy().send(request(retry={}), Deadline(), send)
+        send, calls = responses(503)
+        agw_req = request(retry={})
+        agw_req.method = 'POST'
+        upstream_policy.UpstreamPolicy().send(agw_req, Deadline(), send)
+        self.assertEqual(1, len(calls))
+
+    def test_retry_is_bounded_by_deadline(self, sleep):
+        send, calls = responses(503, 200)
+        deadline = Deadline(10)
+        with patch.object(deadline, 'remaining', return_value=0.4), \
+                patch.object(upstream_policy.random, 'uniform', return_value=0.5):
+            agw_resp = upstream_policy.UpstreamPolicy().send(request(retry={}), deadline, send)
+        self.assertEqual(503, agw_resp.status)
+        self.assertEqual(1, len(calls))
+
+
+class TestHedgeDelay(TestCase):
+    def test_percentile(self):
+        latencies = deque([i / 10 for i in range(1, 11)])
+        delay = upstream_policy.UpstreamPolicy._hedge_delay
+        self.assertEqual(1.0, delay({'percentile': 95, 'min_samples': 10}, latencies))
+        self.assertEqual(0.6, delay({'percentile': 50, 'min_samples': 10}, latencies))
+        self.assertEqual(0.2, delay({'percentile': 50, 'delay': 0.2}, latencies))
+        self.assertIsNone(delay({'percentile': 50}, latencies))
+
+
+if __name__ == '__main__':
+    main()
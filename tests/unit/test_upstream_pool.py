@@ -0,0 +1,78 @@
+import gc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from .context import UpstreamPool, settings
+
+
+class TestUpstreamPool(TestCase):
+    def test_sessions_are_pooled_per_host(self):
+        pool = UpstreamPool()
+        session = pool.get_session('http://a.example/x')
+        self.assertIs(session, pool.get_session('HTTP://A.example/y?q=1'))
+        self.assertIsNot(session, pool.get_session('https://a.example/x'))
+        self.assertIsNot(session, pool.get_session('http://b.example/x'))
+        self.assertIsNot(session, pool.get_session('http://a.example/x', {'size': 2}))
+        self.assertIsNot(session, pool.get_session('http://a.example/x', {'keep_alive': False}))
+        self.assertEqual({'pools': 5, 'hits': 1, 'misses': 5, 'expired': 0}, pool.stats())
+
+    def test_keep_alive_option(self):
+        pool = UpstreamPool()
+        self.assertEqual('close', pool.get_session('http://a.example', {'keep_alive': False}).headers['Connection'])
+        self.assertEqual('keep-alive', pool.get_session('http://a.example', {'keep_alive': True}).headers['Connection'])
+
+    def test_cookies_are_not_kept(self):
+        cookies = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                cookies.append(self.headers.get('Cookie'))
+                self.send_response(200)
+                self.send_header('Set-Cookie', 'session=a; Path=/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f'http://127.0.0.1:{server.server_port}/'
+        pool = UpstreamPool()
+        for _ in range(2):
+            pool.get_session(url).get(url, timeout=5)
+        self.assertEqual([None, None], cookies)
+        self.assertEqual(0, len(pool.get_session(url).cookies))
+
+    def test_idle_session_is_dropped_without_closing(self):
+        pool = UpstreamPool()
+        with patch('upstream_pool.time.monotonic', return_value=100):
+            session = pool.get_session('http://a.example')
+        adapter = session.get_adapter('http://a.example')
+        with patch('upstream_pool.time.monotonic', return_value=100 + settings.UPSTREAM_KEEP_ALIVE_TIMEOUT + 1), \
+                patch.object(adapter, 'close') as close:
+            replacement = pool.get_session('http://a.example')
+            self.assertIsNot(session, replacement)
+            self.assertEqual(1, pool.expired)
+            # Still usable by a thread holding it
+            close.assert_not_called()
+            del session
+            gc.collect()
+            close.assert_called_once()
+
+    def test_reset_after_fork(self):
+        pool = UpstreamPool()
+        session = pool.get_session('http://a.example')
+        executor = pool.get_executor()
+        pool._pid = -1
+        self.assertIsNot(session, pool.get_session('http://a.example'))
+        self.assertIsNot(executor, pool.get_executor())
+        self.assertEqual(2, pool.misses)
+
+
+if __name__ == '__main__':
+    main()